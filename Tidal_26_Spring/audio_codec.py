@@ -0,0 +1,52 @@
+import numpy as np
+
+# --- AUDIO CODECS ---
+# pcm16   : raw 16-bit little-endian PCM @ 16 kHz (what legacy clients get, 256 kbit/s)
+# mulaw   : G.711 mu-law, 8 bits per sample @ 16 kHz (2x smaller)
+# mulaw8k : pairs averaged down to 8 kHz, then mu-law (4x smaller; still plenty for crying)
+CODECS = {"pcm16": 16000, "mulaw": 16000, "mulaw8k": 8000} # codec -> output sample rate
+DEFAULT_CODEC = "mulaw"
+
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+
+def _build_mulaw_tables():
+    # Encode every possible int16 once; encoding a block is then a single table lookup
+    x = np.arange(-32768, 32768, dtype=np.int32)
+    sign = (x < 0).astype(np.int32) << 7
+    mag = np.minimum(np.abs(x), MULAW_CLIP) + MULAW_BIAS
+    exponent = np.clip(np.floor(np.log2(mag)).astype(np.int32) - 7, 0, 7)
+    mantissa = (mag >> (exponent + 3)) & 0x0F
+    encoded = (~(sign | (exponent << 4) | mantissa)) & 0xFF
+    # Index by the uint16 bit pattern so a plain .view(np.uint16) of the PCM can be used
+    encode_table = np.empty(65536, dtype=np.uint8)
+    encode_table[x.astype(np.int16).view(np.uint16)] = encoded
+
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exp = (codes >> 4) & 0x07
+    mag = (((codes & 0x0F) << 3) + MULAW_BIAS) << exp
+    decode_table = np.where(codes & 0x80, MULAW_BIAS - mag, mag - MULAW_BIAS).astype(np.int16)
+    return encode_table, decode_table
+
+MULAW_ENCODE, MULAW_DECODE = _build_mulaw_tables()
+
+def mulaw_encode(pcm):
+    """int16 samples -> uint8 mu-law codes"""
+    return MULAW_ENCODE[np.asarray(pcm, dtype=np.int16).view(np.uint16)]
+
+def mulaw_decode(codes):
+    """uint8 mu-law codes -> int16 samples"""
+    return MULAW_DECODE[np.frombuffer(codes, dtype=np.uint8)]
+
+def downsample_2x(pcm):
+    # Averaging pairs is a crude low-pass, but cheap and good enough for voice/crying
+    n = len(pcm) // 2 * 2
+    return ((pcm[0:n:2].astype(np.int32) + pcm[1:n:2]) >> 1).astype(np.int16)
+
+def encode_audio(parts, codec):
+    """parts is a list of int16 arrays (ring buffer views) -> encoded bytes"""
+    if codec == "pcm16":
+        return b''.join(memoryview(np.ascontiguousarray(p)).cast('B') for p in parts)
+    if codec == "mulaw8k":
+        parts = [downsample_2x(p) for p in parts]
+    return b''.join(mulaw_encode(p).tobytes() for p in parts)
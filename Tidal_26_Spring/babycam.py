@@ -6,16 +6,59 @@ import asyncio
 import websockets
 import json
 import socket
-import base64
-import sounddevice as sd
+import os
 import threading
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
 from google.genai import types
+from pipeline import make_stage_pool, put_latest, shared_cascade, FrameScheduler, StagedLoop
+from sources import open_audio_source
+from metrics import make_metrics, NULL_METRICS
+from recorder import EventRecorder
+from vitals_store import VitalsStore
+
+# The microphone is only needed for live audio (replays and WAV sources work without PortAudio)
+try:
+    import sounddevice as sd
+except (ImportError, OSError) as e:
+    sd = None
+    print(f"⚠️ sounddevice unavailable: {e}")
+from transport import VideoPublisher, encode_tiers, DEFAULT_TIER
+from audio_codec import encode_audio
 
 # ⚠️ PUT YOUR KEY HERE
 GEMINI_API_KEY = ""
 
+# --- DETECTION SETTINGS ---
+DETECTION_MODE = "parallel"  # "parallel" (downscaled, concurrent orientation passes) or "sequential"
+DETECTION_SCALE = 0.5        # Resolution used for the parallel orientation passes
+REDETECT_EVERY = 15          # Frames between full face searches (x3 while the scheduler sheds detection)
+RPPG_METHOD = "pos"          # Heart rate: "pos" / "chrom" (forehead + cheeks, fused) or "green" (forehead only)
+RESPIRATION_MODE = "points"  # "points" (sparse LK on chest corners) or "dense" (Farneback on a downscaled chest ROI)
+
+# --- INPUT SETTINGS ---
+VIDEO_SOURCE = 0     # Camera index, a video file, a folder of images, "synthetic:hr=120,rr=30" or "bus:<name>"
+AUDIO_SOURCE = None  # None = default microphone, a 16 kHz WAV file or "synthetic:cry"
+
+# --- METRICS SETTINGS ---
+METRICS = True       # Per-stage timings + counters ("metrics" WebSocket command); False = no-op, no cost
+METRICS_PORT = 9101  # Prometheus text endpoint on localhost (None = WebSocket only)
+
+# --- RECORDING SETTINGS ---
+RECORDING = True              # Save a clip (video + audio, with pre-roll) to disk whenever an ALERT is raised
+RECORDINGS_DIR = "recordings" # Clips are listed/streamed with the list_clips / get_clip WebSocket commands
+PRE_ROLL = 10.0               # Seconds kept in memory before the alert
+POST_ROLL = 10.0              # Seconds recorded after the last alert
+
+# --- HISTORY SETTINGS ---
+HISTORY = True          # Keep every reading on disk (memory-mapped, with 1 s / 1 min / 10 min rollups)
+HISTORY_DIR = "history" # One folder per camera; query it with the "history" WebSocket command
+
+# --- POWER SETTINGS ---
+HEADLESS = False  # No preview window (always-on units without a display)
+ACTIVE_FPS = 10.0 # Target analysis rate while someone is watching (paced by deadlines, shed under load)
+IDLE_FPS = 5.0    # Capture/analysis rate while nobody is watching (safety checks keep running)
+
 # Configure Gemini
 GEMINI_AVAILABLE = False
 client = None
@@ -40,47 +83,243 @@ def get_local_ip():
         s.close()
     return IP
 
+# --- ORIENTATION HELPERS ---
+CASCADE_FILES = {"frontal": 'haarcascade_frontalface_default.xml', "profile": 'haarcascade_profileface.xml'}
+
+# (cascade, orientation) in priority order; the first orientation with hits wins
+DETECTION_PASSES = [("frontal", "upright"), ("profile", "upright"), ("profile", "flipped"),
+                    ("frontal", "90"), ("frontal", "270"), ("frontal", "180")]
+
+ROTATE_CODES = {"90": cv2.ROTATE_90_CLOCKWISE, "270": cv2.ROTATE_90_COUNTERCLOCKWISE, "180": cv2.ROTATE_180}
+
+# Direction of the baby's head in frame coordinates (the chest lies the other way)
+HEAD_DIRECTION = {"upright": (0, -1), "flipped": (0, -1), "90": (-1, 0), "270": (1, 0), "180": (0, 1)}
+
+def orient_image(img, orientation):
+    if orientation == "flipped": return cv2.flip(img, 1)
+    if orientation in ROTATE_CODES: return cv2.rotate(img, ROTATE_CODES[orientation])
+    return img
+
+def remap_box(box, orientation, W, H):
+    """Maps a box found in orient_image(img) back into img coordinates (img is W x H)"""
+    x, y, w, h = [int(round(v)) for v in box]
+    if orientation == "flipped": return (W - x - w, y, w, h)
+    if orientation == "90": return (y, H - x - w, h, w)
+    if orientation == "270": return (W - y - h, x, h, w)
+    if orientation == "180": return (W - x - w, H - y - h, w, h)
+    return (x, y, w, h)
+
+# Skin regions for the pulse: (across the face, toward the top of the head, half width, half height),
+# as fractions of the face box measured from its center, so they follow the face at any size or rotation
+SKIN_ROIS = (("forehead", 0.0, 0.30, 0.20, 0.08), ("cheek_left", -0.24, -0.10, 0.09, 0.09), ("cheek_right", 0.24, -0.10, 0.09, 0.09))
+
+def skin_boxes(face, orientation, W, H):
+    """(n, 4) int array of x0, y0, x1, y1 per SKIN_ROIS entry, clipped to the frame"""
+    x, y, w, h = face
+    hx, hy = HEAD_DIRECTION.get(orientation, (0, -1))
+    rx, ry = -hy, hx # Across the face
+    along, across = (h, w) if hy != 0 else (w, h)
+    rois = np.array([r[1:] for r in SKIN_ROIS], dtype=np.float64)
+    cx = x + w / 2 + rois[:, 0] * across * rx + rois[:, 1] * along * hx
+    cy = y + h / 2 + rois[:, 0] * across * ry + rois[:, 1] * along * hy
+    ex, ey = (rois[:, 2] * across, rois[:, 3] * along) if hy != 0 else (rois[:, 3] * along, rois[:, 2] * across)
+    boxes = np.round(np.stack([cx - ex, cy - ey, cx + ex, cy + ey], axis=1)).astype(int)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, W)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, H)
+    return boxes
+
+def roi_means(frame, boxes):
+    """Mean BGR of every box from one integral image over their union -> (n, 3), NaN for empty boxes"""
+    x0, y0 = boxes[:, 0].min(), boxes[:, 1].min()
+    x1, y1 = boxes[:, 2].max(), boxes[:, 3].max()
+    if x1 <= x0 or y1 <= y0: return np.full((len(boxes), 3), np.nan)
+    ii = cv2.integral(frame[y0:y1, x0:x1]).astype(np.float64)
+    b = boxes - np.array([x0, y0, x0, y0])
+    sums = ii[b[:, 3], b[:, 2]] - ii[b[:, 1], b[:, 2]] - ii[b[:, 3], b[:, 0]] + ii[b[:, 1], b[:, 0]]
+    area = ((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / area[:, None]
+
+def chest_box(face, orientation, W, H):
+    """Returns (left, top, right, bottom) of the chest region next to the face, away from the head"""
+    x, y, w, h = face
+    hx, hy = HEAD_DIRECTION.get(orientation, (0, -1))
+    if hy == -1: left, top, right, bottom = x + int(w * 0.2), y + h, x + int(w * 0.8), y + h + 150
+    elif hy == 1: left, top, right, bottom = x + int(w * 0.2), y - 150, x + int(w * 0.8), y
+    elif hx == -1: left, top, right, bottom = x + w, y + int(h * 0.2), x + w + 150, y + int(h * 0.8)
+    else: left, top, right, bottom = x - 150, y + int(h * 0.2), x, y + int(h * 0.8)
+    return max(0, left), max(0, top), min(W, right), min(H, bottom)
+
+class AudioRing:
+    """Preallocated int16 sample ring; each reader keeps its own position and gets views, not copies"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=np.int16)
+        self.written = 0 # Total samples ever written (reader positions are in the same units)
+        self.lock = threading.Lock()
+
+    def write(self, samples):
+        n = len(samples)
+        if n > self.capacity: # Only the newest capacity samples can survive anyway
+            with self.lock:
+                self.written += n - self.capacity
+            samples = samples[-self.capacity:]; n = self.capacity
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        np.copyto(self.data[start:start+first], samples[:first], casting='unsafe')
+        if n > first:
+            np.copyto(self.data[:n-first], samples[first:], casting='unsafe')
+        with self.lock:
+            self.written += n
+
+    def read(self, pos):
+        """Returns (views, new_pos) for everything written since pos; a reader that fell behind skips ahead"""
+        with self.lock:
+            end = self.written
+        pos = max(pos, end - self.capacity)
+        if pos >= end: return [], end
+        start = pos % self.capacity; stop = end % self.capacity
+        if start < stop or stop == 0:
+            return [self.data[start:stop or self.capacity]], end
+        return [self.data[start:], self.data[:stop]], end
+
+    def latest(self, n, out):
+        """Copies the newest n samples into out (a preallocated array); returns how many were available"""
+        with self.lock:
+            end = self.written
+        parts, _ = self.read(end - min(n, self.capacity))
+        filled = 0
+        for part in parts:
+            out[filled:filled+len(part)] = part
+            filled += len(part)
+        return filled
+
 class AudioMonitor:
-    def __init__(self, threshold=25.0): 
-        self.threshold = threshold
-        self.is_loud = False
+    def __init__(self, samplerate=16000, blocksize=1600, ring_seconds=2.0, source=None, autostart=True): 
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.source = source # None = microphone; otherwise anything with read(n) (see sources.py)
         self.running = True
-        self.loud_frames = 0
-        self.audio_buffer = []
-        self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self._listen, daemon=True)
-        self.thread.start()
+        self.ring = AudioRing(int(samplerate * ring_seconds))
+        self.read_pos = 0
+        self.scratch = np.zeros(blocksize, dtype=np.float32) # Reused by the callback, no per-block allocations
+        self.thread = threading.Thread(target=self._listen if source is None else self._play, daemon=True)
+        if autostart: self.thread.start() # A replay feeds the ring itself, in virtual time
 
     def get_audio_chunk(self):
-        with self.lock:
-            if not self.audio_buffer:
-                return ""
-            data = b''.join(self.audio_buffer)
-            self.audio_buffer.clear()
-            return base64.b64encode(data).decode('utf-8')
+        """Returns ring views (int16) of the samples captured since the last call"""
+        parts, self.read_pos = self.ring.read(self.read_pos)
+        return parts
+
+    def write(self, samples):
+        # float32 -> int16 PCM into the ring, all analysis happens elsewhere
+        scratch = self.scratch[:len(samples)]
+        np.multiply(samples, 32767, out=scratch)
+        np.clip(scratch, -32768, 32767, out=scratch)
+        self.ring.write(scratch)
 
     def _listen(self):
+        if sd is None: return
         def callback(indata, frames, time, status):
-            volume_norm = np.linalg.norm(indata) * 50
-            if volume_norm > self.threshold:
-                self.loud_frames += 1
-            else:
-                self.loud_frames = max(0, self.loud_frames - 1)
-            
-            if self.loud_frames > 5:
-                self.is_loud = True
-            else:
-                self.is_loud = False
-            
-            # Capture audio: Convert float32 to int16 PCM
-            pcm_data = (indata * 32767).clip(-32768, 32767).astype(np.int16).tobytes()
-            with self.lock:
-                self.audio_buffer.append(pcm_data)
+            # Real-time thread: nothing but the ring write
+            self.write(indata[:, 0])
 
-        with sd.InputStream(callback=callback, channels=1, samplerate=16000, blocksize=1600):
+        with sd.InputStream(callback=callback, channels=1, samplerate=self.samplerate, blocksize=self.blocksize):
             while self.running:
                 sd.sleep(100)
     
+    def _play(self):
+        # File/synthetic audio at the real sample rate, so it lines up with live video
+        next_due = time.monotonic()
+        while self.running:
+            block = self.source.read(self.blocksize)
+            if block is None: break
+            self.write(block)
+            next_due += len(block) / self.samplerate
+            time.sleep(max(0, next_due - time.monotonic()))
+
+    def stop(self):
+        self.running = False
+
+class CryDetector:
+    """Batched STFT over the recent audio ring: band energy + 300-600 Hz pitch + periodicity -> cry confidence"""
+    def __init__(self, ring, samplerate=16000, window_seconds=1.0, interval=0.25, loud_threshold=25.0,
+                 frame_size=512, hop=256, f0_range=(300.0, 600.0), band=(300.0, 3000.0), autostart=True, metrics=NULL_METRICS):
+        self.ring = ring
+        self.metrics = metrics
+        self.samplerate = samplerate
+        self.interval = interval
+        self.loud_threshold = loud_threshold
+        self.frame_size = frame_size
+        self.hop = hop
+        self.window_samples = int(samplerate * window_seconds)
+        self.buffer = np.zeros(self.window_samples, dtype=np.int16)
+        self.hann = np.hanning(frame_size).astype(np.float32)
+        
+        # Zero-padded FFT so the autocorrelation (irfft of the power spectrum) is not circular
+        self.nfft = 2 * frame_size
+        freqs = np.fft.rfftfreq(self.nfft, 1.0 / samplerate)
+        self.band_mask = (freqs >= band[0]) & (freqs <= band[1])
+        self.min_lag = int(samplerate / f0_range[1]); self.max_lag = int(np.ceil(samplerate / f0_range[0]))
+        
+        self.noise_floor = None
+        self.confidence = 0.0
+        self.pitch = 0.0
+        self.loud_blocks = 0
+        self.is_loud = False
+        self.read_pos = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        if autostart: self.thread.start() # Otherwise the caller drives update()
+
+    def _loop(self):
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                with self.metrics.timer("cry"):
+                    self.update()
+            except Exception as e:
+                print(f"Cry detector error: {e}")
+
+    def update(self):
+        # --- LOUDNESS (same norm * 50 > threshold rule the callback used, per 100 ms block) ---
+        parts, self.read_pos = self.ring.read(self.read_pos)
+        new_samples = sum(len(p) for p in parts)
+        if new_samples == 0: return
+        block = self.samplerate // 10
+        for p in parts:
+            blocks = p[:len(p) // block * block].reshape(-1, block).astype(np.float32) / 32767
+            for loud in np.sqrt(np.einsum('ij,ij->i', blocks, blocks)) * 50 > self.loud_threshold:
+                self.loud_blocks = self.loud_blocks + 1 if loud else max(0, self.loud_blocks - 1)
+        self.is_loud = self.loud_blocks > 5
+        
+        # --- SPECTRAL FEATURES over the last window, all frames at once ---
+        filled = self.ring.latest(self.window_samples, self.buffer)
+        if filled < self.frame_size: return
+        x = self.buffer[:filled].astype(np.float32) / 32768
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.frame_size)[::self.hop] * self.hann
+        power = np.abs(np.fft.rfft(frames, n=self.nfft, axis=1)) ** 2
+        
+        energy = power.sum(axis=1) + 1e-12
+        band_ratio = power[:, self.band_mask].sum(axis=1) / energy
+        
+        ac = np.fft.irfft(power, n=self.nfft, axis=1)[:, :self.max_lag + 1]
+        ac = ac / (ac[:, :1] + 1e-12)
+        lags = ac[:, self.min_lag:self.max_lag + 1]
+        periodicity = lags.max(axis=1)
+        f0 = self.samplerate / (lags.argmax(axis=1) + self.min_lag)
+        
+        # Quiet frames track the background level (slowly) so a cry is judged relative to the room
+        rms = np.sqrt(energy / self.frame_size)
+        quietest = np.percentile(rms, 10)
+        self.noise_floor = quietest if self.noise_floor is None else min(0.95 * self.noise_floor + 0.05 * quietest, max(quietest, 1e-6))
+        
+        # Cry-like frame: clearly above the room level, strongly periodic with a 300-600 Hz fundamental, energy in the cry band
+        cry_frames = (rms > 3 * self.noise_floor) & (rms > 1e-3) & (periodicity > 0.45) & (band_ratio > 0.6)
+        score = min(1.0, float(cry_frames.mean()) / 0.4) # 40% of the window being cry-like is a confident cry
+        self.confidence = 0.6 * self.confidence + 0.4 * score
+        self.pitch = float(np.median(f0[cry_frames])) if cry_frames.any() else 0.0
+
     def stop(self):
         self.running = False
 
@@ -101,118 +340,183 @@ class Stabilizer:
         self.value = (self.value * self.decay) + (new_val * (1 - self.decay))
         return self.value
 
-class NannyCamServer:
-    def __init__(self):
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        self.profile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
-        self.hr_stabilizer = Stabilizer(decay=0.96, threshold=2.0)
-        self.rr_stabilizer = Stabilizer(decay=0.85, threshold=1.0) 
-        
-        self.hr_buffer = [] 
-        self.hr_times = []
-        
-        self.lk_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
-        self.old_gray = None
-        self.p0_chest = None
-        self.resp_buffer = [] 
-        
-        self.bad_tracking_frames = 0
-        self.connected_clients = set()
-        
-        print("🎙️ Initializing Audio...")
-        self.audio_monitor = AudioMonitor(threshold=25.0)
+class RingBuffer:
+    """Preallocated sample + timestamp ring (no list.pop(0) shuffling)"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=np.float64)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.head = 0
+        self.size = 0
+        self.total = 0 # Numbers the waveform stream; clear() jumps it ahead so clients see a gap and resnapshot
 
-        self.last_face_time = time.time()
-        self.is_rolled_over = False
-        
-        # GEMINI STATE
-        self.gemini_status = None
-        self.gemini_last_update = 0 # Timestamp of last AI response
-        self.last_gemini_check = 0
-        self.gemini_lock = False
+    def __len__(self):
+        return self.size
 
-    def detect_faces_robust(self, gray):
-        # 1. Try Upright Frontal
-        faces = list(self.face_cascade.detectMultiScale(gray, 1.3, 5))
-        if len(faces) > 0: return faces, "upright"
-        
-        # 2. Try Upright Profile
-        faces = list(self.profile_cascade.detectMultiScale(gray, 1.3, 5))
-        if len(faces) > 0: return faces, "upright" # Treat profile like upright for tracking
-        
-        # 3. Try Profile Flipped (looking other way)
-        flipped = cv2.flip(gray, 1)
-        faces = list(self.profile_cascade.detectMultiScale(flipped, 1.3, 5))
-        if len(faces) > 0: return faces, "flipped" # Don't track, coords are flipped
-        
-        # 4. Try 90 Rotations (Sideways Sleeping)
-        for output_tag, code in [("90", cv2.ROTATE_90_CLOCKWISE), ("270", cv2.ROTATE_90_COUNTERCLOCKWISE), ("180", cv2.ROTATE_180)]:
-            rotated = cv2.rotate(gray, code)
-            faces = list(self.face_cascade.detectMultiScale(rotated, 1.3, 5))
-            if len(faces) > 0: return faces, output_tag
+    def append(self, value, t):
+        self.data[self.head] = value
+        self.times[self.head] = t
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total += 1
 
-        return [], "none"
+    def last(self):
+        return self.data[self.head - 1] if self.size > 0 else 0.0
 
-    async def register_client(self, websocket):
-        self.connected_clients.add(websocket)
-        try:
-            await websocket.wait_closed()
-        finally:
-            self.connected_clients.remove(websocket)
+    def clear(self):
+        self.head = 0
+        self.size = 0
+        self.total += self.capacity # Discontinuity: every client position now falls before the window
 
-    async def broadcast_data(self, data):
-        if not self.connected_clients: return
-        message = json.dumps(data)
-        websockets.broadcast(self.connected_clients, message)
-    
-    # --- GEMINI WORKER ---
-    def check_with_gemini(self, frame_bgr):
-        if self.gemini_lock or not GEMINI_AVAILABLE: return
-        self.gemini_lock = True
+    def tail(self, n=None):
+        """Returns (values, times) of the newest n samples in time order"""
+        n = self.size if n is None else min(n, self.size)
+        idx = np.arange(self.head - n, self.head) % self.capacity
+        return self.data[idx], self.times[idx]
+
+def resample_uniform(values, times, rate):
+    """Linear interpolation onto an evenly spaced time grid (frame times jitter, frames get dropped or shed)"""
+    n = int((times[-1] - times[0]) * rate) + 1
+    grid = times[0] + np.arange(n) / rate
+    return np.interp(grid, times, values), grid
+
+class RppgEstimator:
+    """Pulse from skin color in all SKIN_ROIS at once: CHROM or POS per region over the whole window,
+    then one spectrum fused from the regions, each weighted by its own signal quality"""
+    def __init__(self, capacity=150, method="pos", rate=10.0, min_seconds=5.0, low=0.75, high=3.0):
+        self.method = method
+        self.rate = rate                # Window is resampled to this rate (Hz)
+        self.min_seconds = min_seconds  # Time-based, so a low frame rate doesn't delay the first estimate
+        self.low = low; self.high = high
+        self.bandpass = signal.butter(4, [low / (rate / 2), min(high / (rate / 2), 0.99)], btype='band')
+        self.rgb = np.zeros((capacity, len(SKIN_ROIS), 3))
+        self.times = np.zeros(capacity)
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+        self.quality = np.zeros(len(SKIN_ROIS)) # Per region, 0..1 (share of band power at the pulse)
+
+    def add(self, means_bgr, t):
+        self.rgb[self.head] = means_bgr[:, ::-1] # BGR -> RGB
+        self.times[self.head] = t
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def window(self):
+        idx = np.arange(self.head - self.size, self.head) % self.capacity
+        return self.rgb[idx], self.times[idx]
+
+    def pos(self, x):
+        """Plane-orthogonal-to-skin (Wang et al. 2017) on 1.6 s sliding windows, overlap-added; x is (rois, 3, T)"""
+        n, _, T = x.shape
+        l = min(T, int(1.6 * self.rate))
+        windows = np.lib.stride_tricks.sliding_window_view(x, l, axis=2)  # (rois, 3, T-l+1, l)
+        cn = windows / windows.mean(axis=3, keepdims=True)
+        s1 = cn[:, 1] - cn[:, 2]
+        s2 = -2 * cn[:, 0] + cn[:, 1] + cn[:, 2]
+        alpha = s1.std(axis=2, keepdims=True) / (s2.std(axis=2, keepdims=True) + 1e-9)
+        h = s1 + alpha * s2
+        h -= h.mean(axis=2, keepdims=True)
+        idx = (np.arange(T - l + 1)[:, None] + np.arange(l)).ravel()
+        return np.stack([np.bincount(idx, weights=h[i].ravel(), minlength=T) for i in range(n)])
+
+    def chrom(self, x):
+        """Chrominance method (de Haan & Jeanne 2013) over the whole window; x is (rois, 3, T)"""
+        b, a = self.bandpass
+        cn = x / x.mean(axis=2, keepdims=True)
+        xs = signal.filtfilt(b, a, 3 * cn[:, 0] - 2 * cn[:, 1], axis=1)
+        ys = signal.filtfilt(b, a, 1.5 * cn[:, 0] + cn[:, 1] - 1.5 * cn[:, 2], axis=1)
+        alpha = xs.std(axis=1, keepdims=True) / (ys.std(axis=1, keepdims=True) + 1e-9)
+        return xs - alpha * ys
+
+    def estimate(self):
+        """BPM from the current window (0 until there is enough of it)"""
+        rgb, times = self.window()
+        if self.size < 20 or times[-1] - times[0] < self.min_seconds: return 0
+        valid = ~np.isnan(rgb).any(axis=(0, 2)) & (rgb.min(axis=(0, 2)) > 0) # Regions that stayed in frame
+        if not valid.any(): return 0
+
+        # (T, rois, 3) -> (rois, 3, T) on a uniform time grid
+        series = rgb[:, valid].reshape(len(times), -1).T
+        grid = times[0] + np.arange(int((times[-1] - times[0]) * self.rate) + 1) / self.rate
+        x = np.stack([np.interp(grid, times, s) for s in series]).reshape(-1, 3, len(grid))
+
+        b, a = self.bandpass
+        pulse = self.chrom(x) if self.method == "chrom" else signal.filtfilt(b, a, self.pos(x), axis=1)
+        spectrum = np.abs(np.fft.rfft(pulse * np.hanning(len(grid)), axis=1)) ** 2
+        freqs = np.fft.rfftfreq(len(grid), d=1 / self.rate)
+
+        # Quality: power within 0.1 Hz of the peak and its harmonic, over all power in the wider band
+        band = (freqs >= self.low) & (freqs <= self.high)
+        wide = (freqs >= self.low) & (freqs <= 2 * self.high)
+        peak = freqs[band][np.argmax(spectrum[:, band], axis=1)][:, None]
+        near = (np.abs(freqs - peak) <= 0.1) | (np.abs(freqs - 2 * peak) <= 0.1)
+        quality = (spectrum * (near & wide)).sum(axis=1) / (spectrum[:, wide].sum(axis=1) + 1e-12)
+        self.quality = np.zeros(len(SKIN_ROIS))
+        self.quality[valid] = quality
+
+        # Each region's normalized in-band spectrum, weighted by quality squared (clean regions dominate)
+        normalized = spectrum[:, band] / (spectrum[:, band].sum(axis=1, keepdims=True) + 1e-12)
+        fused = (quality[:, None] ** 2 * normalized).sum(axis=0)
+        return freqs[band][np.argmax(fused)] * 60
+
+class VitalsEngine:
+    def __init__(self, capacity=150, min_samples=60, update_interval=1.0, resample_rate=10.0, rppg_method="pos"):
+        self.hr = RingBuffer(capacity)
+        self.resp = RingBuffer(capacity)
+        self.min_samples = min_samples
+        self.update_interval = update_interval # Re-estimate at ~1 Hz, not every frame
+        self.last_update = 0
+        self.raw_hr = 0
+        self.raw_rr = 0
+        self.resample_rate = resample_rate # Hz; both estimators see this rate whatever the camera delivered
+        self.filter_cache = {} # rounded sample rate -> (b, a)
+        self.smooth_kernel = np.ones(5) / 5
+        # "pos"/"chrom": multi-region rPPG; "green": the forehead green channel alone (get_bpm_fft)
+        self.pulse = RppgEstimator(capacity, rppg_method, resample_rate) if rppg_method != "green" else None
+
+    def add_hr_sample(self, value, t):
+        self.hr.append(value, t)
+
+    def add_skin_sample(self, means_bgr, t):
+        if self.pulse is not None: self.pulse.add(means_bgr, t)
+
+    def add_resp_sample(self, value, t):
+        self.resp.append(value, t)
+
+    def update(self, now):
+        """Returns (raw_hr, raw_rr), recomputing them only once per update_interval"""
+        if now - self.last_update < self.update_interval:
+            return self.raw_hr, self.raw_rr
+        self.last_update = now
         
-        try:
-            rgb_frame = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-            pil_img = Image.fromarray(rgb_frame)
-            
-            prompt = """
-            Analyze this baby monitor frame. Return JSON:
-            {"is_safe": bool, "status_text": "string (MAX 3 WORDS)", "is_crying": bool}
-            Examples: "SAFE", "ON STOMACH", "CRYING", "FACE COVERED".
-            """
-            
-            response = client.models.generate_content(
-                model='gemini-2.5-flash-lite',
-                contents=[prompt, pil_img],
-                config=types.GenerateContentConfig(response_mime_type="application/json")
-            )
-            
-            data = json.loads(response.text)
-            
-            # UPDATED LOGIC: Even "Safe" is a status now
-            if not data['is_safe']:
-                self.gemini_status = f"AI ALERT: {data['status_text'].upper()}"
-            elif data['is_crying']:
-                self.gemini_status = "AI ALERT: CRYING"
+        self.raw_hr = 0; self.raw_rr = 0
+        if self.pulse is not None: self.raw_hr = self.pulse.estimate()
+        elif len(self.hr) > self.min_samples: self.raw_hr = self.get_bpm_fft(*self.hr.tail())
+        if len(self.resp) > self.min_samples: self.raw_rr = self.get_rpm_peak_counting(*self.resp.tail())
+        return self.raw_hr, self.raw_rr
+
+    def get_bandpass(self, fps_val):
+        # Frame rate jitters a little; 0.5 Hz buckets keep the cache tiny and the filter valid
+        key = round(fps_val * 2) / 2
+        if key not in self.filter_cache:
+            nyquist = key / 2
+            low = 0.75; high = 3.0
+            if low >= nyquist:
+                self.filter_cache[key] = None
             else:
-                self.gemini_status = "AI: SAFE" 
-            
-            self.gemini_last_update = time.time()
-            print(f"🤖 AI Check: {self.gemini_status}")
-            
-        except Exception as e:
-            print(f"Gemini logic error: {e}")
-        finally:
-            self.gemini_lock = False
+                self.filter_cache[key] = signal.butter(4, [low/nyquist, min(high/nyquist, 0.99)], btype='band')
+        return self.filter_cache[key]
 
     # --- SIGNAL PROCESSING ---
     def get_bpm_fft(self, signal_data, times):
-        if len(signal_data) < 30: return 0
-        fps_val = len(times) / (times[-1] - times[0])
-        y = signal.detrend(np.array(signal_data))
-        nyquist = fps_val / 2
-        low = 0.75; high = 3.0 
-        if low >= nyquist: return 0
-        b, a = signal.butter(4, [low/nyquist, min(high/nyquist, 0.99)], btype='band')
+        if len(signal_data) < 30 or times[-1] <= times[0]: return 0
+        signal_data, times = resample_uniform(signal_data, times, self.resample_rate)
+        fps_val = self.resample_rate
+        coeffs = self.get_bandpass(fps_val)
+        if coeffs is None: return 0
+        b, a = coeffs
+        y = signal.detrend(signal_data)
         filtered = signal.filtfilt(b, a, y)
         fft_mag = np.abs(np.fft.rfft(filtered))
         peak_idx = np.argmax(fft_mag)
@@ -220,12 +524,11 @@ class NannyCamServer:
         return freqs[peak_idx] * 60
 
     def get_rpm_peak_counting(self, wave_data, times):
-        if len(wave_data) < 30: return 0
-        y = np.array(wave_data)
-        y = signal.detrend(y)
-        kernel = np.ones(5)/5 
-        y_smooth = np.convolve(y, kernel, mode='same')
-        range_val = np.max(y_smooth) - np.min(y_smooth)
+        if len(wave_data) < 30 or times[-1] <= times[0]: return 0
+        wave_data, times = resample_uniform(wave_data, times, self.resample_rate) # distance=15 below means 1.5 s
+        y = signal.detrend(wave_data)
+        y_smooth = np.convolve(y, self.smooth_kernel, mode='same')
+        range_val = np.ptp(y_smooth)
         if range_val < 1e-5: return 0
         y_norm = (y_smooth - np.min(y_smooth)) / range_val
         peaks, _ = signal.find_peaks(y_norm, distance=15, prominence=0.05)
@@ -235,170 +538,583 @@ class NannyCamServer:
             return min(rpm, 80)
         return 0
 
-    async def run(self):
-        cap = cv2.VideoCapture(0)
-        print(f"\n✅ SERVER STARTED!\n📡 Connect App to: ws://{get_local_ip()}:8765\n")
+class RespirationTracker:
+    """Chest motion along the body axis -> one respiration sample per frame.
+    "points": sparse LK flow on corners of the chest ROI; "dense": Farneback flow on a downscaled ROI.
+    Both take the median motion, so one slipping point or a corner of blanket can't make the RR signal jump."""
+    def __init__(self, mode="points", max_points=20, min_points=5, outlier_mad=3.0, min_spread=0.5,
+                 thrash_threshold=2.0, dense_width=64, margin=20, min_texture=6.0):
+        self.mode = mode
+        self.max_points = max_points
+        self.min_points = min_points
+        self.outlier_mad = outlier_mad           # Points further than this many MADs from the median are dropped
+        self.min_spread = min_spread             # ... but never closer than this (px): sub-pixel noise is not an outlier
+        self.thrash_threshold = thrash_threshold # Median motion (px/frame) that counts as thrashing
+        self.dense_width = dense_width
+        self.margin = margin                     # Search margin (px) around the chest box for LK
+        self.min_texture = min_texture           # Dense: grey-level std of the chest ROI below which nobody is there
+        self.lk_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.points = None                       # (N, 2) float32, frame coordinates
+        self.prev_gray = None                    # cvtColor gives a fresh array every frame, so no copy is needed
+        self.chest = None                        # Dense: last chest box and its texture while the face was seen
+        self.texture = 0.0
+
+    def tracking(self, gray):
+        """Is there still a body where the chest was? (asked once the face is gone)"""
+        if self.mode == "points": return self.points is not None and len(self.points) > self.min_points
+        # Dense flow has no points to lose: look for the chest's texture at its last position instead
+        # (an empty crib or plain sheet is flat, so a picked-up baby doesn't read as rolled over)
+        if self.prev_gray is None or self.chest is None: return False
+        return float(np.std(self.small_roi(gray, self.chest)[0])) >= max(self.min_texture, 0.5 * self.texture)
+
+    def small_roi(self, gray, chest):
+        """Chest crop downscaled to dense_width (area averaging also removes sensor noise), and the scale"""
+        left, top, right, bottom = chest
+        scale = min(1.0, self.dense_width / (right - left))
+        size = (max(8, int((right - left) * scale)), max(8, int((bottom - top) * scale)))
+        return cv2.resize(gray[top:bottom, left:right], size, interpolation=cv2.INTER_AREA), scale
+
+    def lost(self):
+        return self.prev_gray is None
+
+    def reset(self):
+        self.points = None
+        self.prev_gray = None
+        self.chest = None
+
+    def detect(self, gray, chest, limit):
+        # Corners of the chest crop only (no full-frame mask)
+        left, top, right, bottom = chest
+        found = cv2.goodFeaturesToTrack(gray[top:bottom, left:right], maxCorners=limit, qualityLevel=0.01, minDistance=10, blockSize=7)
+        if found is None: return np.zeros((0, 2), dtype=np.float32)
+        return found.reshape(-1, 2) + np.array([left, top], dtype=np.float32)
+
+    def update(self, gray, chest, body_axis):
+        """Returns (displacement along the body axis or None, thrashing, points to draw)"""
+        left, top, right, bottom = chest
+        if right <= left or bottom <= top:
+            self.reset()
+            return None, False, ()
+        if self.prev_gray is None:
+            self.prev_gray = gray
+            if self.mode == "points": self.points = self.detect(gray, chest, self.max_points)
+            return None, False, ()
+        if self.mode == "dense": return self.update_dense(gray, chest, body_axis)
+        return self.update_points(gray, chest, body_axis)
+
+    def update_points(self, gray, chest, body_axis):
+        left, top, right, bottom = chest
+        if len(self.points) < self.min_points:
+            extra = self.detect(self.prev_gray, chest, self.max_points - len(self.points))
+            self.points = np.concatenate((self.points, extra))
+        if len(self.points) == 0:
+            self.reset()
+            return None, False, ()
+
+        # LK on the chest area only (plus a margin for the points to move into)
+        H, W = gray.shape[:2]
+        x0 = max(0, left - self.margin); y0 = max(0, top - self.margin)
+        x1 = min(W, right + self.margin); y1 = min(H, bottom + self.margin)
+        origin = np.array([x0, y0], dtype=np.float32)
+        old = np.ascontiguousarray(self.points - origin).reshape(-1, 1, 2)
+        new, st, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray[y0:y1, x0:x1], gray[y0:y1, x0:x1], old, None, **self.lk_params)
+        if new is None:
+            self.reset()
+            return None, False, ()
+        new = new.reshape(-1, 2) + origin
+        old = self.points
+
+        keep = (st.ravel() == 1) & (new[:, 0] >= left) & (new[:, 0] <= right) & (new[:, 1] >= top) & (new[:, 1] <= bottom)
+        new, old = new[keep], old[keep]
+        if len(new) == 0:
+            self.reset()
+            return None, False, ()
+
+        motion = new - old
+        along = motion[:, body_axis]
+        median = np.median(along)
+        spread = max(self.outlier_mad * 1.4826 * np.median(np.abs(along - median)), self.min_spread)
+        inliers = np.abs(along - median) <= spread
+        thrashing = np.median(np.hypot(motion[:, 0], motion[:, 1])) > self.thrash_threshold
+
+        self.points = new[inliers] # Slipped points are dropped and replaced by fresh corners later
+        self.prev_gray = gray
+        return float(np.mean(along[inliers])), thrashing, self.points
+
+    def update_dense(self, gray, chest, body_axis):
+        prev, scale = self.small_roi(self.prev_gray, chest)
+        cur, _ = self.small_roi(gray, chest)
+        flow = cv2.calcOpticalFlowFarneback(prev, cur, None, 0.5, 2, 9, 2, 5, 1.1, 0) / scale
+        self.prev_gray = gray
+        self.chest = chest
+        self.texture = float(np.std(cur))
+        along = float(np.median(flow[..., body_axis]))
+        thrashing = np.median(np.hypot(flow[..., 0], flow[..., 1])) > self.thrash_threshold
+        return along, thrashing, ()
+
+class FaceTracker:
+    """Runs the full robust search every N frames (or once the track is lost) and a cheap ROI search in between"""
+    def __init__(self, detector, face_cascade, profile_cascade, redetect_every=15, margin=0.5):
+        self.detector = detector # gray -> (faces, orientation)
+        self.face_cascade = face_cascade
+        self.profile_cascade = profile_cascade
+        self.redetect_every = redetect_every
+        self.margin = margin
+        self.box = None
+        self.orientation = "none"
+        self.frames_since_full = 0
+
+    def update(self, gray):
+        if self.box is not None and self.frames_since_full < self.redetect_every:
+            box = self._local_search(gray)
+            if box is not None:
+                self.box = box
+                self.frames_since_full += 1
+                return [box], self.orientation
         
+        # Scheduled refresh or track lost -> full search (boxes come back in frame coordinates)
+        faces, orientation = self.detector(gray)
+        self.frames_since_full = 0
+        self.orientation = orientation
+        if len(faces) > 0:
+            self.box = tuple(int(v) for v in max(faces, key=lambda f: f[2] * f[3]))
+        else:
+            self.box = None
+        return faces, orientation
+
+    def _local_search(self, gray):
+        x, y, w, h = self.box
+        H, W = gray.shape[:2]
+        mx = int(w * self.margin); my = int(h * self.margin)
+        x0 = max(0, x - mx); y0 = max(0, y - my)
+        x1 = min(W, x + w + mx); y1 = min(H, y + h + my)
+        roi = gray[y0:y1, x0:x1]
+        if roi.size == 0: return None
+        oriented = orient_image(roi, self.orientation)
+        
+        # The face can only have changed size a little since the last frame
+        side = min(w, h)
+        min_size = (int(side * 0.6), int(side * 0.6)); max_size = (int(side * 1.6), int(side * 1.6))
+        for cascade in (self.face_cascade, self.profile_cascade):
+            faces = cascade.detectMultiScale(oriented, 1.1, 4, minSize=min_size, maxSize=max_size)
+            if len(faces) > 0:
+                fx, fy, fw, fh = remap_box(max(faces, key=lambda f: f[2] * f[3]), self.orientation, x1 - x0, y1 - y0)
+                return (fx + x0, fy + y0, fw, fh)
+        return None
+
+def scene_hash(frame_bgr):
+    """64-bit difference hash: nearly identical scenes differ in only a few bits"""
+    gray = cv2.cvtColor(cv2.resize(frame_bgr, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hash_distance(a, b):
+    return bin(a ^ b).count("1")
+
+class GeminiScheduler:
+    """Single async AI worker: skips unchanged scenes, reuses cached verdicts and calls early on local alarms"""
+    PROMPT = """
+            Analyze this baby monitor frame. Return JSON:
+            {"is_safe": bool, "status_text": "string (MAX 3 WORDS)", "is_crying": bool}
+            Examples: "SAFE", "ON STOMACH", "CRYING", "FACE COVERED".
+            """
+
+    def __init__(self, ai_client=None, interval=10.0, min_gap=2.0, cache_ttl=60.0, max_hash_distance=6, upload_size=512, settle_frames=3,
+                 metrics=NULL_METRICS):
+        self.client = ai_client
+        self.metrics = metrics
+        self.interval = interval                   # Regular check period
+        self.min_gap = min_gap                     # Even early calls are at least this far apart (rate limits)
+        self.cache_ttl = cache_ttl                 # How long an unchanged scene may reuse the last verdict
+        self.max_hash_distance = max_hash_distance # dHash bits that may differ for "the same scene"
+        self.upload_size = upload_size             # Longest side of the uploaded JPEG
+        self.settle_frames = settle_frames         # Frames new signals must hold before they count as a change
+        self.queue = asyncio.Queue(maxsize=1)
+        self.status = None
+        self.last_update = 0 # Timestamp of last AI verdict (fresh or reused)
+        self.last_request = 0
+        self.last_signals = None   # Settled signals
+        self.new_signals = None    # Candidate that differs from them, and for how many frames in a row
+        self.new_count = 0
+        self.pending_change = False # Latched until a request actually goes out
+        self.cached_hash = None
+        self.cached_time = 0
+        self.calls_made = 0
+        self.calls_skipped = 0
+
+    def consider(self, frame_bgr, signals, now):
+        """Called once per analyzed frame on the event loop; decides whether the AI needs to look"""
+        if self.client is None: return
+        self.settle(signals)
+        signals_changed = self.pending_change
+        
+        since = now - self.last_request
+        if since < self.min_gap: return
+        if since < self.interval and not signals_changed: return
+        self.last_request = now
+        self.pending_change = False
+        
+        h = scene_hash(frame_bgr)
+        if (not signals_changed and self.status is not None and self.cached_hash is not None
+                and now - self.cached_time < self.cache_ttl and hash_distance(h, self.cached_hash) <= self.max_hash_distance):
+            self.last_update = now # Same scene, same verdict
+            self.calls_skipped += 1
+            return
+        # The frame may be a frame-bus view that gets overwritten before the worker reads it
+        put_latest(self.queue, (frame_bgr.copy(), h, now))
+
+    def settle(self, signals):
+        # Debounce: a flickering status must not bypass the cache every min_gap
+        if self.last_signals is None or signals == self.last_signals:
+            self.last_signals = signals
+            self.new_signals, self.new_count = None, 0
+            return
+        if signals != self.new_signals: self.new_signals, self.new_count = signals, 0
+        self.new_count += 1
+        if self.new_count >= self.settle_frames:
+            self.last_signals = signals
+            self.new_signals, self.new_count = None, 0
+            self.pending_change = True
+
+    def prepare_upload(self, frame_bgr):
+        h, w = frame_bgr.shape[:2]
+        scale = self.upload_size / max(h, w)
+        if scale < 1.0:
+            frame_bgr = cv2.resize(frame_bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', frame_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+        return buffer.tobytes()
+
+    async def worker(self, encode_pool):
+        if self.client is None: return
         while True:
-            await asyncio.sleep(0.1) # Limit to ~10 FPS
-            ret, frame = cap.read()
-            if not ret: break
-            
-            clean_frame = frame.copy()
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            h, w, _ = frame.shape
-            
-            # --- FACE DETECTION (Robust) ---
-            all_faces, orientation = self.detect_faces_robust(gray)
-            
-            faces = []
-            if len(all_faces) > 0:
-                faces = all_faces if orientation == "upright" else []
-            
-            # --- AI CHECK (Every 5s) ---
-            if time.time() - self.last_gemini_check > 10.0:
-                threading.Thread(target=self.check_with_gemini, args=(clean_frame,)).start()
-                self.last_gemini_check = time.time()
-
-            # --- ROLL LOGIC ---
-            if len(all_faces) > 0:
-                self.last_face_time = time.time()
-                self.is_rolled_over = False
+            await self.check(*(await self.queue.get()), encode_pool)
+
+    async def check(self, frame_bgr, h, frame_time, encode_pool):
+        """One AI round trip; times are on the frame clock so replays see the same verdict ages"""
+        loop = asyncio.get_running_loop()
+        try:
+            jpeg = await loop.run_in_executor(encode_pool, self.prepare_upload, frame_bgr)
+            self.calls_made += 1
+            with self.metrics.timer("gemini"):
+                response = await self.client.aio.models.generate_content(
+                    model='gemini-2.5-flash-lite',
+                    contents=[self.PROMPT, types.Part.from_bytes(data=jpeg, mime_type='image/jpeg')],
+                    config=types.GenerateContentConfig(response_mime_type="application/json")
+                )
             
-            time_since_face = time.time() - self.last_face_time
-            if time_since_face > 3.0 and self.p0_chest is not None and len(self.p0_chest) > 5:
-                self.is_rolled_over = True
+            data = json.loads(response.text)
             
-            raw_hr = 0; raw_rr = 0
-            status = "SEARCHING..."
-            if self.is_rolled_over: status = "ALERT: ROLLED OVER"
+            # UPDATED LOGIC: Even "Safe" is a status now
+            if not data['is_safe']:
+                self.status = f"AI ALERT: {data['status_text'].upper()}"
+            elif data['is_crying']:
+                self.status = "AI ALERT: CRYING"
+            else:
+                self.status = "AI: SAFE" 
             
-            chest_detected = False; thrashing_detected = False
+            self.last_update = frame_time
+            self.cached_hash = h
+            self.cached_time = frame_time
+            print(f"🤖 AI Check: {self.status}")
             
-            if len(faces) > 0:
-                status = "SAFE"
-                (x, y, w_f, h_f) = max(faces, key=lambda f: f[2] * f[3])
-                
-                fh_x = x + int(w_f * 0.5) - 20; fh_y = y + int(h_f * 0.15)
-                roi = frame[fh_y:fh_y+30, fh_x:fh_x+40]
-                cv2.rectangle(frame, (fh_x, fh_y), (fh_x+40, fh_y+30), (0, 255, 0), 2)
-                if roi.size > 0:
-                    self.hr_buffer.append(np.mean(roi[:, :, 1]))
-                    self.hr_times.append(time.time())
-
-                chest_top = y + h_f; chest_bottom = min(h, chest_top + 150)
-                chest_left = x + int(w_f * 0.2); chest_right = x + int(w_f * 0.8)
-                
-                if self.p0_chest is None:
-                    mask = np.zeros_like(gray)
-                    cv2.rectangle(mask, (chest_left, chest_top), (chest_right, chest_bottom), 255, -1)
-                    self.p0_chest = cv2.goodFeaturesToTrack(gray, mask=mask, maxCorners=20, qualityLevel=0.01, minDistance=10, blockSize=7)
-                    self.old_gray = gray.copy()
-                    self.resp_buffer = [] 
-                elif len(self.p0_chest) < 5:
-                    mask = np.zeros_like(gray)
-                    cv2.rectangle(mask, (chest_left, chest_top), (chest_right, chest_bottom), 255, -1)
-                    new_pts = cv2.goodFeaturesToTrack(gray, mask=mask, maxCorners=20 - len(self.p0_chest), qualityLevel=0.01, minDistance=10, blockSize=7)
-                    if new_pts is not None: self.p0_chest = np.concatenate((self.p0_chest, new_pts), axis=0)
-
-                if self.p0_chest is not None:
-                    chest_detected = True
-                    p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, gray, self.p0_chest, None, **self.lk_params)
-                    if p1 is not None:
-                        good_new = []; good_old = []; movements = []
-                        for i, (new_pt, old_pt) in enumerate(zip(p1[st==1], self.p0_chest[st==1])):
-                             a, b = new_pt.ravel(); c, d = old_pt.ravel()
-                             if chest_left <= a <= chest_right and chest_top <= b <= chest_bottom:
-                                 good_new.append(new_pt); good_old.append(old_pt)
-                                 movements.append(np.sqrt((a-c)**2 + (b-d)**2))
-                        
-                        good_new = np.array(good_new).reshape(-1, 1, 2)
-                        good_old = np.array(good_old).reshape(-1, 1, 2)
-
-                        if len(good_new) > 0:
-                            dy = np.mean(good_new[:, 0, 1] - good_old[:, 0, 1])
-                            val = self.resp_buffer[-1] if self.resp_buffer else 0
-                            self.resp_buffer.append(val + dy)
-                            
-                            if np.mean(movements) > 2.0: thrashing_detected = True
-                            
-                            color = (0, 0, 255) if thrashing_detected else (0, 255, 255)
-                            for pt in good_new: cv2.circle(frame, (int(pt.ravel()[0]), int(pt.ravel()[1])), 3, color, -1)
-
-                            self.p0_chest = good_new
-                            self.old_gray = gray.copy()
-                        else: self.p0_chest = None
-                    else: self.p0_chest = None
-            
-            if len(self.hr_buffer) > 150: self.hr_buffer.pop(0); self.hr_times.pop(0)
-            if len(self.resp_buffer) > 150: self.resp_buffer.pop(0)
+        except Exception as e:
+            print(f"Gemini logic error: {e}")
+
+class NannyCamServer:
+    def __init__(self, face_tracking=True, detection_mode="sequential", detection_scale=0.5, headless=False, idle_fps=5.0,
+                 video_source=0, audio_source=None, ai_client=None, realtime=True, metrics=False, metrics_port=None,
+                 stream_id=0, analysis_pool=None, encode_pool=None, recording=False, recordings_dir=RECORDINGS_DIR,
+                 history=False, history_dir=HISTORY_DIR, respiration_mode=RESPIRATION_MODE):
+        self.metrics = make_metrics("babycam", metrics)
+        self.metrics_port = metrics_port
+        # Per-thread classifiers shared with every other pipeline in the process (see pipeline.SharedCascade)
+        self.face_cascade = shared_cascade(CASCADE_FILES["frontal"])
+        self.profile_cascade = shared_cascade(CASCADE_FILES["profile"])
+        self.cascades = {"frontal": self.face_cascade, "profile": self.profile_cascade}
+        self.detection_scale = detection_scale
+        self.detect_pool = None
+        detector = self.detect_faces_robust
+        if detection_mode == "parallel":
+            self.detect_pool = ThreadPoolExecutor(max_workers=len(DETECTION_PASSES) - 1, thread_name_prefix="detect")
+            detector = self.detect_faces_parallel
+        self.detect_faces = detector
+        
+        self.face_tracker = None
+        if face_tracking:
+            self.face_tracker = FaceTracker(detector, self.face_cascade, self.profile_cascade, redetect_every=REDETECT_EVERY)
+        self.hr_stabilizer = Stabilizer(decay=0.96, threshold=2.0)
+        self.rr_stabilizer = Stabilizer(decay=0.85, threshold=1.0) 
+        
+        self.vitals = VitalsEngine(capacity=150, min_samples=60, update_interval=1.0, rppg_method=RPPG_METHOD)
+        
+        self.respiration = RespirationTracker(mode=respiration_mode)
+        
+        self.bad_tracking_frames = 0
+        self.connected_clients = set()
+        self.publisher = VideoPublisher(stream_id=stream_id, meta_type="vitals")
+        
+        # realtime=False: no audio threads; a replay writes the ring and calls cry_detector.update() itself
+        print("🎙️ Initializing Audio...")
+        self.video_source = video_source
+        self.audio_monitor = AudioMonitor(source=open_audio_source(audio_source), autostart=realtime)
+        self.cry_detector = CryDetector(self.audio_monitor.ring, loud_threshold=25.0, autostart=realtime, metrics=self.metrics)
+
+        self.last_face_time = time.time()
+        self.is_rolled_over = False
+        
+        # GEMINI STATE
+        if ai_client is None and GEMINI_AVAILABLE: ai_client = client
+        self.gemini = GeminiScheduler(ai_client, interval=10.0, metrics=self.metrics)
+
+        # PIPELINE STATE (capture thread -> analysis executor -> encode executor)
+        self.running = True
+        self.show_preview = not headless
+        self.draw_overlay = self.show_preview # Off while the scheduler sheds the preview
+        self.active_fps = ACTIVE_FPS
+        self.scheduler = FrameScheduler(self.active_fps)
+        self.idle_fps = idle_fps
+        self.analysis_pool = analysis_pool or make_stage_pool("analysis")
+        self.encode_pool = encode_pool or make_stage_pool("encode")
+        self.pipeline = StagedLoop(self, "NannyCam Server", record_tier=DEFAULT_TIER)
+        self.metrics.add_collector(self.collect_metrics)
+
+        # EVENT RECORDING (pre-roll of medium-tier JPEGs + PCM, flushed to disk on ALERT)
+        self.recorder = None
+        if recording:
+            self.recorder = EventRecorder(recordings_dir, stream_id=stream_id, pre_roll=PRE_ROLL, post_roll=POST_ROLL)
+
+        # VITALS HISTORY (written by the analysis stage, queried off the event loop)
+        self.history = VitalsStore(os.path.join(history_dir, str(stream_id))) if history else None
+
+    def collect_metrics(self):
+        stats = {"ai_calls_made": self.gemini.calls_made,
+                 "ai_calls_skipped": self.gemini.calls_skipped, "cry_confidence": round(self.cry_detector.confidence, 3)}
+        stats.update(self.pipeline.stats())
+        stats.update(self.publisher.stats())
+        stats.update(self.scheduler.stats())
+        if self.vitals.pulse is not None: stats["pulse_quality"] = round(float(self.vitals.pulse.quality.max()), 3)
+        return stats
+
+    def detect_pass(self, gray, cascade, orientation, scale=1.0):
+        img = orient_image(gray, orientation)
+        if scale != 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        faces = cascade.detectMultiScale(img, 1.3, 5)
+        H, W = gray.shape[:2]
+        return [remap_box([v / scale for v in f], orientation, W, H) for f in faces]
+
+    def detect_faces_robust(self, gray):
+        # Upright frontal -> upright profile -> flipped profile -> 90/270/180 rotations (sideways sleeping)
+        for cascade_name, orientation in DETECTION_PASSES:
+            faces = self.detect_pass(gray, self.cascades[cascade_name], orientation)
+            if len(faces) > 0: return faces, orientation
 
-            if len(self.hr_buffer) > 60: raw_hr = self.get_bpm_fft(self.hr_buffer, self.hr_times)
-            if len(self.resp_buffer) > 60: raw_rr = self.get_rpm_peak_counting(self.resp_buffer, self.hr_times[-len(self.resp_buffer):])
+        return [], "none"
+
+    def detect_faces_parallel(self, gray):
+        # Common case first: a downscaled upright frontal pass on this thread
+        faces = self.detect_pass(gray, self.cascades[DETECTION_PASSES[0][0]], DETECTION_PASSES[0][1], self.detection_scale)
+        if len(faces) > 0: return faces, DETECTION_PASSES[0][1]
+        
+        # Otherwise every other orientation at once: worst case is two passes, not six
+        futures = [self.detect_pool.submit(self.detect_pass, gray, self.cascades[name], orientation, self.detection_scale)
+                   for name, orientation in DETECTION_PASSES[1:]]
+        results = [f.result() for f in futures]
+        for (_, orientation), faces in zip(DETECTION_PASSES[1:], results):
+            if len(faces) > 0: return faces, orientation
+
+        return [], "none"
+
+    async def register_client(self, websocket):
+        self.connected_clients.add(websocket)
+        self.publisher.add(websocket)
+        try:
+            async for message in websocket:
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    continue
+                if not isinstance(data, dict): continue # Commands are JSON objects
                 
-            stable_hr = self.hr_stabilizer.update(raw_hr)
-            stable_rr = self.rr_stabilizer.update(raw_rr)
+                # Opt-in to binary video; clients that never say hello stay on the legacy JSON format
+                if data.get("command") == "hello":
+                    await websocket.send(json.dumps(self.publisher.negotiate(websocket, data)))
+                elif data.get("command") == "metrics":
+                    await websocket.send(json.dumps({"type": "metrics", "stream_id": self.publisher.stream_id, **self.metrics.snapshot()}))
+                elif data.get("command") == "history" and self.history is not None:
+                    await websocket.send(json.dumps(await self.query_history(data)))
+                elif self.recorder is not None:
+                    await self.recorder.handle_command(websocket, data, asyncio.get_running_loop())
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.connected_clients.remove(websocket)
+            self.publisher.remove(websocket)
 
-            # --- FINAL STATUS LOGIC (Priority Order: 1. Crying, 2. Rolled, 3. Breath, 4. Gemini) ---
-            
-            # Priority 4: Gemini AI (Lowest priority of the intelligent/alert statuses)
-            if self.gemini_status and (time.time() - self.gemini_last_update < 6.0):
-                status = self.gemini_status
-
-            # Priority 3: Breathing Alerts
-            if stable_rr > 40: 
-                status = "ALERT: FAST BREATH"
-            elif stable_rr < 5 and stable_rr > 0: 
-                status = "ALERT: LOW BREATH"
-            
-            # Priority 2: Rolled Over
-            if self.is_rolled_over: 
-                status = "ALERT: ROLLED OVER"
-            
-            # Priority 1: Crying / Loud Noise (Highest Priority)
-            audio_alert = self.audio_monitor.is_loud
-            if audio_alert:
-                if thrashing_detected: 
-                    status = "ALERT: CRYING DETECTED"
-                else: 
-                    status = "ALERT: LOUD NOISE"
-            
-            # Payload
-            small_frame = cv2.resize(clean_frame, (400, 300))
-            
-            # Payload
-            small_frame = cv2.resize(clean_frame, (400, 300))
-            _, buffer = cv2.imencode('.jpg', small_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-            b64_video = base64.b64encode(buffer).decode('utf-8')
+    async def query_history(self, data):
+        # {"command": "history", "series": "vitals"|"samples"|"events", "start": epoch s, "end": epoch s,
+        #  "resolution": "auto"|"raw"|"1s"|"1m"|"10m", "max_points": 1000}
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self.history.query, data.get("series", "vitals"), data.get("start"),
+                                              data.get("end"), data.get("resolution", "auto"), data.get("max_points", 1000))
+        except (ValueError, TypeError) as e:
+            return {"type": "history", "error": str(e)}
 
-            hr_graph = [float(val) for val in self.hr_buffer[-60:]]
-            rr_graph = [float(val) for val in self.resp_buffer[-60:]]
-            
-            payload = {
-                "type": "video",
-                "bpm": int(stable_hr), "rpm": int(stable_rr), "status": status,
-                "video": b64_video, "hr_wave": hr_graph, "rr_wave": rr_graph
-            }
+    # --- ANALYSIS STAGE (runs on the analysis executor, never on the event loop) ---
+    def analyze_frame(self, frame, frame_time):
+        # Grabbers hand out frames nobody else writes to (BusGrabber copies its ring slot), so frame stays clean; overlays go on a copy
+        clean_frame = frame
+        overlay = frame.copy() if self.draw_overlay else None
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        h, w, _ = frame.shape
+        
+        # --- FACE DETECTION (Robust) ---
+        with self.metrics.timer("detect"):
+            if self.face_tracker is not None:
+                faces, orientation = self.face_tracker.update(gray)
+            else:
+                faces, orientation = self.detect_faces(gray)
+        
+        # --- ROLL LOGIC ---
+        if len(faces) > 0:
+            self.last_face_time = frame_time
+            self.is_rolled_over = False
+        
+        time_since_face = frame_time - self.last_face_time
+        if time_since_face > 3.0 and self.respiration.tracking(gray):
+            self.is_rolled_over = True
+        
+        status = "SEARCHING..."
+        if self.is_rolled_over: status = "ALERT: ROLLED OVER"
+        
+        thrashing_detected = False
+        hr_sample = None; resp_sample = None
+        
+        if len(faces) > 0:
+            status = "SAFE"
+            face = max(faces, key=lambda f: f[2] * f[3])
             
-            await self.broadcast_data(payload)
-            cv2.imshow("NannyCam Server", frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'): break
+            # Forehead + cheeks in one pass; the forehead's green channel still feeds the graph
+            boxes = skin_boxes(face, orientation, w, h)
+            means = roi_means(frame, boxes)
+            self.vitals.add_skin_sample(means, frame_time)
+            if not np.isnan(means[0, 1]):
+                hr_sample = means[0, 1]
+                self.vitals.add_hr_sample(hr_sample, frame_time)
+            if overlay is not None:
+                for x0, y0, x1, y1 in boxes: cv2.rectangle(overlay, (int(x0), int(y0)), (int(x1), int(y1)), (0, 255, 0), 2)
+
+            # Breathing moves the chest along the body axis (vertical unless the baby lies sideways)
+            chest = chest_box(face, orientation, w, h)
+            body_axis = 0 if orientation in ("90", "270") else 1
+            if self.respiration.lost(): self.vitals.resp.clear() # New baseline for the breathing wave
+            with self.metrics.timer("flow"):
+                dy, thrashing_detected, points = self.respiration.update(gray, chest, body_axis)
+            if dy is not None:
+                resp_sample = self.vitals.resp.last() + dy
+                self.vitals.add_resp_sample(resp_sample, frame_time)
+            if overlay is not None:
+                color = (0, 0, 255) if thrashing_detected else (0, 255, 255)
+                for px, py in points: cv2.circle(overlay, (int(px), int(py)), 3, color, -1)
+        
+        with self.metrics.timer("vitals"):
+            raw_hr, raw_rr = self.vitals.update(frame_time)
             
-        cap.release()
-        cv2.destroyAllWindows()
-        self.audio_monitor.stop()
+        stable_hr = self.hr_stabilizer.update(raw_hr)
+        stable_rr = self.rr_stabilizer.update(raw_rr)
+
+        # --- FINAL STATUS LOGIC (Priority Order: 1. Crying, 2. Rolled, 3. Breath, 4. Gemini) ---
+        
+        # Priority 4: Gemini AI (Lowest priority of the intelligent/alert statuses)
+        if self.gemini.status and (frame_time - self.gemini.last_update < 6.0):
+            status = self.gemini.status
+
+        # Priority 3: Breathing Alerts
+        if stable_rr > 40: 
+            status = "ALERT: FAST BREATH"
+        elif stable_rr < 5 and stable_rr > 0: 
+            status = "ALERT: LOW BREATH"
+        
+        # Priority 2: Rolled Over
+        if self.is_rolled_over: 
+            status = "ALERT: ROLLED OVER"
+        
+        # Priority 1: Crying (Highest Priority)
+        # Thrashing backs up a weaker audio verdict. A loud but non-cry sound (door, TV) is only shown
+        # when nothing else is going on: it is not an alert, so it neither records nor calls the AI early
+        cry_confidence = self.cry_detector.confidence
+        if cry_confidence > 0.6 or (thrashing_detected and cry_confidence > 0.3):
+            status = "ALERT: CRYING DETECTED"
+        elif self.cry_detector.is_loud and "ALERT" not in status:
+            status = "LOUD NOISE"
+
+        if self.history is not None:
+            with self.metrics.timer("history"):
+                self.history.record(frame_time, hr_sample, resp_sample, stable_hr, stable_rr, raw_hr, raw_rr, cry_confidence, status)
+        
+        # Snapshot everything the encode stage needs so it never touches live state
+        return {
+            "preview": overlay, "clean": clean_frame, "time": frame_time,
+            "bpm": int(stable_hr), "rpm": int(stable_rr), "status": status,
+            "cry_confidence": round(float(cry_confidence), 2),
+            "signals": {"face": len(faces) > 0, "thrashing": thrashing_detected,
+                        "crying": cry_confidence > 0.6},
+            # Graph windows as arrays; the publisher sends each client only what it has not seen yet
+            "waves": {"hr": (self.vitals.hr.total, self.vitals.hr.tail(60)[0]),
+                      "rr": (self.vitals.resp.total, self.vitals.resp.tail(60)[0])}
+        }
+
+    # --- ENCODE STAGE (runs on the encode executor) ---
+    def encode_frame(self, result, tiers):
+        return encode_tiers(result["clean"], tiers)
+
+    def frame_meta(self, result):
+        # Legacy payload minus "video" and the graphs (the publisher adds them in the client's format)
+        return {
+            "type": "video",
+            "bpm": result["bpm"], "rpm": result["rpm"], "status": result["status"],
+            "cry_confidence": result["cry_confidence"]
+        }
+
+    # --- PIPELINE HOOKS (the loop itself is pipeline.StagedLoop) ---
+    def shed_work(self, scheduler):
+        # Shed work under load: preview overlay first, then full face searches (vitals come last)
+        self.draw_overlay = self.show_preview and not scheduler.shed("preview")
+        if self.face_tracker is not None:
+            self.face_tracker.redetect_every = REDETECT_EVERY * 3 if scheduler.shed("detection") else REDETECT_EVERY
+
+    def after_analysis(self, result):
+        # --- AI CHECK (every 10s, earlier when local signals change, skipped for an unchanged scene) ---
+        self.gemini.consider(result["clean"], result["signals"], result["time"])
+
+    async def run(self):
+        print(f"\n✅ SERVER STARTED!\n📡 Connect App to: ws://{get_local_ip()}:8766\n")
+        ai_worker = asyncio.create_task(self.gemini.worker(self.encode_pool))
+        try:
+            await self.pipeline.run()
+        finally:
+            ai_worker.cancel()
+            if self.detect_pool is not None: self.detect_pool.shutdown(wait=False)
+            self.audio_monitor.stop()
+            self.cry_detector.stop()
+            if self.history is not None: self.history.close()
 
     async def broadcast_audio(self):
         print("🎙️ Audio Stream Started")
-        while True:
+        while self.running:
             await asyncio.sleep(0.05)
-            chunk = self.audio_monitor.get_audio_chunk()
-            if chunk:
-                payload = {"type": "audio", "audio": chunk}
-                await self.broadcast_data(payload)
+            # No listeners -> nothing gets encoded but the recorder's PCM (the cry detector reads the ring on its own)
+            parts = self.audio_monitor.get_audio_chunk()
+            if parts and self.connected_clients:
+                self.publisher.publish_audio(parts, time.time())
+            if parts and self.recorder is not None:
+                self.recorder.add_audio(encode_audio(parts, "pcm16"), time.time())
 
 async def main():
-    server = NannyCamServer()
+    server = NannyCamServer(detection_mode=DETECTION_MODE, detection_scale=DETECTION_SCALE, headless=HEADLESS, idle_fps=IDLE_FPS,
+                            video_source=VIDEO_SOURCE, audio_source=AUDIO_SOURCE, metrics=METRICS, metrics_port=METRICS_PORT,
+                            recording=RECORDING, history=HISTORY)
     print("🚀 Starting NannyCam...")
     async with websockets.serve(server.register_client, "0.0.0.0", 8766):
         await asyncio.gather(
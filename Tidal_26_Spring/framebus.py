@@ -0,0 +1,233 @@
+import sys
+import time
+import signal
+import argparse
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from sources import open_video_source
+
+# --- SHARED-MEMORY FRAME BUS ---
+# One capture service writes camera frames into a ring of slots in shared memory; any number of
+# analyzers (baby vitals, room security, recorder...) attach by name and read the newest frame as a
+# NumPy view, without copying it. The writer never waits: a slow reader simply skips ahead to the
+# newest frame, and can ask afterwards whether the slot it used was overwritten in the meantime.
+# Pipelines keep frames far longer than one lap of the ring (encode, recorder pre-roll), so BusGrabber
+# copies each frame once at hand-off and re-reads if the slot was overwritten during the copy.
+# Every write stamps a heartbeat; the hub restarts a capture service whose heartbeat stops (hung camera
+# driver), and readers re-attach by name to the segment the restarted service creates.
+#
+# Layout: header (int64 x HEADER_WORDS) | slot sequence numbers (int64 x slots) |
+#         slot timestamps (float64 x slots) | frames (uint8 x slots x H x W x C)
+MAGIC = 0x4D414D41 # "MAMA"
+HEADER_WORDS = 8
+H_MAGIC, H_HEIGHT, H_WIDTH, H_CHANNELS, H_SLOTS, H_SEQ, H_CLOSED, H_HEARTBEAT_MS = range(HEADER_WORDS)
+WRITING = -1
+REATTACH_EVERY = 1.0 # Seconds without a new frame between attempts to re-attach (capture service restarted)
+
+def bus_size(shape, slots):
+    return 8 * (HEADER_WORDS + 2 * slots) + slots * int(np.prod(shape))
+
+def attach_memory(name):
+    # Readers must not unlink the segment when they exit (the writer owns it)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        try: resource_tracker.unregister(memory._name, "shared_memory")
+        except Exception: pass
+        return memory
+
+class FrameBus:
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        buf = memory.buf
+        self.header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=buf)
+        if not owner and self.header[H_MAGIC] != MAGIC: raise IOError(f"{memory.name} is not a frame bus")
+        slots = int(self.header[H_SLOTS])
+        shape = (int(self.header[H_HEIGHT]), int(self.header[H_WIDTH]), int(self.header[H_CHANNELS]))
+        offset = 8 * HEADER_WORDS
+        self.slot_seq = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=offset)
+        self.slot_time = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=offset + 8 * slots)
+        self.frames = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=buf, offset=offset + 16 * slots)
+        self.slots = slots
+        self.shape = shape
+
+    @classmethod
+    def create(cls, name, shape, slots=8):
+        try: # A writer that crashed (or was killed by the hub) leaves its segment behind; take it over
+            stale = attach_memory(name)
+            stale.close(); stale.unlink()
+        except FileNotFoundError:
+            pass
+        memory = shared_memory.SharedMemory(name=name, create=True, size=bus_size(shape, slots))
+        header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=memory.buf)
+        header[:] = 0
+        header[H_HEIGHT], header[H_WIDTH], header[H_CHANNELS] = shape
+        header[H_SLOTS] = slots
+        bus = cls.__new__(cls)
+        FrameBus.__init__(bus, memory, owner=True)
+        bus.slot_seq[:] = 0
+        bus.header[H_MAGIC] = MAGIC # Last: readers only trust a fully initialized bus
+        return bus
+
+    @classmethod
+    def attach(cls, name):
+        return cls(attach_memory(name), owner=False)
+
+    # --- WRITER ---
+    def write(self, frame, timestamp):
+        seq = int(self.header[H_SEQ]) + 1
+        i = seq % self.slots
+        self.slot_seq[i] = WRITING # Readers that pick this slot now see it as invalid
+        np.copyto(self.frames[i], frame)
+        self.slot_time[i] = timestamp
+        self.slot_seq[i] = seq
+        self.header[H_SEQ] = seq
+        self.header[H_HEARTBEAT_MS] = int(time.time() * 1000)
+        return seq
+
+    def close(self):
+        if self.owner: self.header[H_CLOSED] = 1
+        self.header = self.slot_seq = self.slot_time = self.frames = None # Views must go before the buffer
+        try:
+            self.memory.close()
+        except BufferError:
+            pass # A frame view is still in use somewhere; the mapping goes away with it
+        if self.owner:
+            try: self.memory.unlink()
+            except FileNotFoundError: pass
+
+    # --- READERS ---
+    def latest(self):
+        """(seq, timestamp, read-only view) of the newest complete frame, or (0, 0, None)"""
+        seq = int(self.header[H_SEQ])
+        while seq > 0:
+            i = seq % self.slots
+            if self.slot_seq[i] == seq:
+                view = self.frames[i]
+                view.flags.writeable = False
+                return seq, float(self.slot_time[i]), view
+            seq -= 1 # Writer is inside this slot right now: the previous one is complete
+        return 0, 0.0, None
+
+    def valid(self, seq):
+        """True while the frame read as seq has not been overwritten (the writer laps after `slots` frames)"""
+        return self.slot_seq[seq % self.slots] == seq
+
+    def closed(self):
+        return self.header[H_CLOSED] == 1
+
+    def heartbeat_age(self):
+        """Seconds since the writer last published a frame (None before the first one)"""
+        if self.header[H_HEARTBEAT_MS] == 0: return None
+        return time.time() - self.header[H_HEARTBEAT_MS] / 1000.0
+
+class BusGrabber:
+    """FrameGrabber look-alike that reads a FrameBus: pipelines switch with video_source="bus:<name>" """
+    def __init__(self, name, timeout=10.0):
+        self.name = name
+        self.timeout = timeout # Seconds without a new frame before the camera counts as gone
+        self.bus = None
+        self.read_seq = 0
+        self.frame = None
+        self.dropped = 0
+        self.last_change = time.monotonic()
+        self.next_attach = 0
+
+    def start(self):
+        deadline = time.monotonic() + self.timeout
+        while self.bus is None:
+            try:
+                self.bus = FrameBus.attach(self.name)
+            except (FileNotFoundError, IOError):
+                if time.monotonic() > deadline: raise
+                time.sleep(0.2) # Capture service still starting
+        self.last_change = time.monotonic()
+        return self
+
+    @property
+    def running(self):
+        # A closed bus is not the end yet: the hub restarts the capture service and latest() re-attaches
+        return self.bus is not None and time.monotonic() - self.last_change < self.timeout
+
+    def set_rate(self, fps):
+        pass # The capture service decides the rate; readers just skip frames
+
+    def latest(self):
+        """Like FrameGrabber.latest, the frame is the caller's own: the ring slot is copied at hand-off"""
+        now = time.monotonic()
+        if now - self.last_change > REATTACH_EVERY and now >= self.next_attach: self.reattach()
+        while True:
+            seq, timestamp, view = self.bus.latest()
+            if view is None: return 0, 0.0, None
+            if seq == self.read_seq: return seq, timestamp, self.frame # Nothing new: no copy
+            frame = view.copy() # Slots are reused after `slots` frames; analysis, encode and recording outlive that
+            if self.bus.valid(seq): break # Otherwise the writer lapped us mid-copy (torn frame): take the newest again
+        if self.read_seq and seq > self.read_seq + 1: self.dropped += seq - self.read_seq - 1
+        self.read_seq = seq
+        self.frame = frame
+        self.last_change = time.monotonic()
+        return seq, timestamp, frame
+
+    def reattach(self):
+        # A restarted capture service creates a new segment under the same name; the old one never moves again
+        self.next_attach = time.monotonic() + REATTACH_EVERY
+        try:
+            bus = FrameBus.attach(self.name)
+        except (FileNotFoundError, IOError):
+            return # Not back yet
+        old, self.bus = self.bus, bus
+        self.read_seq = 0 # Sequence numbers restart with the new segment
+        old.close()
+
+    def valid(self, seq):
+        return self.bus is not None and self.bus.valid(seq)
+
+    def stop(self):
+        if self.bus is not None:
+            bus, self.bus = self.bus, None
+            bus.close()
+
+class CaptureService:
+    """The single writer: opens the camera (or any video source) and publishes every frame on the bus"""
+    def __init__(self, source, name, slots=8):
+        self.source = source
+        self.name = name
+        self.slots = slots
+        self.running = True
+
+    def run(self):
+        cap = open_video_source(self.source)
+        ok, frame = cap.read()
+        if not ok:
+            print(f"❌ Frame bus {self.name}: cannot read from {self.source}")
+            return
+        bus = FrameBus.create(self.name, frame.shape, self.slots)
+        print(f"🚌 Frame bus {self.name}: {frame.shape[1]}x{frame.shape[0]}, {self.slots} slots")
+        try:
+            while self.running and ok:
+                bus.write(frame, time.time())
+                ok, frame = cap.read()
+        finally:
+            cap.release()
+            bus.close()
+
+    def stop(self):
+        self.running = False
+
+def run_capture_service(source, name, slots=8):
+    # Process entry point (hub, or the command line below); SIGTERM still unlinks the shared memory
+    service = CaptureService(source, name, slots)
+    signal.signal(signal.SIGTERM, lambda *args: service.stop())
+    try: service.run()
+    except KeyboardInterrupt: pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish a camera on a shared-memory frame bus")
+    parser.add_argument("source", nargs="?", default="0", help="camera index, video file, image folder or synthetic")
+    parser.add_argument("--name", default="mamabear_cam0")
+    parser.add_argument("--slots", type=int, default=8)
+    args = parser.parse_args()
+    run_capture_service(args.source, args.name, args.slots)
+    sys.exit(0)
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import multiprocessing
+import websockets
+from pipeline import SharedStagePool
+from framebus import FrameBus, run_capture_service
+
+# --- HUB SETTINGS ---
+# One entry per camera: "baby" runs the NannyCam pipeline, "room" the RoomCam security pipeline.
+# "source" is anything sources.open_video_source understands (camera index, file, folder, "synthetic").
+CAMERAS = [
+    {"name": "nursery", "profile": "baby", "source": 0},
+    {"name": "living-room", "profile": "room", "source": 1},
+]
+# Shared captures: with {"cam0": 0} the camera is opened once and several CAMERAS entries can
+# analyze it with "source": "bus:cam0" (e.g. a baby and a room profile on the same nursery camera).
+BUSES = {}
+BUS_STALL = 3.0          # Seconds without a new frame before a capture service counts as hung and is restarted
+BUS_STARTUP = 20.0       # Seconds a (re)started capture service gets to open the camera and publish its first frame
+HUB_MODE = "threads"     # "threads": one process, shared cascades and worker pools
+                         # "processes": one supervised process per camera (uses every core)
+HUB_PORT = 8766          # Clients pick a camera by path: ws://host:8766/nursery (or /0); "/" is the first camera
+METRICS_BASE_PORT = 9100 # Camera i serves Prometheus metrics on METRICS_BASE_PORT + 1 + i (None = off)
+CHILD_BASE_PORT = 8870   # "processes" mode: camera i listens on 127.0.0.1:CHILD_BASE_PORT + i
+
+def get_local_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('10.255.255.255', 1))
+        IP = s.getsockname()[0]
+    except Exception:
+        IP = '127.0.0.1'
+    finally:
+        s.close()
+    return IP
+
+def build_camera(index, config, analysis_pool=None, encode_pool=None):
+    """Creates the server for one camera; its stream id is its position in CAMERAS"""
+    metrics_port = METRICS_BASE_PORT + 1 + index if METRICS_BASE_PORT else None
+    source = config.get("source", 0)
+    if config["profile"] == "baby":
+        import babycam
+        return babycam.NannyCamServer(detection_mode=babycam.DETECTION_MODE, detection_scale=babycam.DETECTION_SCALE,
+                                      headless=True, idle_fps=babycam.IDLE_FPS, video_source=source,
+                                      audio_source=config.get("audio"), metrics=metrics_port is not None,
+                                      metrics_port=metrics_port, stream_id=index,
+                                      analysis_pool=analysis_pool, encode_pool=encode_pool, recording=babycam.RECORDING,
+                                      history=babycam.HISTORY)
+    if config["profile"] == "room":
+        import roomcam
+        return roomcam.RoomCamServer(headless=True, idle_fps=roomcam.IDLE_FPS, video_source=source,
+                                     metrics=metrics_port is not None, metrics_port=metrics_port, stream_id=index,
+                                     analysis_pool=analysis_pool, encode_pool=encode_pool, recording=roomcam.RECORDING)
+    raise ValueError(f"Unknown camera profile {config['profile']!r}")
+
+def client_handler(server):
+    return getattr(server, "register_client", None) or server.handle_client
+
+def camera_tasks(server):
+    tasks = [server.run()]
+    if hasattr(server, "broadcast_audio"): tasks.append(server.broadcast_audio())
+    return tasks
+
+def camera_list():
+    return [{"name": c["name"], "profile": c["profile"], "stream_id": i, "path": f"/{c['name']}"} for i, c in enumerate(CAMERAS)]
+
+async def route(websocket):
+    """Camera index for the connection's path (None after answering /cameras or an unknown path)"""
+    path = websocket.request.path if hasattr(websocket, "request") else websocket.path
+    key = path.split("?")[0].strip("/")
+    names = [c["name"] for c in CAMERAS]
+    if key == "": return 0
+    if key.isdigit() and int(key) < len(CAMERAS): return int(key)
+    if key in names: return names.index(key)
+    if key == "cameras":
+        await websocket.send(json.dumps({"type": "cameras", "cameras": camera_list()}))
+    else:
+        await websocket.send(json.dumps({"type": "error", "error": f"unknown camera {key!r}", "cameras": camera_list()}))
+    return None
+
+# --- "threads" MODE ---
+async def run_threads():
+    # Every camera keeps at most one frame per stage in flight, so the pools can be shared safely;
+    # cascades are per worker thread (pipeline.SharedCascade), i.e. loaded once per worker, not per camera.
+    workers = os.cpu_count() or 1
+    analysis_pool = SharedStagePool(max_workers=workers, thread_name_prefix="analysis")
+    encode_pool = SharedStagePool(max_workers=workers, thread_name_prefix="encode")
+    servers = [build_camera(i, config, analysis_pool, encode_pool) for i, config in enumerate(CAMERAS)]
+    handlers = [client_handler(server) for server in servers]
+
+    async def handle(websocket):
+        index = await route(websocket)
+        if index is not None: await handlers[index](websocket)
+
+    try:
+        async with websockets.serve(handle, "0.0.0.0", HUB_PORT):
+            await asyncio.gather(*[task for server in servers for task in camera_tasks(server)])
+    finally:
+        analysis_pool.close()
+        encode_pool.close()
+
+# --- "processes" MODE ---
+def camera_process(index, config, port):
+    """Child process: one camera pipeline with its own WebSocket server on localhost"""
+    async def serve():
+        server = build_camera(index, config)
+        async with websockets.serve(client_handler(server), "127.0.0.1", port):
+            await asyncio.gather(*camera_tasks(server))
+    try: asyncio.run(serve())
+    except KeyboardInterrupt: pass
+
+class Supervisor:
+    """Keeps one process per job alive, restarting crashed (or stalled) ones with exponential backoff"""
+    def __init__(self, jobs):
+        self.jobs = jobs # [(name, target, args)]
+        self.processes = [None] * len(jobs)
+        self.restarts = [0] * len(jobs)
+        self.next_start = [0.0] * len(jobs)
+        self.started = [0.0] * len(jobs)
+        self.running = True
+
+    def start(self, i):
+        name, target, args = self.jobs[i]
+        process = multiprocessing.Process(target=target, args=args, name=name, daemon=True)
+        process.start()
+        self.processes[i] = process
+        self.started[i] = time.monotonic()
+
+    def start_all(self):
+        for i in range(len(self.jobs)): self.start(i)
+
+    def stalled(self, i):
+        return False # Alive but not doing its job (see BusSupervisor)
+
+    def halt(self, process):
+        process.terminate()
+        process.join(timeout=2.0)
+        if process.is_alive(): # Stuck in a driver call, SIGTERM never gets handled
+            process.kill()
+            process.join()
+
+    async def watch(self):
+        while self.running:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for i, process in enumerate(self.processes):
+                if process.is_alive():
+                    if not self.stalled(i): continue
+                    print(f"⚠️ {self.jobs[i][0]} stalled, stopping it")
+                    await asyncio.to_thread(self.halt, process)
+                if self.next_start[i] == 0:
+                    if now - self.started[i] > 60: self.restarts[i] = 0 # It ran fine for a while
+                    delay = min(30.0, 2.0 ** self.restarts[i])
+                    print(f"⚠️ {self.jobs[i][0]} exited (code {process.exitcode}), restarting in {delay:.0f}s")
+                    self.next_start[i] = now + delay
+                elif now >= self.next_start[i]:
+                    self.restarts[i] += 1
+                    self.next_start[i] = 0
+                    self.start(i)
+
+    def stop(self):
+        self.running = False
+        for process in self.processes:
+            if process is not None and process.is_alive(): process.terminate()
+        for process in self.processes:
+            if process is not None: process.join(timeout=2.0)
+
+async def proxy(websocket, port):
+    # Messages are relayed as-is (binary frames stay binary). A slow phone slows the relay, which
+    # fills the child's socket and lets its publisher drop frames / lower the tier as usual.
+    try:
+        async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as upstream:
+            async def pump(source, sink):
+                async for message in source:
+                    await sink.send(message)
+            tasks = [asyncio.create_task(pump(websocket, upstream)), asyncio.create_task(pump(upstream, websocket))]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending: task.cancel()
+    except (OSError, websockets.exceptions.ConnectionClosed):
+        pass # Camera process (re)starting; the app reconnects
+
+async def run_processes():
+    ports = [CHILD_BASE_PORT + i for i in range(len(CAMERAS))]
+    supervisor = Supervisor([(f"camera-{c['name']}", camera_process, (i, c, ports[i])) for i, c in enumerate(CAMERAS)])
+    supervisor.start_all()
+
+    async def handle(websocket):
+        index = await route(websocket)
+        if index is not None: await proxy(websocket, ports[index])
+
+    try:
+        async with websockets.serve(handle, "0.0.0.0", HUB_PORT):
+            await supervisor.watch()
+    finally:
+        supervisor.stop()
+
+class BusSupervisor(Supervisor):
+    """Supervisor for the capture services: a service whose bus heartbeat stops (camera driver hung in
+    read()) is restarted like a crashed one; BusGrabber readers re-attach to the new segment"""
+    def __init__(self, buses, stall=BUS_STALL, startup=BUS_STARTUP):
+        super().__init__([(f"bus-{name}", run_capture_service, (source, name)) for name, source in buses.items()])
+        self.names = list(buses)
+        self.stall = stall
+        self.startup = startup
+        self.buses = [None] * len(self.names) # Our own read-only attachment, for the heartbeat
+        self.started_at = [0.0] * len(self.names) # Wall clock, comparable with the heartbeat
+
+    def start(self, i):
+        self.detach(i)
+        self.started_at[i] = time.time()
+        super().start(i)
+
+    def detach(self, i):
+        if self.buses[i] is not None:
+            bus, self.buses[i] = self.buses[i], None
+            bus.close()
+
+    def stalled(self, i):
+        if self.buses[i] is None:
+            try: self.buses[i] = FrameBus.attach(self.names[i])
+            except (FileNotFoundError, IOError): pass # Not created yet
+        age = self.buses[i].heartbeat_age() if self.buses[i] is not None else None
+        now = time.time()
+        if age is not None and now - age >= self.started_at[i]: return age > self.stall
+        # No frame from this run yet (or still attached to the segment a killed service left behind)
+        self.detach(i)
+        return now - self.started_at[i] > self.startup
+
+    def stop(self):
+        for i in range(len(self.names)): self.detach(i)
+        super().stop()
+
+async def main():
+    print(f"🏠 Camera hub: {len(CAMERAS)} cameras, {HUB_MODE} mode")
+    for c in CAMERAS:
+        print(f"   📡 {c['name']} ({c['profile']}): ws://{get_local_ip()}:{HUB_PORT}/{c['name']}")
+    buses = BusSupervisor(BUSES)
+    buses.start_all() # Readers wait for their bus to appear
+    watchdog = asyncio.create_task(buses.watch())
+    try:
+        await (run_processes() if HUB_MODE == "processes" else run_threads())
+    finally:
+        watchdog.cancel()
+        buses.stop()
+
+if __name__ == "__main__":
+    try: asyncio.run(main())
+    except KeyboardInterrupt: pass
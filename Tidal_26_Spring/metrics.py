@@ -0,0 +1,177 @@
+import time
+import bisect
+import asyncio
+
+# --- HOT-PATH INSTRUMENTATION ---
+# Stage timings go into fixed-bucket histograms (one bisect + two adds per observation); counters
+# that already live on the servers are read only when someone asks, through collectors.
+# NullMetrics has the same interface and does nothing, so switching metrics off costs one no-op call.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0) # Seconds
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.max: self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (good enough to spot a slow stage)"""
+        target = q * self.count
+        running = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            running += n
+            if running >= target: return min(bound, self.max)
+        return self.max
+
+class Timer:
+    __slots__ = ("histogram", "start")
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Rate:
+    """Events per second, smoothed over the last few seconds"""
+    __slots__ = ("last", "fps")
+    def __init__(self):
+        self.last = None
+        self.fps = 0.0
+
+    def tick(self, now):
+        if self.last is not None and now > self.last:
+            self.fps = 1.0 / (now - self.last) if self.fps == 0 else 0.9 * self.fps + 0.1 / (now - self.last)
+        self.last = now
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, namespace):
+        self.namespace = namespace # Prometheus metric prefix, e.g. "babycam"
+        self.histograms = {}
+        self.counters = {}
+        self.rates = {}
+        self.collectors = []
+        self.started = time.time()
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None: histogram = self.histograms[stage] = Histogram()
+        return histogram
+
+    def timer(self, stage):
+        return Timer(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def tick(self, name):
+        rate = self.rates.get(name)
+        if rate is None: rate = self.rates[name] = Rate()
+        rate.tick(time.monotonic())
+
+    def add_collector(self, fn):
+        """fn() -> {name: number}, evaluated only when metrics are read"""
+        self.collectors.append(fn)
+
+    def gauges(self):
+        values = {}
+        for fn in self.collectors:
+            values.update(fn())
+        return values
+
+    def snapshot(self):
+        stages = {}
+        for stage, h in self.histograms.items():
+            if h.count == 0: continue
+            stages[stage] = {"count": h.count, "mean_ms": round(h.total / h.count * 1000, 2),
+                             "p50_ms": round(h.quantile(0.5) * 1000, 1), "p95_ms": round(h.quantile(0.95) * 1000, 1),
+                             "max_ms": round(h.max * 1000, 1)}
+        return {"enabled": True, "uptime": round(time.time() - self.started, 1), "stages": stages,
+                "counters": dict(self.counters), "fps": {name: round(r.fps, 2) for name, r in self.rates.items()},
+                "gauges": self.gauges()}
+
+    def prometheus(self):
+        """Text exposition format (version 0.0.4)"""
+        ns = self.namespace
+        lines = [f"# TYPE {ns}_stage_seconds histogram"]
+        for stage, h in self.histograms.items():
+            running = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                running += n
+                lines.append(f'{ns}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {running}')
+            lines.append(f'{ns}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+            lines.append(f'{ns}_stage_seconds_sum{{stage="{stage}"}} {h.total:.6f}')
+            lines.append(f'{ns}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE {ns}_{name}_total counter")
+            lines.append(f"{ns}_{name}_total {value}")
+        for name, rate in self.rates.items():
+            lines.append(f"# TYPE {ns}_{name}_fps gauge")
+            lines.append(f"{ns}_{name}_fps {rate.fps:.3f}")
+        for name, value in self.gauges().items():
+            lines.append(f"# TYPE {ns}_{name} gauge")
+            lines.append(f"{ns}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class NullTimer:
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): pass
+
+NULL_TIMER = NullTimer()
+
+class NullMetrics:
+    enabled = False
+
+    def timer(self, stage): return NULL_TIMER
+    def observe(self, stage, seconds): pass
+    def count(self, name, n=1): pass
+    def tick(self, name): pass
+    def add_collector(self, fn): pass
+    def snapshot(self): return {"enabled": False}
+    def prometheus(self): return ""
+
+NULL_METRICS = NullMetrics()
+
+def make_metrics(namespace, enabled=True):
+    return Metrics(namespace) if enabled else NULL_METRICS
+
+async def serve_prometheus(metrics, host="127.0.0.1", port=9101):
+    """Minimal HTTP endpoint for GET /metrics (bound to localhost by default)"""
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass # Skip headers
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                body = metrics.prometheus().encode()
+                head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            else:
+                body = b"Not found\n"
+                head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n"
+            writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"📈 Metrics at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,321 @@
+import cv2
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sources import open_video_source
+from metrics import NULL_METRICS, serve_prometheus
+
+DECODE_SLACK = 0.25 # Fraction of the decode interval a frame may arrive early and still count as due
+
+class FrameGrabber:
+    """Capture thread that always keeps only the newest camera frame (source: see sources.open_video_source)"""
+    def __init__(self, source=0, metrics=NULL_METRICS):
+        self.source = source
+        self.metrics = metrics
+        self.cap = None
+        self.frame = None
+        self.frame_time = 0
+        self.seq = 0
+        self.read_seq = 0
+        self.dropped = 0
+        self.decode_interval = 0 # Seconds between decoded frames (0 = every frame the camera delivers)
+        self.running = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._capture, daemon=True)
+
+    def start(self):
+        self.cap = open_video_source(self.source)
+        self.running = True
+        self.thread.start()
+        return self
+
+    def set_rate(self, fps):
+        """Caps how many frames per second get decoded (None = camera rate)"""
+        self.decode_interval = 1.0 / fps if fps else 0
+
+    def _capture(self):
+        # Decode when the next frame is due, not when a full interval has passed since the last one:
+        # with camera jitter the "since last" gate aliases (a 30 fps camera at 30 fps decoded ~20 fps)
+        next_due = 0
+        while self.running:
+            # grab() keeps the driver queue fresh; only retrieve() (the decode) is rate limited
+            if not self.cap.grab():
+                self.running = False
+                break
+            now = time.time()
+            interval = self.decode_interval
+            if interval and now < next_due - DECODE_SLACK * interval: continue
+            with self.metrics.timer("capture"): # Decode (grab() only latches the frame)
+                ret, frame = self.cap.retrieve()
+            if not ret:
+                self.running = False
+                break
+            if interval: next_due = max(next_due, now - interval / 2) + interval # Keeps the phase; resyncs after a stall
+            with self.lock:
+                # Nobody picked up the previous frame -> it is stale, overwrite it
+                if self.frame is not None and self.read_seq != self.seq:
+                    self.dropped += 1
+                self.frame = frame
+                self.frame_time = now
+                self.seq += 1
+
+    def latest(self):
+        """Returns (seq, timestamp, frame) of the newest frame (frame is None before the first read)"""
+        with self.lock:
+            self.read_seq = self.seq
+            return self.seq, self.frame_time, self.frame
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+        if self.cap is not None:
+            self.cap.release()
+
+def open_grabber(source=0, metrics=NULL_METRICS):
+    """"bus:<name>" reads a shared-memory frame bus (see framebus.py); anything else opens the source directly"""
+    if isinstance(source, str) and source.startswith("bus:"):
+        from framebus import BusGrabber
+        return BusGrabber(source[4:])
+    return FrameGrabber(source, metrics)
+
+def make_stage_pool(name):
+    # One worker per stage keeps per-stage state single-threaded; OpenCV releases the GIL
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+class SharedStagePool(ThreadPoolExecutor):
+    """One stage executor for several pipelines (multi-camera hub). Each pipeline still has at most one
+    frame in flight per stage, so its state stays sequential even when it hops between workers.
+    Pipelines call shutdown() when they stop; only close() (the owner) really shuts the pool down."""
+    def shutdown(self, wait=True, **kwargs):
+        pass
+
+    def close(self):
+        super().shutdown(wait=False)
+
+# --- SHARED MODELS ---
+# A CascadeClassifier must not be used by two threads at once. SharedCascade hands every thread its
+# own classifier, loaded on first use and then reused by every pipeline (camera) that runs on it.
+_thread_models = threading.local()
+_shared_cascades = {}
+
+class SharedCascade:
+    def __init__(self, filename):
+        self.path = cv2.data.haarcascades + filename
+
+    def classifier(self):
+        cache = getattr(_thread_models, "cascades", None)
+        if cache is None: cache = _thread_models.cascades = {}
+        cascade = cache.get(self.path)
+        if cascade is None:
+            cascade = cache[self.path] = cv2.CascadeClassifier(self.path)
+            if cascade.empty(): raise IOError(f"Cannot load {self.path}")
+        return cascade
+
+    def detectMultiScale(self, *args, **kwargs):
+        return self.classifier().detectMultiScale(*args, **kwargs)
+
+def shared_cascade(filename):
+    cascade = _shared_cascades.get(filename)
+    if cascade is None: cascade = _shared_cascades[filename] = SharedCascade(filename)
+    cascade.classifier() # Load now on the caller's thread so a bad install fails at startup
+    return cascade
+
+def put_latest(queue, item):
+    """Bounded hand-off between stages: drops the stale item instead of building a backlog"""
+    dropped = False
+    if queue.full():
+        try:
+            queue.get_nowait()
+            dropped = True
+        except asyncio.QueueEmpty:
+            pass
+    queue.put_nowait(item)
+    return dropped
+
+# --- FRAME SCHEDULING / LOAD SHEDDING ---
+# The analysis loop waits for absolute (monotonic) deadlines instead of sleeping a fixed time after
+# the work, so the frame rate holds as long as the work fits the budget. When it doesn't, work is
+# shed one level at a time, cheapest loss first; the vitals sampling rate is the last thing to go.
+SHED_LEVELS = ("none", "preview", "encode", "detection", "vitals")
+
+STALE_POLL = 0.005 # Seconds between looks for a frame that is due but not decoded yet
+
+class FrameScheduler:
+    def __init__(self, fps, high=0.9, low=0.6, raise_after=5, lower_after=30):
+        self.period = 1.0 / fps
+        self.high = high                 # Load (stage time / frame budget) above which work is shed
+        self.low = low                   # ... and below which it is brought back
+        self.raise_after = raise_after   # Consecutive overloaded frames before shedding one more level
+        self.lower_after = lower_after   # Consecutive relaxed frames before restoring one level
+        self.deadline = None
+        self.level = 0
+        self.stage_time = {}             # stage -> smoothed seconds per frame
+        self.over = 0
+        self.under = 0
+        self.missed = 0
+
+    def set_fps(self, fps):
+        self.period = 1.0 / fps
+
+    def busy(self):
+        return max(self.stage_time.values(), default=0.0) # The slowest stage sets the pace
+
+    def frame_period(self):
+        # Last level: a lower rate the slowest stage can actually hold, so samples stay evenly spaced
+        if self.shed("vitals"): return max(self.period, self.busy() * 1.1)
+        return self.period
+
+    async def wait(self, stale=False):
+        """Sleeps until the next deadline; a missed deadline is skipped, not caught up on.
+        stale=True: the frame for the current deadline was not decoded yet, so poll again shortly
+        (for up to half a period) instead of losing the whole period."""
+        now = time.monotonic()
+        if stale and self.deadline is not None and now - self.deadline < self.frame_period() / 2:
+            await asyncio.sleep(STALE_POLL)
+            return
+        if self.deadline is None: self.deadline = now
+        self.deadline += self.frame_period()
+        if self.deadline < now:
+            self.missed += 1
+            self.deadline = now
+        await asyncio.sleep(self.deadline - now)
+
+    def report(self, stage, seconds):
+        """Time one frame spent in a pipeline stage; the slowest stage decides the load"""
+        previous = self.stage_time.get(stage)
+        self.stage_time[stage] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+        self.adapt(self.busy() / self.frame_period())
+
+    def adapt(self, load):
+        if load > self.high:
+            self.over += 1; self.under = 0
+            if self.over >= self.raise_after and self.level < len(SHED_LEVELS) - 1:
+                self.set_level(self.level + 1)
+        elif load < self.low:
+            self.under += 1; self.over = 0
+            if self.under >= self.lower_after and self.level > 0:
+                self.set_level(self.level - 1)
+        else:
+            self.over = 0; self.under = 0
+
+    def set_level(self, level):
+        self.level = level
+        self.over = 0; self.under = 0
+        self.stage_time = {} # Measure again under the new level
+        print(f"⚖️ Load shedding: {SHED_LEVELS[level]}")
+
+    def shed(self, what):
+        """True once the shedding level has reached `what` (see SHED_LEVELS)"""
+        return self.level >= SHED_LEVELS.index(what)
+
+    def stats(self):
+        return {"shed_level": self.level, "deadlines_missed": self.missed,
+                "load": round(self.busy() / self.frame_period(), 3), "target_fps": round(1.0 / self.frame_period(), 2)}
+
+# --- STAGED CAMERA LOOP ---
+# capture thread -> analysis executor -> encode executor -> clients / recorder / preview window, shared
+# by the camera servers. The server keeps only its camera-specific hooks:
+#   analyze_frame(frame, t) -> result dict with at least "time", "status" and "preview" (frame or None)
+#   encode_frame(result, tiers) -> {tier: jpeg}, frame_meta(result) -> JSON payload for the clients
+#   shed_work(scheduler)   optional, before each analysis: scale the work to the shedding level
+#   after_analysis(result) optional, on the event loop once per analyzed frame (AI scheduling...)
+# and the state the loop reads: running, connected_clients, show_preview, active_fps, idle_fps,
+# scheduler, publisher, recorder, metrics, metrics_port, analysis_pool, encode_pool, video_source.
+class StagedLoop:
+    def __init__(self, server, window, record_tier):
+        self.server = server
+        self.window = window           # Preview window title
+        self.record_tier = record_tier # Tier the recorder stores, encoded even without clients
+        self.grabber = None
+        self.frames_dropped = 0
+
+    async def analysis_stage(self, encode_queue):
+        server = self.server
+        scheduler = server.scheduler
+        loop = asyncio.get_running_loop()
+        last_seq = 0
+        stale = False
+        while server.running:
+            # Full rate only while someone is watching; otherwise drop to the idle rate
+            scheduler.set_fps(server.active_fps if (server.connected_clients or server.show_preview) else server.idle_fps)
+            self.grabber.set_rate(1.0 / scheduler.frame_period())
+            await scheduler.wait(stale)
+            seq, frame_time, frame = self.grabber.latest()
+            stale = seq == last_seq
+            if stale:
+                if not self.grabber.running: break # Camera gone
+                continue
+            last_seq = seq
+
+            if hasattr(server, "shed_work"): server.shed_work(scheduler)
+            start = time.perf_counter()
+            with server.metrics.timer("analyze"):
+                result = await loop.run_in_executor(server.analysis_pool, server.analyze_frame, frame, frame_time)
+            scheduler.report("analysis", time.perf_counter() - start)
+            server.metrics.tick("analysis")
+            if hasattr(server, "after_analysis"): server.after_analysis(result)
+            if put_latest(encode_queue, result):
+                self.frames_dropped += 1
+
+        server.running = False
+        put_latest(encode_queue, None)
+
+    async def encode_stage(self, encode_queue):
+        server = self.server
+        loop = asyncio.get_running_loop()
+        while True:
+            result = await encode_queue.get()
+            if result is None: break
+
+            # Each tier is encoded once per frame, and only if some client (or the recorder) is on it
+            tiers = server.publisher.active_tiers() if server.connected_clients else set()
+            if server.recorder is not None: tiers.add(self.record_tier)
+            if len(tiers) > 1 and server.scheduler.shed("encode"): tiers = {max(tiers)} # Everyone gets the cheapest one
+            if tiers:
+                start = time.perf_counter()
+                with server.metrics.timer("encode"):
+                    jpegs = await loop.run_in_executor(server.encode_pool, server.encode_frame, result, tiers)
+                server.scheduler.report("encode", time.perf_counter() - start)
+            if server.connected_clients:
+                with server.metrics.timer("broadcast"):
+                    server.publisher.publish(jpegs, server.frame_meta(result), result["time"], result.get("waves"))
+                server.metrics.tick("sent")
+            if server.recorder is not None:
+                server.recorder.add_video(jpegs.get(self.record_tier) or jpegs[max(jpegs)], result["time"])
+                server.recorder.update(result["status"], result["time"])
+
+            if server.show_preview:
+                # First thing shed under load; the analysis may also have skipped drawing it (None)
+                if result["preview"] is not None and not server.scheduler.shed("preview"): cv2.imshow(self.window, result["preview"])
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    server.running = False
+                    break
+
+    async def run(self):
+        """Runs until the camera is gone or the server stops; the server cleans up its own extras afterwards"""
+        server = self.server
+        self.grabber = open_grabber(server.video_source, server.metrics).start()
+        metrics_server = None
+        if server.metrics.enabled and server.metrics_port:
+            metrics_server = await serve_prometheus(server.metrics, port=server.metrics_port)
+        encode_queue = asyncio.Queue(maxsize=1)
+        try:
+            await asyncio.gather(
+                self.analysis_stage(encode_queue),
+                self.encode_stage(encode_queue)
+            )
+        finally:
+            server.running = False
+            self.grabber.stop()
+            server.analysis_pool.shutdown(wait=False)
+            server.encode_pool.shutdown(wait=False)
+            if metrics_server is not None: metrics_server.close()
+            if server.recorder is not None: server.recorder.close()
+            if server.show_preview: cv2.destroyAllWindows()
+
+    def stats(self):
+        stats = {"frames_dropped": self.frames_dropped}
+        if self.grabber is not None: stats["capture_dropped"] = self.grabber.dropped
+        return stats
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import base64
+import struct
+from collections import deque
+from pipeline import make_stage_pool
+from transport import pack_frame, KIND_VIDEO, KIND_AUDIO
+
+# --- EVENT RECORDING ---
+# The server keeps the last few seconds of encoded video (and PCM audio) in memory. When the status
+# turns into an ALERT, that pre-roll plus everything until post_roll seconds after the last alert is
+# written to recordings/<id>.clip, and an index (<id>.json) lets clients seek and fetch byte ranges.
+#
+# .clip file: CLIP_MAGIC, then records of u32 length + a transport frame (FRAME_HEADER + body),
+# i.e. the same binary messages a live binary client receives (JPEG video, pcm16 audio).
+CLIP_MAGIC = b"MBCLIP01"
+RECORD_LENGTH = struct.Struct("!I")
+CHUNK_SIZE = 256 * 1024   # Default bytes per get_clip reply
+INDEX_INTERVAL = 1.0      # Seconds between seek index entries
+
+class EventRecorder:
+    def __init__(self, directory="recordings", stream_id=0, pre_roll=10.0, post_roll=10.0, max_clip=120.0, max_clips=50):
+        self.directory = directory
+        self.stream_id = stream_id
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll   # Keep recording this long after the last alert
+        self.max_clip = max_clip     # Seconds; a never-ending alert is split into several clips
+        self.max_clips = max_clips   # Oldest clips are deleted beyond this
+        self.buffer = deque()        # (kind, timestamp, bytes) pre-roll, oldest first
+        self.clip = None             # Clip being recorded (dict, touched only on the event loop)
+        self.writer_pool = make_stage_pool("record") # Disk writes in order, off the event loop
+        os.makedirs(directory, exist_ok=True)
+
+    # --- INPUT (event loop) ---
+    def add_video(self, jpeg, timestamp):
+        self.add(KIND_VIDEO, jpeg, timestamp)
+
+    def add_audio(self, pcm, timestamp):
+        self.add(KIND_AUDIO, pcm, timestamp)
+
+    def add(self, kind, body, timestamp):
+        if self.clip is not None:
+            self.write(kind, body, timestamp)
+            return
+        self.buffer.append((kind, timestamp, body))
+        while self.buffer and timestamp - self.buffer[0][1] > self.pre_roll:
+            self.buffer.popleft()
+
+    def update(self, status, timestamp):
+        """Call once per analyzed frame with the status the clients see"""
+        alert = "ALERT" in status
+        if self.clip is None:
+            if alert: self.start(status, timestamp)
+            return
+        if alert:
+            self.clip["last_alert"] = timestamp
+            if status not in self.clip["reasons"]: self.clip["reasons"].append(status)
+        if timestamp - self.clip["last_alert"] > self.post_roll or timestamp - self.clip["start"] > self.max_clip:
+            self.finish(timestamp)
+
+    # --- CLIPS ---
+    def start(self, status, timestamp):
+        clip_id = f"{self.stream_id}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(timestamp))}_{int(timestamp * 1000) % 1000:03d}"
+        start = self.buffer[0][1] if self.buffer else timestamp
+        self.clip = {"id": clip_id, "stream_id": self.stream_id, "reasons": [status], "start": start,
+                     "alert": timestamp, "last_alert": timestamp, "end": timestamp, "frames": 0, "audio_chunks": 0,
+                     "size": len(CLIP_MAGIC), "index": [], "seq": 0, "file": None}
+        print(f"🔴 Recording {clip_id} ({status})")
+        clip = self.clip
+        self.writer_pool.submit(self._open, clip)
+        pre_roll, self.buffer = self.buffer, deque()
+        for kind, t, body in pre_roll:
+            self.write(kind, body, t)
+
+    def write(self, kind, body, timestamp):
+        clip = self.clip
+        clip["seq"] += 1
+        record = pack_frame(kind, self.stream_id, clip["seq"], timestamp, body)
+        if kind == KIND_VIDEO:
+            if not clip["index"] or timestamp - clip["start"] - clip["index"][-1][0] >= INDEX_INTERVAL:
+                clip["index"].append([round(timestamp - clip["start"], 2), clip["size"]]) # Seek points are video frames
+            clip["frames"] += 1
+        else:
+            clip["audio_chunks"] += 1
+        clip["size"] += RECORD_LENGTH.size + len(record)
+        clip["end"] = timestamp
+        self.writer_pool.submit(self._append, clip, RECORD_LENGTH.pack(len(record)) + record)
+
+    def finish(self, timestamp):
+        clip, self.clip = self.clip, None
+        print(f"⏹️ Saved recording {clip['id']} ({clip['end'] - clip['start']:.0f}s, {clip['frames']} frames)")
+        self.writer_pool.submit(self._close, clip)
+
+    def _open(self, clip):
+        clip["file"] = open(self.path(clip["id"], ".clip"), "wb")
+        clip["file"].write(CLIP_MAGIC)
+
+    def _append(self, clip, data):
+        clip["file"].write(data)
+
+    def _close(self, clip):
+        clip["file"].close()
+        meta = {k: v for k, v in clip.items() if k not in ("file", "seq")}
+        tmp = self.path(clip["id"], ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.path(clip["id"], ".json"))
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        # Only this camera's clips: several cameras may share one directory (hub)
+        clips = sorted(f[:-5] for f in os.listdir(self.directory) if f.endswith(".json") and f.startswith(f"{self.stream_id}_"))
+        for clip_id in clips[:max(0, len(clips) - self.max_clips)]:
+            self.delete_clip(clip_id)
+
+    def path(self, clip_id, ext):
+        return os.path.join(self.directory, os.path.basename(clip_id) + ext)
+
+    # --- QUERIES (blocking file I/O: call them in an executor) ---
+    def list_clips(self):
+        clips = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json") or not name.startswith(f"{self.stream_id}_"): continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            meta.pop("index", None)
+            clips.append(meta)
+        return clips
+
+    def read_chunk(self, clip_id, offset=0, length=CHUNK_SIZE, at=None):
+        """Byte range of a finished clip; at (seconds into the clip) seeks to the video frame at or before it"""
+        with open(self.path(clip_id, ".json")) as f:
+            meta = json.load(f)
+        if at is not None:
+            offset = len(CLIP_MAGIC)
+            for t, position in meta["index"]:
+                if t > at: break
+                offset = position
+        length = max(0, min(int(length), CHUNK_SIZE * 4))
+        with open(self.path(clip_id, ".clip"), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return {"type": "clip_chunk", "id": clip_id, "offset": offset, "length": len(data), "size": meta["size"],
+                "eof": offset + len(data) >= meta["size"], "data": base64.b64encode(data).decode('utf-8')}
+
+    def delete_clip(self, clip_id):
+        for ext in (".json", ".clip"):
+            try: os.remove(self.path(clip_id, ext))
+            except FileNotFoundError: pass
+
+    def close(self):
+        if self.clip is not None: self.finish(self.clip["end"])
+        self.writer_pool.shutdown(wait=True)
+
+    async def handle_command(self, websocket, data, loop):
+        """list_clips / get_clip / delete_clip WebSocket commands; returns False for anything else"""
+        command = data.get("command")
+        try:
+            if command == "list_clips":
+                clips = await loop.run_in_executor(None, self.list_clips)
+                recording = [self.clip["id"]] if self.clip is not None else []
+                await websocket.send(json.dumps({"type": "clips", "clips": clips, "recording": recording}))
+            elif command == "get_clip":
+                # Missing or null fields take their defaults; anything else must be a number
+                offset, length, at = data.get("offset"), data.get("length"), data.get("time")
+                reply = await loop.run_in_executor(None, self.read_chunk, str(data.get("id", "")), int(offset or 0),
+                                                   CHUNK_SIZE if length is None else int(length), None if at is None else float(at))
+                await websocket.send(json.dumps(reply))
+            elif command == "delete_clip":
+                await loop.run_in_executor(None, self.delete_clip, str(data.get("id", "")))
+                await websocket.send(json.dumps({"type": "clip_deleted", "id": data.get("id")}))
+            else:
+                return False
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            await websocket.send(json.dumps({"type": "clip_error", "id": data.get("id"), "error": str(e)}))
+        return True
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from sources import open_video_source, open_audio_source, SyntheticSource, ToneSource
+
+# --- OFFLINE REPLAY / BENCHMARK ---
+# Runs NannyCamServer / RoomCamServer on recorded or synthetic input without a camera, microphone or
+# Gemini key, as fast as the machine allows. Frame times are virtual (frame index / fps), so the
+# vitals, alerts and AI scheduling come out the same on every run.
+#
+#   python replay.py baby --video clip.mp4 --audio night.wav
+#   python replay.py room --video frames_folder/
+#   python replay.py bench
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class GeminiStub:
+    """Answers like Gemini (same call shapes as genai.Client) from canned verdicts, without a network"""
+    def __init__(self, latency=0.0, safe=True, authorized=True):
+        self.latency = latency
+        self.safe = safe
+        self.authorized = authorized
+        self.calls = 0
+        self.models = self
+        self.aio = StubAio(self)
+
+    def answer(self, contents):
+        self.calls += 1
+        if "authorized_person_present" in str(contents[0]):
+            return StubResponse(json.dumps({"authorized_person_present": self.authorized, "confidence": "HIGH",
+                                            "description": "stub verdict"}))
+        return StubResponse(json.dumps({"is_safe": self.safe, "status_text": "SAFE" if self.safe else "FACE COVERED",
+                                        "is_crying": False}))
+
+    def generate_content(self, model=None, contents=None, config=None):
+        if self.latency: time.sleep(self.latency)
+        return self.answer(contents)
+
+class StubAio:
+    def __init__(self, stub):
+        self.stub = stub
+        self.models = self
+
+    async def generate_content(self, model=None, contents=None, config=None):
+        if self.stub.latency: await asyncio.sleep(self.stub.latency)
+        return self.stub.answer(contents)
+
+class StageTimes:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def report(self, title):
+        print(f"\n📊 {title}")
+        print(f"   {'stage':<10}{'calls':>7}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'max fps':>9}")
+        for stage, values in self.samples.items():
+            ms = np.array(values) * 1000
+            print(f"   {stage:<10}{len(ms):>7}{ms.mean():>10.1f}{np.percentile(ms, 50):>9.1f}{np.percentile(ms, 95):>9.1f}{1000 / max(ms.mean(), 1e-6):>9.0f}")
+
+def timed(times, stage, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    times.add(stage, time.perf_counter() - start)
+    return result
+
+async def replay_baby(server, video, audio=None, frames=None, tiers=(0, 1, 2), times=None, on_result=None):
+    times = times or StageTimes()
+    monitor = server.audio_monitor
+    silence = np.zeros(monitor.blocksize, dtype=np.float32)
+    t0 = time.time()
+    pending_audio = 0.0
+    last_cry = None
+    count = 0
+    while frames is None or count < frames:
+        ok, frame = timed(times, "capture", video.read)
+        if not ok: break
+        frame_time = t0 + video.frame_time
+
+        # Audio for the same span of virtual time, in the block size the microphone would deliver
+        pending_audio += monitor.samplerate / video.fps
+        while pending_audio >= monitor.blocksize:
+            block = audio.read(monitor.blocksize) if audio is not None else silence
+            monitor.write(block if block is not None else silence)
+            pending_audio -= monitor.blocksize
+        if last_cry is None or frame_time - last_cry >= server.cry_detector.interval:
+            timed(times, "cry", server.cry_detector.update)
+            last_cry = frame_time
+
+        result = timed(times, "analyze", server.analyze_frame, frame, frame_time)
+        server.gemini.consider(result["clean"], result["signals"], frame_time)
+        if not server.gemini.queue.empty(): # Answered before the next frame: same verdicts every run
+            start = time.perf_counter()
+            await server.gemini.check(*server.gemini.queue.get_nowait(), server.encode_pool)
+            times.add("ai", time.perf_counter() - start)
+        if tiers: timed(times, "encode", server.encode_frame, result, set(tiers))
+        if on_result is not None: on_result(result)
+        count += 1
+    return times
+
+def replay_room(server, video, frames=None, tiers=(0, 1, 2), times=None, on_result=None):
+    times = times or StageTimes()
+    t0 = time.time()
+    count = 0
+    while frames is None or count < frames:
+        ok, frame = timed(times, "capture", video.read)
+        if not ok: break
+        result = timed(times, "analyze", server.analyze_frame, frame, t0 + video.frame_time)
+        if tiers: timed(times, "encode", server.encode_frame, result, set(tiers))
+        if on_result is not None: on_result(result)
+        count += 1
+    return times
+
+def make_baby_server(video, audio, stub):
+    import babycam
+    return babycam.NannyCamServer(detection_mode=babycam.DETECTION_MODE, detection_scale=babycam.DETECTION_SCALE,
+                                  headless=True, video_source=video, audio_source=audio, ai_client=stub, realtime=False)
+
+def make_room_server(video, stub):
+    import roomcam
+    return roomcam.RoomCamServer(headless=True, video_source=video, ai_client=stub, realtime=False)
+
+def first_face_photo(folder="authorized_faces"):
+    if not os.path.isdir(folder): return None
+    photos = sorted(f for f in os.listdir(folder) if f.endswith('.jpg'))
+    return os.path.join(folder, photos[0]) if photos else None
+
+# --- BENCHMARK SUITE ---
+def vitals_accuracy(hr, rr, face, seconds=45.0, fps=10.0):
+    """Synthetic baby with known rates -> median estimates over the last 15 s"""
+    video = SyntheticSource(hr_bpm=hr, rr_rpm=rr, fps=fps, face=face, frames=int(seconds * fps), realtime=False)
+    server = make_baby_server(video, None, GeminiStub())
+    readings = []
+    times = asyncio.run(replay_baby(server, video, tiers=(), on_result=lambda r: readings.append((r["time"], r["bpm"], r["rpm"],
+                                                                                                   server.vitals.raw_hr, server.vitals.raw_rr))))
+    readings = np.array(readings)
+    tail = readings[readings[:, 0] >= readings[-1, 0] - 15.0]
+    return np.median(tail[:, 3]), np.median(tail[:, 4]), tail[-1, 1], tail[-1, 2], times
+
+def cry_response(kind, seconds=6.0):
+    video = SyntheticSource(fps=10.0, frames=int(seconds * 10), realtime=False)
+    server = make_baby_server(video, None, GeminiStub())
+    peak = []
+    asyncio.run(replay_baby(server, video, audio=ToneSource(kind), tiers=(), on_result=lambda r: peak.append(r["cry_confidence"])))
+    return max(peak)
+
+def bench():
+    face = first_face_photo()
+    if face is None: print("⚠️ No photo in authorized_faces/: heart rate cannot be measured on the synthetic scene")
+
+    print("\n🫀 Vitals accuracy (synthetic scene, 10 fps, median of the last 15 s)")
+    print(f"   {'true HR':>8}{'raw HR':>8}{'shown':>7}  |{'true RR':>8}{'raw RR':>8}{'shown':>7}")
+    all_times = StageTimes()
+    for hr, rr in [(96, 24), (132, 36)]:
+        raw_hr, raw_rr, shown_hr, shown_rr, times = vitals_accuracy(hr, rr, face)
+        print(f"   {hr:>8}{raw_hr:>8.1f}{shown_hr:>7.0f}  |{rr:>8}{raw_rr:>8.1f}{shown_rr:>7.0f}")
+        for stage, values in times.samples.items():
+            for v in values: all_times.add(stage, v)
+
+    print("\n🎙️ Cry detector (peak confidence)")
+    for kind in ("quiet", "speech", "cry"):
+        print(f"   {kind:<8}{cry_response(kind):.2f}")
+
+    # Throughput with every tier encoded (worst case: clients on all three)
+    video = SyntheticSource(face=face, frames=200, realtime=False)
+    baby = make_baby_server(video, None, GeminiStub())
+    times = asyncio.run(replay_baby(baby, video, audio=ToneSource("quiet")))
+    times.report("NannyCamServer stages (synthetic scene, 3 tiers)")
+
+    video = SyntheticSource(face=face, frames=200, realtime=False)
+    times = replay_room(make_room_server(video, GeminiStub()), video)
+    times.report("RoomCamServer stages (synthetic scene, 3 tiers)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded/synthetic input through the camera servers")
+    parser.add_argument("mode", choices=["baby", "room", "bench"])
+    parser.add_argument("--video", default="synthetic", help='video file, image folder or "synthetic:hr=120,rr=30"')
+    parser.add_argument("--audio", default=None, help='16 kHz WAV file or "synthetic:cry" (baby only)')
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--ai-latency", type=float, default=0.0, help="seconds the Gemini stub takes to answer")
+    args = parser.parse_args()
+
+    if args.mode == "bench":
+        bench()
+        return
+
+    video = open_video_source(args.video, realtime=False)
+    stub = GeminiStub(latency=args.ai_latency)
+    statuses = {}
+    count_status = lambda r: statuses.__setitem__(r["status"], statuses.get(r["status"], 0) + 1)
+    start = time.perf_counter()
+    if args.mode == "baby":
+        server = make_baby_server(video, None, stub)
+        times = asyncio.run(replay_baby(server, video, open_audio_source(args.audio), args.frames, on_result=count_status))
+        print(f"\n🫀 Final BPM {server.hr_stabilizer.value:.0f} / RPM {server.rr_stabilizer.value:.0f}")
+    else:
+        server = make_room_server(video, stub)
+        times = replay_room(server, video, args.frames, on_result=count_status)
+    elapsed = time.perf_counter() - start
+
+    frames = len(times.samples.get("analyze", []))
+    print(f"⏱️ {frames} frames in {elapsed:.1f}s ({frames / max(elapsed, 1e-6):.1f} fps, {frames / video.fps / max(elapsed, 1e-6):.1f}x real time)")
+    print(f"🤖 Gemini stub calls: {stub.calls}")
+    print("🏷️ Statuses: " + ", ".join(f"{k} x{v}" for k, v in statuses.items()))
+    times.report("Per-stage timings")
+
+if __name__ == "__main__":
+    try: main()
+    except KeyboardInterrupt: sys.exit(1)
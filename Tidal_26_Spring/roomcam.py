@@ -6,16 +6,53 @@ import json
 import socket
 import base64
 import time
-import threading
+import hashlib
 import os
 from google import genai
 from google.genai import types
 from PIL import Image
-import io
+from pipeline import make_stage_pool, shared_cascade, FrameScheduler, StagedLoop
+from transport import VideoPublisher, encode_tiers, DEFAULT_TIER
+from metrics import make_metrics
+from recorder import EventRecorder
 
 # ⚠️ PUT YOUR GEMINI KEY HERE
 GEMINI_API_KEY = ""
 
+# --- ENROLLMENT SETTINGS ---
+COLLAGE_CELL = 160       # Face size in the reference collage
+COLLAGE_MAX_SIDE = 640   # The collage never grows past this, however many users are enrolled
+# Kept next to the photos (never *.jpg, so never mistaken for a user). Row i of both arrays
+# belongs to manifest entry i, so enrolling one user appends instead of rescanning the folder.
+MANIFEST_FILE = "manifest.json"       # [{"id", "file", "added", "sha1", "face"}, ...]
+THUMBS_FILE = "thumbs.npy"            # COLLAGE_CELL face crops
+DESCRIPTORS_FILE = "descriptors.npy"  # LBP descriptors (zeros where no face was found)
+
+# --- TRACKING SETTINGS ---
+VERDICT_TTL = 300.0   # Seconds a per-person verdict is trusted before that person is checked again
+TRACK_MAX_MISSING = 2.0 # Seconds a track survives without a matching detection
+
+# --- DETECTION SETTINGS ---
+FULL_SCAN_EVERY = 5.0 # Seconds between full-frame cascade scans outside motion regions (x3 while shedding detection)
+
+# --- INPUT SETTINGS ---
+VIDEO_SOURCE = 0  # Camera index, a video file, a folder of images, "synthetic" or "bus:<name>"
+
+# --- METRICS SETTINGS ---
+METRICS = True       # Per-stage timings + counters ("metrics" WebSocket command); False = no-op, no cost
+METRICS_PORT = 9102  # Prometheus text endpoint on localhost (None = WebSocket only)
+
+# --- RECORDING SETTINGS ---
+RECORDING = True              # Save a clip (with pre-roll) to disk whenever an intruder ALERT is raised
+RECORDINGS_DIR = "recordings" # Clips are listed/streamed with the list_clips / get_clip WebSocket commands
+PRE_ROLL = 10.0               # Seconds kept in memory before the alert
+POST_ROLL = 10.0              # Seconds recorded after the last alert
+
+# --- POWER SETTINGS ---
+HEADLESS = False  # No preview window (always-on units without a display)
+ACTIVE_FPS = 30.0 # Target analysis rate while someone is watching (paced by deadlines, shed under load)
+IDLE_FPS = 2.0    # Capture/analysis rate while nobody is watching (intrusion checks keep running)
+
 # Configure Gemini
 client = None
 try:
@@ -38,8 +75,214 @@ def get_local_ip():
         s.close()
     return IP
 
+def boxes_overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+class MotionGate:
+    """Cheap frame differencing on a downscaled frame; tells the cascades where (and whether) to look"""
+    def __init__(self, width=160, threshold=25, min_area=15, learn_rate=0.1, full_scan_every=5.0):
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area         # In downscaled pixels
+        self.learn_rate = learn_rate     # How fast the background absorbs changes
+        self.full_scan_every = full_scan_every
+        self.background = None
+        self.last_full_scan = 0
+
+    def update(self, gray):
+        """Returns motion boxes (x, y, w, h) in full-frame coordinates"""
+        H, W = gray.shape[:2]
+        scale = self.width / W
+        small = cv2.resize(gray, (self.width, int(H * scale)), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        if self.background is None:
+            self.background = small.astype(np.float32)
+            return [(0, 0, W, H)] # First frame: everything is new
+        
+        diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(small, self.background, self.learn_rate)
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        
+        regions = []
+        for c in contours:
+            if cv2.contourArea(c) < self.min_area: continue
+            x, y, w, h = cv2.boundingRect(c)
+            # Back to full resolution, padded so a face at the edge of the motion still fits
+            pad = max(w, h) // 2 + 4
+            x0 = max(0, int((x - pad) / scale)); y0 = max(0, int((y - pad) / scale))
+            x1 = min(W, int((x + w + pad) / scale)); y1 = min(H, int((y + h + pad) / scale))
+            regions.append((x0, y0, x1 - x0, y1 - y0))
+        return regions
+
+    def full_scan_due(self, now):
+        if now - self.last_full_scan >= self.full_scan_every:
+            self.last_full_scan = now
+            return True
+        return False
+
+# --- LOCAL FACE DESCRIPTORS (uniform LBP histograms on a 4x4 grid) ---
+LBP_SIZE = 64
+LBP_GRID = 4
+LBP_BINS = 59 # 58 uniform patterns + 1 bin for everything else
+LBP_DIM = LBP_GRID * LBP_GRID * LBP_BINS
+LBP_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+def _build_lbp_tables():
+    uniform = np.full(256, LBP_BINS - 1, dtype=np.int32)
+    next_bin = 0
+    for code in range(256):
+        bits = [(code >> i) & 1 for i in range(8)]
+        if sum(bits[i] != bits[(i + 1) % 8] for i in range(8)) <= 2:
+            uniform[code] = next_bin
+            next_bin += 1
+    cell = np.arange(LBP_SIZE) // (LBP_SIZE // LBP_GRID)
+    cell_ids = (cell[:, None] * LBP_GRID + cell[None, :]) * LBP_BINS
+    return uniform, cell_ids
+
+LBP_UNIFORM, LBP_CELL_OFFSETS = _build_lbp_tables()
+
+def lbp_descriptor(face_gray):
+    """Unit-length descriptor; the dot product of two descriptors is their similarity (0..1)"""
+    g = cv2.equalizeHist(cv2.resize(face_gray, (LBP_SIZE + 2, LBP_SIZE + 2), interpolation=cv2.INTER_AREA)).astype(np.int16)
+    center = g[1:-1, 1:-1]
+    codes = np.zeros((LBP_SIZE, LBP_SIZE), dtype=np.int32)
+    for bit, (dy, dx) in enumerate(LBP_OFFSETS):
+        codes |= (g[1+dy:LBP_SIZE+1+dy, 1+dx:LBP_SIZE+1+dx] >= center).astype(np.int32) << bit
+    hist = np.bincount((LBP_CELL_OFFSETS + LBP_UNIFORM[codes]).ravel(), minlength=LBP_DIM).astype(np.float32)
+    hist = np.sqrt(hist.reshape(-1, LBP_BINS) / (LBP_SIZE // LBP_GRID) ** 2).ravel() # Hellinger per cell
+    return hist / np.linalg.norm(hist)
+
+def square_crop(gray, box, margin=1.0):
+    x, y, w, h = box
+    H, W = gray.shape[:2]
+    side = int(max(w, h) * margin)
+    cx, cy = x + w // 2, y + h // 2
+    x0 = max(0, cx - side // 2); y0 = max(0, cy - side // 2)
+    return gray[y0:min(H, y0 + side), x0:min(W, x0 + side)]
+
+class FaceIndex:
+    """Enrolled descriptors in one array: a single matrix product matches every detected face.
+    LBP similarity cannot tell people apart (same-person enrollment pairs score 0.88-0.93, blurred
+    noise 0.80, an unrelated synthetic face 0.93), so it never authorizes anyone: it only skips the
+    Gemini call for crops far below anything the enrolled photos score against each other."""
+    def __init__(self, reject=0.70, margin=0.15):
+        self.max_reject = reject # Below this for every face is a confident stranger...
+        self.margin = margin     # ... and at least this far below the weakest enrolled self-match
+        self.reject = reject
+        self.descriptors = np.zeros((0, LBP_DIM), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def set(self, descriptors):
+        self.descriptors = np.asarray(descriptors, dtype=np.float32).reshape(-1, LBP_DIM)
+        self.reject = self.max_reject
+        if len(self.descriptors) > 1:
+            # Calibrate on the enrollment: each photo's best match among the others is a real positive pair
+            pairs = self.descriptors @ self.descriptors.T
+            np.fill_diagonal(pairs, -1.0)
+            self.reject = min(self.max_reject, float(pairs.max(axis=1).min()) - self.margin)
+
+    def best_similarity(self, queries):
+        if len(self.descriptors) == 0 or len(queries) == 0: return np.zeros(len(queries))
+        return (np.asarray(queries, dtype=np.float32) @ self.descriptors.T).max(axis=1)
+
+    def classify(self, queries):
+        """Returns ("stranger" | "ambiguous", best similarity over all faces); only Gemini can confirm a match"""
+        best = self.best_similarity(queries)
+        top = float(best.max()) if len(best) else 0.0
+        if len(best) and top < self.reject: return "stranger", top
+        return "ambiguous", top
+
+# --- PER-PERSON TRACKING ---
+def box_iou(a, b):
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+def suppress_duplicates(boxes, iou_threshold=0.3):
+    """NMS for scoreless cascade hits: earlier boxes (frontal before profile) win.
+    A box mostly inside a kept one is a duplicate too (profile hits are often smaller)."""
+    keep = []
+    for box in boxes:
+        duplicate = False
+        for k in keep:
+            iou = box_iou(box, k)
+            if iou >= iou_threshold: duplicate = True; break
+            if iou > 0:
+                ix = min(box[0] + box[2], k[0] + k[2]) - max(box[0], k[0])
+                iy = min(box[1] + box[3], k[1] + k[3]) - max(box[1], k[1])
+                if ix * iy >= 0.8 * min(box[2] * box[3], k[2] * k[3]): duplicate = True; break
+        if not duplicate: keep.append(box)
+    return keep
+
+class FaceTrack:
+    def __init__(self, track_id, box, now):
+        self.id = track_id
+        self.box = box
+        self.first_seen = now
+        self.last_seen = now
+        self.hits = 1
+        self.verdict = None     # "authorized" | "intruder" | None (not decided yet)
+        self.verdict_time = 0
+        self.message = ""
+        self.last_local_check = 0
+        self.last_ai_check = 0  # Gemini is asked at most every 15 s per person
+
+    def needs_verdict(self, now, ttl):
+        return self.verdict is None or now - self.verdict_time > ttl
+
+    def set_verdict(self, verdict, message, now):
+        self.verdict = verdict
+        self.message = message
+        self.verdict_time = now
+
+class FaceTracker:
+    """Greedy IoU association of face boxes into tracks with stable ids"""
+    def __init__(self, iou_threshold=0.3, max_missing=2.0):
+        self.iou_threshold = iou_threshold
+        self.max_missing = max_missing
+        self.tracks = {}
+        self.next_id = 1
+        self.verdicts_stale = False # Set by other threads; the tracks themselves are only touched in update()
+
+    def update(self, boxes, now):
+        """Returns the tracks seen in this frame"""
+        if self.verdicts_stale:
+            self.verdicts_stale = False
+            for track in self.tracks.values(): track.verdict = None
+        pairs = sorted(((box_iou(t.box, b), t.id, i) for t in self.tracks.values() for i, b in enumerate(boxes)), reverse=True)
+        used_tracks = set(); used_boxes = set()
+        for iou, track_id, i in pairs:
+            if iou < self.iou_threshold: break
+            if track_id in used_tracks or i in used_boxes: continue
+            track = self.tracks[track_id]
+            track.box = boxes[i]; track.last_seen = now; track.hits += 1
+            used_tracks.add(track_id); used_boxes.add(i)
+        
+        for i, box in enumerate(boxes):
+            if i in used_boxes: continue
+            self.tracks[self.next_id] = FaceTrack(self.next_id, box, now)
+            self.next_id += 1
+        
+        for track_id in [t.id for t in self.tracks.values() if now - t.last_seen > self.max_missing]:
+            del self.tracks[track_id]
+        return [t for t in self.tracks.values() if t.last_seen == now]
+
+    def clear_verdicts(self):
+        """Thread-safe: every verdict is dropped at the start of the next update()"""
+        self.verdicts_stale = True
+
 class RoomCamServer:
-    def __init__(self):
+    def __init__(self, headless=False, idle_fps=2.0, video_source=0, ai_client=None, metrics=False, metrics_port=None,
+                 stream_id=1, analysis_pool=None, encode_pool=None, recording=False, recordings_dir=RECORDINGS_DIR, realtime=True):
+        self.metrics = make_metrics("roomcam", metrics)
+        self.metrics_port = metrics_port
+        self.ai_calls = 0
         # --- UPGRADE: Use Deep Neural Network (DNN) for better accuracy ---
         # These models are built into OpenCV but need the files loaded.
         # If these fail, we fall back to Haar Cascades automatically.
@@ -47,18 +290,28 @@ class RoomCamServer:
         try:
             # We will use the standard Haar Cascade as the primary for simplicity in this script,
             # but we tune the parameters for maximum accuracy.
-            self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            self.face_cascade = shared_cascade('haarcascade_frontalface_default.xml')
             
             # Additional cascades for profiles (side views)
-            self.profile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+            self.profile_cascade = shared_cascade('haarcascade_profileface.xml')
             print("✅ High-Accuracy Cascade configuration loaded")
         except Exception as e:
             print(f"⚠️ Cascade Error: {e}")
 
+        self.video_source = video_source
+        self.ai_client = ai_client if ai_client is not None else client
+
+        self.motion_gate = MotionGate(full_scan_every=FULL_SCAN_EVERY)
+        self.last_faces = []
+        self.tracker = FaceTracker(max_missing=TRACK_MAX_MISSING)
+        self.verdict_ttl = VERDICT_TTL
+
         self.connected_clients = set()
+        self.publisher = VideoPublisher(stream_id=stream_id, meta_type="status")
         self.alert_status = "WAITING FOR TRAINING..."
-        self.last_ai_check = 0
-        self.ai_lock = False
+        self.ai_lock = False # One Gemini request in flight at a time (set by verify_tracks, cleared by verify_intruder)
+        self.ai_pool = make_stage_pool("gemini")
+        self.realtime = realtime # False (replay): Gemini checks run inline so verdicts are deterministic
         self.ai_message = ""
         
         # --- MULTI-USER STORAGE ---
@@ -67,20 +320,76 @@ class RoomCamServer:
             os.makedirs(self.faces_dir)
             
         self.authorized_users = [] 
+        self.enrollment = []
+        self.thumbs = np.zeros((0, COLLAGE_CELL, COLLAGE_CELL, 3), dtype=np.uint8)
+        self.descriptors = np.zeros((0, LBP_DIM), dtype=np.float32)
+        self.collage = None
+        self.enrollment_generation = 0 # Bumped by publish_enrollment; Gemini answers about an older collage are dropped
+        self.face_index = FaceIndex(reject=0.70, margin=0.15)
+        # Enrollment runs off the event loop, one job at a time (shared cascades are per-thread, so this is safe)
+        self.enroll_pool = make_stage_pool("enroll")
         self.load_authorized_faces()
 
+        # PIPELINE STATE (capture thread -> analysis executor -> encode executor)
+        self.running = True
+        self.show_preview = not headless
+        self.active_fps = ACTIVE_FPS
+        self.scheduler = FrameScheduler(self.active_fps)
+        self.idle_fps = idle_fps
+        self.analysis_pool = analysis_pool or make_stage_pool("analysis")
+        self.encode_pool = encode_pool or make_stage_pool("encode")
+        self.pipeline = StagedLoop(self, "Room Cam (Laptop)", record_tier=DEFAULT_TIER)
+        self.metrics.add_collector(self.collect_metrics)
+
+        # EVENT RECORDING (pre-roll of medium-tier JPEGs, flushed to disk on ALERT)
+        self.recorder = None
+        if recording:
+            self.recorder = EventRecorder(recordings_dir, stream_id=stream_id, pre_roll=PRE_ROLL, post_roll=POST_ROLL)
+
+    def collect_metrics(self):
+        stats = {"ai_calls_made": self.ai_calls,
+                 "tracks": len(self.tracker.tracks), "authorized_users": len(self.authorized_users)}
+        stats.update(self.pipeline.stats())
+        stats.update(self.publisher.stats())
+        stats.update(self.scheduler.stats())
+        return stats
+
     def load_authorized_faces(self):
-        """Loads all JPGs from the folder into memory"""
-        self.authorized_users = []
-        files = [f for f in os.listdir(self.faces_dir) if f.endswith('.jpg')]
+        """Loads the manifest and reconciles it with the folder (photos added or removed by hand)"""
+        try:
+            with open(os.path.join(self.faces_dir, MANIFEST_FILE)) as f:
+                enrollment = json.load(f)
+            thumbs = np.load(os.path.join(self.faces_dir, THUMBS_FILE))
+            descriptors = np.load(os.path.join(self.faces_dir, DESCRIPTORS_FILE))
+            if not (len(enrollment) == len(thumbs) == len(descriptors)): raise ValueError("manifest out of sync")
+        except (OSError, ValueError):
+            enrollment, thumbs, descriptors = [], self.thumbs[:0], self.descriptors[:0]
         
-        for filename in files:
-            path = os.path.join(self.faces_dir, filename)
-            try:
-                with open(path, "rb") as f:
-                    self.authorized_users.append(f.read())
-            except Exception as e:
-                print(f"❌ Error loading file {filename}: {e}")
+        files = set(f for f in os.listdir(self.faces_dir) if f.endswith('.jpg'))
+        keep = [i for i, entry in enumerate(enrollment) if entry["file"] in files]
+        changed = len(keep) != len(enrollment)
+        self.enrollment = [enrollment[i] for i in keep]
+        self.thumbs, self.descriptors = thumbs[keep], descriptors[keep]
+        
+        known = set(entry["file"] for entry in self.enrollment)
+        for filename in sorted(files - known): # Older installs, or photos copied in manually
+            with open(os.path.join(self.faces_dir, filename), "rb") as f:
+                data = f.read()
+            if self.add_entry(filename, data) is None:
+                print(f"❌ Error loading file {filename}")
+            changed = True
+        
+        if changed: self.save_manifest()
+        self.publish_enrollment()
+
+    def publish_enrollment(self):
+        # Swaps in the new collage/index; the analysis thread only ever sees complete objects
+        collage = self.compose_collage(self.thumbs)
+        self.collage = Image.fromarray(cv2.cvtColor(collage, cv2.COLOR_BGR2RGB)) if collage is not None else None
+        self.face_index.set([d for d, entry in zip(self.descriptors, self.enrollment) if entry["face"]])
+        self.authorized_users = [entry["file"] for entry in self.enrollment]
+        self.enrollment_generation += 1
+        self.tracker.clear_verdicts() # Someone may have just been enrolled (or removed)
         
         if len(self.authorized_users) > 0:
             print(f"✅ Loaded {len(self.authorized_users)} authorized users.")
@@ -88,35 +397,133 @@ class RoomCamServer:
         else:
             self.alert_status = "WAITING FOR TRAINING..."
 
-    # --- GEMINI CHECK ---
-    def verify_intruder(self, current_frame_rgb):
-        if self.ai_lock or len(self.authorized_users) == 0: return
-        self.ai_lock = True
+    def add_entry(self, filename, data, sha1=None):
+        """Crops and describes one photo and appends it to the manifest (None if it cannot be decoded)"""
+        described = self.describe_entry(filename, data, sha1)
+        return self.commit_entry(*described) if described is not None else None
+
+    def describe_entry(self, filename, data, sha1=None):
+        """-> (entry, cell, descriptor) without touching the index (None if it cannot be decoded)"""
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None: return None
+        cell, descriptor = self.crop_face(image)
+        entry = {"id": os.path.splitext(filename)[0], "file": filename, "added": time.time(),
+                 "sha1": sha1 or hashlib.sha1(data).hexdigest(), "face": descriptor is not None}
+        return entry, cell, descriptor
+
+    def commit_entry(self, entry, cell, descriptor):
+        self.enrollment = self.enrollment + [entry]
+        self.thumbs = np.concatenate([self.thumbs, cell[None]])
+        self.descriptors = np.concatenate([self.descriptors, (descriptor if descriptor is not None else np.zeros(LBP_DIM, np.float32))[None]])
+        return entry
+
+    def save_manifest(self):
+        try:
+            np.save(os.path.join(self.faces_dir, THUMBS_FILE), self.thumbs)
+            np.save(os.path.join(self.faces_dir, DESCRIPTORS_FILE), self.descriptors)
+            # Manifest last (and atomically): a crash in between leaves it out of sync -> rebuilt on load
+            tmp = os.path.join(self.faces_dir, MANIFEST_FILE + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(self.enrollment, f, indent=1)
+            os.replace(tmp, os.path.join(self.faces_dir, MANIFEST_FILE))
+        except OSError as e:
+            print(f"⚠️ Could not save enrollment manifest: {e}")
+
+    # --- ENROLLMENT JOBS (run on enroll_pool) ---
+    def enroll_image(self, image_bytes):
+        """Adds one photo incrementally -> train_result payload"""
+        sha1 = hashlib.sha1(image_bytes).hexdigest()
+        for entry in self.enrollment:
+            if entry["sha1"] == sha1:
+                print(f"ℹ️ Duplicate upload of {entry['file']}, skipped")
+                return {"type": "train_result", "success": True, "duplicate": True, "id": entry["id"]}
         
+        filename = f"user_{int(time.time())}.jpg"
+        n = 1
+        while os.path.exists(os.path.join(self.faces_dir, filename)): # Two uploads within one second
+            filename = f"user_{int(time.time())}_{n}.jpg"; n += 1
+        
+        described = self.describe_entry(filename, image_bytes, sha1)
+        if described is None:
+            print("❌ Error: Uploaded image could not be decoded")
+            return {"type": "train_result", "success": False}
+        # Photo on disk first: if that fails the index is untouched (no user that a restart would forget)
+        path = os.path.join(self.faces_dir, filename)
         try:
-            # 1. Current Room View
-            current_pil = Image.fromarray(current_frame_rgb)
-            
-            # 2. CREATE A COLLAGE OF AUTHORIZED USERS
-            user_images = [Image.open(io.BytesIO(b)) for b in self.authorized_users]
-            
-            if not user_images: return
+            with open(path, "wb") as f:
+                f.write(image_bytes)
+        except OSError as e:
+            print(f"❌ Error: Could not save {filename}: {e}")
+            if os.path.exists(path): os.remove(path) # Partial write (disk full)
+            return {"type": "train_result", "success": False}
+        entry = self.commit_entry(*described)
+        self.save_manifest() # Failure only costs a rebuild from the folder on the next start
+        self.publish_enrollment()
+        print(f"✅ Saved new user profile: {filename}")
+        return {"type": "train_result", "success": True, "duplicate": False, "id": entry["id"], "face_found": entry["face"]}
+
+    def reset_faces(self):
+        for f in os.listdir(self.faces_dir):
+            os.remove(os.path.join(self.faces_dir, f))
+        self.enrollment = []
+        self.thumbs, self.descriptors = self.thumbs[:0], self.descriptors[:0]
+        self.publish_enrollment()
+        print("🔄 All Authorized Users Deleted")
+
+    # --- REFERENCE COLLAGE (composed from the stored crops, never on the AI hot path) ---
+    def crop_face(self, image_bgr):
+        """Largest face with some margin as a COLLAGE_CELL square (center crop if no face is found),
+        plus its LBP descriptor (None without a face)"""
+        h, w = image_bgr.shape[:2]
+        scale = min(1.0, 480 / max(h, w)) # Phone selfies are large; detect on a small copy
+        small = cv2.resize(image_bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        faces = self.face_cascade.detectMultiScale(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 1.1, 5, minSize=(30, 30))
+        
+        descriptor = None
+        if len(faces) > 0:
+            x, y, fw, fh = [v / scale for v in max(faces, key=lambda f: f[2] * f[3])]
+            gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
+            descriptor = lbp_descriptor(square_crop(gray, (int(x), int(y), int(fw), int(fh))))
+            cx, cy = x + fw / 2, y + fh / 2
+            side = max(fw, fh) * 1.4
+        else:
+            cx, cy = w / 2, h / 2
+            side = min(w, h)
+        side = min(side, w, h)
+        x0 = int(min(max(0, cx - side / 2), w - side)); y0 = int(min(max(0, cy - side / 2), h - side))
+        crop = image_bgr[y0:y0+int(side), x0:x0+int(side)]
+        return cv2.resize(crop, (COLLAGE_CELL, COLLAGE_CELL), interpolation=cv2.INTER_AREA), descriptor
+
+    def compose_collage(self, cells):
+        if len(cells) == 0: return None
+        # Square-ish grid that never grows past COLLAGE_MAX_SIDE: more users -> smaller cells
+        cols = int(np.ceil(np.sqrt(len(cells)))); rows = int(np.ceil(len(cells) / cols))
+        cell = min(COLLAGE_CELL, COLLAGE_MAX_SIDE // cols)
+        collage = np.zeros((rows * cell, cols * cell, 3), dtype=np.uint8)
+        for i, face in enumerate(cells):
+            r, c = divmod(i, cols)
+            collage[r*cell:(r+1)*cell, c*cell:(c+1)*cell] = cv2.resize(face, (cell, cell), interpolation=cv2.INTER_AREA)
+        return collage
 
-            total_width = sum(img.width for img in user_images)
-            max_height = max(img.height for img in user_images)
+    # --- GEMINI CHECK ---
+    def verify_intruder(self, current_frame_rgb, track, now, generation, collage):
+        """Asks Gemini about one tracked person (on ai_pool, queued by verify_tracks); the verdict is cached on the track
+        and stamped with the time of the frame it was asked about (now), like every other track time.
+        generation/collage are the enrollment as it was when the check was queued."""
+        try:
+            if collage is None: return
+            
+            # 1. Close-up of the tracked person
+            current_pil = Image.fromarray(current_frame_rgb)
             
-            collage = Image.new('RGB', (total_width, max_height))
-            x_offset = 0
-            for img in user_images:
-                collage.paste(img, (x_offset, 0))
-                x_offset += img.width
+            # 2. COLLAGE OF AUTHORIZED USERS (prebuilt when the enrollment changed)
             
             # 3. ASK GEMINI
             prompt = """
             You are a CRITICAL SECURITY SYSTEM analyzing images for EXACT facial recognition matches.
             
             Image 1: Collage of ALL AUTHORIZED USERS (The Team) - These are the ONLY approved faces.
-            Image 2: CURRENT ROOM VIEW - You must identify if ANY of these exact people are present.
+            Image 2: CLOSE-UP OF A PERSON IN THE ROOM - You must identify if this is one of these exact people.
             
             STRICT COMPARISON RULES:
             1. Match facial features PRECISELY: eye shape, nose structure, facial proportions, jawline, and overall face geometry.
@@ -140,33 +547,44 @@ class RoomCamServer:
             }
             """
             
-            response = client.models.generate_content(
-                model='gemini-2.5-flash-lite',
-                contents=[prompt, collage, current_pil],
-                config=types.GenerateContentConfig(response_mime_type="application/json")
-            )
+            self.ai_calls += 1
+            with self.metrics.timer("gemini"):
+                response = self.ai_client.models.generate_content(
+                    model='gemini-2.5-flash-lite',
+                    contents=[prompt, collage, current_pil],
+                    config=types.GenerateContentConfig(response_mime_type="application/json")
+                )
             
             data = json.loads(response.text)
+            if generation != self.enrollment_generation:
+                # Enrollment changed while Gemini was thinking: the answer compares against the old team
+                # (a change after this check still clears the verdict on the next tracker update)
+                print(f"🤖 AI Analysis (person #{track.id}) discarded: enrollment changed")
+                track.last_ai_check = 0 # Ask again with the new collage
+                return
             
             if data['authorized_person_present']:
-                self.alert_status = "SECURE: AUTHORIZED USER DETECTED"
-                self.ai_message = "Authorized personnel on site"
+                track.set_verdict("authorized", "Authorized personnel on site", now)
             else:
-                self.alert_status = "🚨 ALERT: INTRUDER DETECTED"
-                self.ai_message = f"Unknown: {data['description']}"
+                track.set_verdict("intruder", f"Unknown: {data['description']}", now)
             
-            print(f"🤖 AI Analysis: Safe? {data['authorized_person_present']} ({data['confidence']})")
+            print(f"🤖 AI Analysis (person #{track.id}): Safe? {data['authorized_person_present']} ({data['confidence']})")
             
         except Exception as e:
             print(f"AI Error: {e}")
         finally:
-            self.ai_lock = False
+            self.ai_lock = False # Lets verify_tracks queue the next person
 
     async def handle_client(self, websocket):
         self.connected_clients.add(websocket)
+        self.publisher.add(websocket)
         try:
             async for message in websocket:
-                data = json.loads(message)
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    continue
+                if not isinstance(data, dict): continue # Commands are JSON objects
                 
                 # --- SINGLE IMAGE TRAINING (Reverted per request) ---
                 if data.get("command") == "train":
@@ -188,28 +606,27 @@ class RoomCamServer:
                         final_image_bytes = base64.b64decode(b64_str)
 
                     if final_image_bytes:
-                        # Save to disk
-                        filename = f"user_{int(time.time())}.jpg"
-                        path = os.path.join(self.faces_dir, filename)
-                        with open(path, "wb") as f:
-                            f.write(final_image_bytes)
-                        
-                        # Reload list
-                        self.load_authorized_faces()
-                        
-                        response = {"type": "train_result", "success": True}
+                        # Decode, crop, describe and save on the enroll executor; video keeps flowing
+                        loop = asyncio.get_running_loop()
+                        response = await loop.run_in_executor(self.enroll_pool, self.enroll_image, final_image_bytes)
                         await websocket.send(json.dumps(response))
-                        print(f"✅ Saved new user profile: {filename}")
                     else:
                         print("❌ Error: No valid image found")
                         response = {"type": "train_result", "success": False}
                         await websocket.send(json.dumps(response))
 
+                # Opt-in to binary video; clients that never say hello stay on the legacy JSON format
+                elif data.get("command") == "hello":
+                    await websocket.send(json.dumps(self.publisher.negotiate(websocket, data)))
+
+                elif data.get("command") == "metrics":
+                    await websocket.send(json.dumps({"type": "metrics", "stream_id": self.publisher.stream_id, **self.metrics.snapshot()}))
+
                 elif data.get("command") == "reset_faces":
-                    for f in os.listdir(self.faces_dir):
-                        os.remove(os.path.join(self.faces_dir, f))
-                    self.load_authorized_faces()
-                    print("🔄 All Authorized Users Deleted")
+                    await asyncio.get_running_loop().run_in_executor(self.enroll_pool, self.reset_faces)
+
+                elif self.recorder is not None:
+                    await self.recorder.handle_command(websocket, data, asyncio.get_running_loop())
 
         except websockets.exceptions.ConnectionClosed:
             pass
@@ -217,87 +634,156 @@ class RoomCamServer:
             print(f"Server Error: {e}")
         finally:
             self.connected_clients.remove(websocket)
+            self.publisher.remove(websocket)
 
-    async def broadcast(self, data):
-        if not self.connected_clients: return
-        msg = json.dumps(data)
-        websockets.broadcast(self.connected_clients, msg)
+    def verify_tracks(self, gray, frame, tracks, now):
+        """Local pre-filter for every person without a fresh verdict: obvious strangers are flagged
+        right away, everyone else is verified by Gemini (never authorized on a local match alone)"""
+        for track in tracks:
+            if not track.needs_verdict(now, self.verdict_ttl) or track.hits < 3: continue # 3 hits: ignore one-frame false positives
+            if now - track.last_local_check < 1.0: continue
+            track.last_local_check = now
+            
+            with self.metrics.timer("match"):
+                verdict, similarity = self.match_faces_locally(gray, [track.box])
+            if verdict == "stranger":
+                track.set_verdict("intruder", f"Unknown: no local match ({similarity:.2f})", now)
+            elif self.ai_client is None:
+                track.message = f"Unverified: no AI check available ({similarity:.2f})"
+            elif not self.ai_lock and now - track.last_ai_check > 15.0:
+                x, y, w, h = track.box
+                H, W = frame.shape[:2]
+                pad = max(w, h)
+                crop = frame[max(0, y - pad):min(H, y + h + pad), max(0, x - pad):min(W, x + w + pad)]
+                rgb_crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+                # Set here on the analysis thread, so a second person in the same frame waits for the next round
+                self.ai_lock = True
+                track.last_ai_check = now
+                job = (rgb_crop, track, now, self.enrollment_generation, self.collage)
+                if self.realtime: self.ai_pool.submit(self.verify_intruder, *job)
+                else: self.verify_intruder(*job)
 
-    async def run(self):
-        cap = cv2.VideoCapture(0)
-        print(f"\n✅ ROOM CAM SERVER ACTIVE (High Accuracy Detection)\n📡 Remote Control URL: ws://{get_local_ip()}:8766\n")
+    def room_status(self, tracks):
+        intruders = [t for t in tracks if t.verdict == "intruder"]
+        if intruders:
+            self.ai_message = intruders[0].message
+            return "🚨 ALERT: INTRUDER DETECTED"
+        if all(t.verdict == "authorized" for t in tracks):
+            return "SECURE: AUTHORIZED USER DETECTED"
+        return "VERIFYING VISITOR..."
+
+    def detect_faces(self, gray):
+        # 1. Frontal Face (Standard) - Lower ScaleFactor = More accurate but slower
+        faces_frontal = self.face_cascade.detectMultiScale(
+            gray, 
+            scaleFactor=1.1, 
+            minNeighbors=5, 
+            minSize=(30, 30)
+        )
         
-        while True:
-            await asyncio.sleep(0.01)
-            ret, frame = cap.read()
-            if not ret: break
-            
-            # --- IMPROVED DETECTION LOGIC ---
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            # 1. Frontal Face (Standard) - Lower ScaleFactor = More accurate but slower
-            faces_frontal = self.face_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.1, 
-                minNeighbors=5, 
-                minSize=(30, 30)
-            )
-            
-            # 2. Profile Face (Side View) - Catches you when you turn your head
-            faces_profile = self.profile_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.1, 
-                minNeighbors=5, 
-                minSize=(30, 30)
-            )
-            
-            # Combine detections
-            faces = []
-            if len(faces_frontal) > 0:
-                for f in faces_frontal: faces.append(f)
-            if len(faces_profile) > 0:
-                for f in faces_profile: faces.append(f)
-                
-            face_found = len(faces) > 0
-            
-            # Draw Boxes
-            for (x, y, w, h) in faces:
-                cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 0, 0), 2)
-
-            # AI Logic
-            if len(self.authorized_users) == 0:
-                 pass 
-            elif face_found:
-                if time.time() - self.last_ai_check > 15.0:
-                    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    threading.Thread(target=self.verify_intruder, args=(rgb_frame,)).start()
-                    self.last_ai_check = time.time()
-            else:
-                self.alert_status = "SCANNING ROOM..."
+        # 2. Profile Face (Side View) - Catches you when you turn your head
+        faces_profile = self.profile_cascade.detectMultiScale(
+            gray, 
+            scaleFactor=1.1, 
+            minNeighbors=5, 
+            minSize=(30, 30)
+        )
+        
+        # Combine detections (the same face is often hit by both cascades)
+        faces = []
+        if len(faces_frontal) > 0:
+            for f in faces_frontal: faces.append(tuple(int(v) for v in f))
+        if len(faces_profile) > 0:
+            for f in faces_profile: faces.append(tuple(int(v) for v in f))
+        return suppress_duplicates(faces)
 
-            final_status = self.alert_status
-            if self.ai_message and "ALERT" in self.alert_status:
-                final_status = f"{self.alert_status} | {self.ai_message}"
+    def match_faces_locally(self, gray, faces):
+        if len(self.face_index) == 0: return "ambiguous", 0.0
+        crops = [square_crop(gray, f) for f in faces]
+        return self.face_index.classify([lbp_descriptor(c) for c in crops if c.size > 0])
 
-            small_frame = cv2.resize(frame, (400, 300))
-            _, buffer = cv2.imencode('.jpg', small_frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-            b64_video = base64.b64encode(buffer).decode('utf-8')
-            
-            payload = {
-                "status": final_status,
-                "video": b64_video,
-                "faces_detected": len(faces)
-            }
-            await self.broadcast(payload)
-            
-            cv2.imshow("Room Cam (Laptop)", frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'): break
-            
-        cap.release()
-        cv2.destroyAllWindows()
+    # --- ANALYSIS STAGE (runs on the analysis executor, never on the event loop) ---
+    def analyze_frame(self, frame, frame_time):
+        # --- IMPROVED DETECTION LOGIC ---
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        H, W = gray.shape[:2]
+        
+        # --- MOTION GATE --- cascades only run where something moved (plus a periodic full scan)
+        motion_regions = self.motion_gate.update(gray)
+        if self.motion_gate.full_scan_due(frame_time) or sum(w * h for (_, _, w, h) in motion_regions) > 0.6 * W * H:
+            with self.metrics.timer("detect"):
+                faces = self.detect_faces(gray)
+        elif motion_regions:
+            # Faces outside every motion box have not moved; re-detect only inside the boxes
+            faces = [f for f in self.last_faces if not any(boxes_overlap(f, r) for r in motion_regions)]
+            with self.metrics.timer("detect"):
+                for (x, y, w, h) in motion_regions:
+                    for (fx, fy, fw, fh) in self.detect_faces(gray[y:y+h, x:x+w]):
+                        faces.append((fx + x, fy + y, fw, fh))
+        else:
+            faces = self.last_faces # Nothing moved: the scene (and whoever is in it) is unchanged
+            self.metrics.count("detect_skipped")
+        faces = suppress_duplicates(faces) # Carried-over boxes vs fresh hits at the edge of a motion box
+        self.last_faces = faces
+        tracks = self.tracker.update(faces, frame_time)
+        
+        # AI Logic (one verdict per person, re-checked only after VERDICT_TTL)
+        if len(self.authorized_users) == 0:
+             pass 
+        elif tracks:
+            self.verify_tracks(gray, frame, tracks, frame_time)
+            self.alert_status = self.room_status(tracks)
+        else:
+            self.alert_status = "SCANNING ROOM..."
+        
+        # Draw Boxes (on a copy, and only if someone will see them)
+        if self.show_preview or self.connected_clients:
+            frame = frame.copy()
+            for t in tracks:
+                x, y, w, h = t.box
+                color = (0, 200, 0) if t.verdict == "authorized" else (0, 0, 255) if t.verdict == "intruder" else (255, 0, 0)
+                cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
+                cv2.putText(frame, f"#{t.id}", (x, max(12, y - 5)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+
+        final_status = self.alert_status
+        if self.ai_message and "ALERT" in self.alert_status:
+            final_status = f"{self.alert_status} | {self.ai_message}"
+
+        # Motion boxes as fractions of the frame so they line up with any video tier
+        regions = [[round(x / W, 3), round(y / H, 3), round(w / W, 3), round(h / H, 3)] for (x, y, w, h) in motion_regions]
+        people = [{"id": t.id, "box": [round(t.box[0] / W, 3), round(t.box[1] / H, 3), round(t.box[2] / W, 3), round(t.box[3] / H, 3)],
+                   "status": t.verdict or "pending", "message": t.message} for t in tracks]
+        return {"preview": frame, "time": frame_time, "status": final_status, "faces_detected": len(faces), "motion_regions": regions, "tracks": people}
+
+    # --- ENCODE STAGE (runs on the encode executor) ---
+    def encode_frame(self, result, tiers):
+        return encode_tiers(result["preview"], tiers)
+
+    def frame_meta(self, result):
+        # Legacy payload minus "video" (the publisher adds it in the client's format)
+        return {
+            "status": result["status"],
+            "faces_detected": result["faces_detected"],
+            "motion_regions": result["motion_regions"],
+            "tracks": result["tracks"]
+        }
+
+    # --- PIPELINE HOOKS (the loop itself is pipeline.StagedLoop) ---
+    def shed_work(self, scheduler):
+        # Under load, full-frame cascade scans (outside motion regions) get rarer
+        self.motion_gate.full_scan_every = FULL_SCAN_EVERY * 3 if scheduler.shed("detection") else FULL_SCAN_EVERY
+
+    async def run(self):
+        print(f"\n✅ ROOM CAM SERVER ACTIVE (High Accuracy Detection)\n📡 Remote Control URL: ws://{get_local_ip()}:8766\n")
+        try:
+            await self.pipeline.run()
+        finally:
+            self.enroll_pool.shutdown(wait=False)
+            self.ai_pool.shutdown(wait=False)
 
 async def main():
-    server = RoomCamServer()
+    server = RoomCamServer(headless=HEADLESS, idle_fps=IDLE_FPS, video_source=VIDEO_SOURCE, metrics=METRICS, metrics_port=METRICS_PORT,
+                           recording=RECORDING)
     async with websockets.serve(server.handle_client, "0.0.0.0", 8766):
         await server.run()
 
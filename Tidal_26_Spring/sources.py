@@ -0,0 +1,238 @@
+import os
+import cv2
+import time
+import wave
+import numpy as np
+
+# --- VIDEO SOURCES ---
+# Everything FrameGrabber opens looks like a cv2.VideoCapture: grab() / retrieve() / read() / release().
+# Non-camera sources also report fps and the (virtual) timestamp of the last frame, so a replay can
+# run faster than real time with the same timestamps every run.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class VideoFileSource:
+    def __init__(self, path, realtime=True, loop=False):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened(): raise IOError(f"Cannot open video {path}")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.realtime = realtime # Paced at the file's frame rate (live stand-in) or as fast as it decodes
+        self.loop = loop
+        self.index = -1
+        self.frame_time = 0.0
+        self.next_due = 0
+
+    def grab(self):
+        if self.realtime:
+            delay = self.next_due - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            self.next_due = max(self.next_due, time.monotonic() - 1.0) + 1.0 / self.fps
+        ok = self.cap.grab()
+        if not ok and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok = self.cap.grab()
+        if ok:
+            self.index += 1
+            self.frame_time = self.index / self.fps
+        return ok
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+    def read(self):
+        if not self.grab(): return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.cap.release()
+
+class ImageDirectorySource:
+    """Sorted still images played back as a clip"""
+    def __init__(self, path, fps=10.0, realtime=True, loop=False):
+        self.files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.files: raise IOError(f"No images in {path}")
+        self.fps = fps
+        self.realtime = realtime
+        self.loop = loop
+        self.index = -1
+        self.frame_time = 0.0
+        self.next_due = 0
+
+    def grab(self):
+        if self.index + 1 >= len(self.files) and not self.loop: return False
+        if self.realtime:
+            delay = self.next_due - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            self.next_due = max(self.next_due, time.monotonic() - 1.0) + 1.0 / self.fps
+        self.index += 1
+        self.frame_time = self.index / self.fps
+        return True
+
+    def retrieve(self):
+        frame = cv2.imread(self.files[self.index % len(self.files)])
+        return frame is not None, frame
+
+    def read(self):
+        if not self.grab(): return False, None
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+class SyntheticSource:
+    """Generated scene with known vitals: a face photo whose green channel pulses at hr_bpm and a
+    textured chest that rises and falls at rr_rpm. Without a face photo only the chest is drawn."""
+    def __init__(self, hr_bpm=120.0, rr_rpm=30.0, fps=10.0, size=(640, 480), face=None, frames=None,
+                 pulse_amplitude=1.5, breath_amplitude=2.0, noise=2.0, seed=0, realtime=True):
+        self.hr_bpm = hr_bpm
+        self.rr_rpm = rr_rpm
+        self.fps = fps
+        self.frames = frames # None = endless
+        self.pulse_amplitude = pulse_amplitude   # Grey levels added to the face's green channel
+        self.breath_amplitude = breath_amplitude # Pixels of chest travel
+        self.noise = noise
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.index = -1
+        self.frame_time = 0.0
+        self.next_due = 0
+
+        W, H = size
+        self.background = np.full((H, W, 3), 90, dtype=np.uint8)
+        self.face = None
+        if face is not None:
+            self.face = cv2.resize(load_face_patch(face), (H * 3 // 8, H * 3 // 8)).astype(np.float32)
+        side = H * 3 // 8
+        self.face_pos = ((W - side) // 2, H // 10)
+        # Chest texture (blobs give goodFeaturesToTrack corners), a little taller than where it is drawn
+        cw, ch = side * 3 // 2, side * 3 // 4
+        self.chest_pos = ((W - cw) // 2, self.face_pos[1] + side + side // 6)
+        texture = cv2.GaussianBlur(self.rng.integers(40, 220, (ch // 8 + 2, cw // 8 + 2), dtype=np.uint8), (3, 3), 0)
+        self.chest = cv2.resize(texture, (cw, ch + 16), interpolation=cv2.INTER_NEAREST)
+        self.chest = cv2.cvtColor(self.chest, cv2.COLOR_GRAY2BGR)
+        self.frame = None
+
+    def grab(self):
+        if self.frames is not None and self.index + 1 >= self.frames: return False
+        if self.realtime:
+            delay = self.next_due - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            self.next_due = max(self.next_due, time.monotonic() - 1.0) + 1.0 / self.fps
+        self.index += 1
+        self.frame_time = self.index / self.fps
+        return True
+
+    def retrieve(self):
+        t = self.frame_time
+        frame = self.background.copy()
+
+        # Chest: the texture slides vertically (sub-pixel) with the breathing phase
+        cx, cy = self.chest_pos
+        ch, cw = self.chest.shape[0] - 16, self.chest.shape[1]
+        shift = 8 + self.breath_amplitude * np.sin(2 * np.pi * self.rr_rpm / 60 * t)
+        m = np.float32([[1, 0, 0], [0, 1, -shift]])
+        frame[cy:cy+ch, cx:cx+cw] = cv2.warpAffine(self.chest, m, (cw, ch), flags=cv2.INTER_LINEAR)
+
+        if self.face is not None:
+            fx, fy = self.face_pos
+            face = self.face.copy()
+            face[:, :, 1] += self.pulse_amplitude * np.sin(2 * np.pi * self.hr_bpm / 60 * t)
+            s = face.shape[0]
+            frame[fy:fy+s, fx:fx+s] = np.clip(face, 0, 255).astype(np.uint8)
+
+        if self.noise:
+            frame = np.clip(frame + self.rng.normal(0, self.noise, frame.shape), 0, 255).astype(np.uint8)
+        return True, frame
+
+    def read(self):
+        if not self.grab(): return False, None
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+def load_face_patch(path):
+    """Square crop around the largest face in a photo (the whole photo if no face is found)"""
+    image = cv2.imread(path)
+    if image is None: raise IOError(f"Cannot read {path}")
+    h, w = image.shape[:2]
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    faces = cascade.detectMultiScale(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 1.1, 5, minSize=(30, 30))
+    if len(faces) == 0: return image
+    x, y, fw, fh = max(faces, key=lambda f: f[2] * f[3])
+    side = min(int(max(fw, fh) * 1.4), w, h)
+    x0 = min(max(0, x + fw // 2 - side // 2), w - side); y0 = min(max(0, y + fh // 2 - side // 2), h - side)
+    return image[y0:y0+side, x0:x0+side]
+
+def parse_options(spec):
+    """"synthetic:hr=120,rr=30" -> ("synthetic", {"hr": "120", "rr": "30"})"""
+    kind, _, rest = spec.partition(":")
+    options = dict(item.split("=", 1) for item in rest.split(",") if "=" in item)
+    return kind, options
+
+def open_video_source(spec, realtime=True):
+    """0 / "0" -> camera, "synthetic[:hr=..,rr=..,fps=..,face=..]", a folder of images, or a video file"""
+    if isinstance(spec, int) or (isinstance(spec, str) and spec.isdigit()):
+        return cv2.VideoCapture(int(spec))
+    if not isinstance(spec, str): return spec # Already a source object
+    kind, options = parse_options(spec)
+    if kind == "synthetic":
+        return SyntheticSource(hr_bpm=float(options.get("hr", 120)), rr_rpm=float(options.get("rr", 30)),
+                               fps=float(options.get("fps", 10)), face=options.get("face"), realtime=realtime)
+    if os.path.isdir(spec):
+        return ImageDirectorySource(spec, realtime=realtime)
+    return VideoFileSource(spec, realtime=realtime)
+
+# --- AUDIO SOURCES --- read(n) returns up to n float32 samples in [-1, 1] (None when exhausted)
+class WavSource:
+    def __init__(self, path, loop=False):
+        with wave.open(path, "rb") as f:
+            self.samplerate = f.getframerate()
+            channels = f.getnchannels(); width = f.getsampwidth()
+            raw = f.readframes(f.getnframes())
+        if width != 2: raise ValueError("Only 16-bit WAV files are supported")
+        self.samples = np.frombuffer(raw, dtype=np.int16).reshape(-1, channels)[:, 0].astype(np.float32) / 32768
+        self.loop = loop
+        self.pos = 0
+
+    def read(self, n):
+        if self.pos >= len(self.samples):
+            if not self.loop: return None
+            self.pos = 0
+        out = self.samples[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+class ToneSource:
+    """Synthetic audio: "quiet" (room noise), "cry" (bursts of a 450 Hz harmonic wail) or "speech"-like low hum"""
+    def __init__(self, kind="quiet", samplerate=16000, seconds=None, seed=0):
+        self.kind = kind
+        self.samplerate = samplerate
+        self.total = int(seconds * samplerate) if seconds else None
+        self.rng = np.random.default_rng(seed)
+        self.pos = 0
+
+    def read(self, n):
+        if self.total is not None:
+            n = min(n, self.total - self.pos)
+            if n <= 0: return None
+        t = (self.pos + np.arange(n)) / self.samplerate
+        self.pos += n
+        out = self.rng.normal(0, 0.003, n)
+        if self.kind == "cry":
+            f0 = 450 + 30 * np.sin(2 * np.pi * 3 * t)
+            phase = 2 * np.pi * np.cumsum(f0) / self.samplerate
+            wail = sum(np.sin(k * phase) / k for k in (1, 2, 3))
+            out += 0.3 * wail * ((t % 1.2) < 0.9) # Cry, short breath, cry again
+        elif self.kind == "speech":
+            out += 0.1 * np.sin(2 * np.pi * 140 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t))
+        return out.astype(np.float32)
+
+def open_audio_source(spec, samplerate=16000):
+    """None -> default microphone (sounddevice), "synthetic:cry|quiet|speech" or a .wav file"""
+    if spec is None or not isinstance(spec, str): return spec
+    kind, _, rest = spec.partition(":")
+    if kind == "synthetic":
+        return ToneSource(rest or "quiet", samplerate=samplerate)
+    source = WavSource(spec, loop=True)
+    if source.samplerate != samplerate: raise ValueError(f"{spec} is {source.samplerate} Hz, expected {samplerate} Hz")
+    return source
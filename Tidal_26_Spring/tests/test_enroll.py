@@ -0,0 +1,67 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import roomcam
+
+FACES = os.path.join(ROOT, "authorized_faces")
+
+class ServerCase(unittest.TestCase):
+    """RoomCamServer in a scratch folder, with one face photo to enroll"""
+    def setUp(self):
+        photos = sorted(f for f in os.listdir(FACES) if f.endswith(".jpg")) if os.path.isdir(FACES) else []
+        if not photos: self.skipTest("needs a face photo in authorized_faces/")
+        with open(os.path.join(FACES, photos[0]), "rb") as f:
+            self.photo = f.read()
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp) # The server keeps its faces in ./authorized_faces
+        self.server = roomcam.RoomCamServer(headless=True, realtime=False)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        for pool in (self.server.enroll_pool, self.server.ai_pool, self.server.analysis_pool, self.server.encode_pool):
+            pool.shutdown(wait=False)
+
+class EnrollWriteFailureTest(ServerCase):
+    def test_disk_full_leaves_no_phantom_user(self):
+        real_open = open
+        def failing_open(path, mode="r", *args, **kwargs):
+            if str(path).endswith(".jpg") and "w" in mode: raise OSError(28, "No space left on device")
+            return real_open(path, mode, *args, **kwargs)
+        with mock.patch("builtins.open", failing_open):
+            result = self.server.enroll_image(self.photo)
+        self.assertEqual(result, {"type": "train_result", "success": False})
+        self.assertEqual(self.server.enrollment, [])
+        self.assertEqual(len(self.server.descriptors), 0)
+        self.assertEqual(os.listdir(self.server.faces_dir), [])
+
+    def test_enrolled_user_survives_restart(self):
+        result = self.server.enroll_image(self.photo)
+        self.assertTrue(result["success"])
+        restarted = roomcam.RoomCamServer(headless=True, realtime=False)
+        self.assertEqual([entry["id"] for entry in restarted.enrollment], [result["id"]])
+
+class EnrollDuringGeminiTest(ServerCase):
+    def test_answer_about_old_collage_is_discarded(self):
+        self.server.enroll_image(self.photo)
+        track = roomcam.FaceTrack(1, (100, 100, 80, 80), 0.0)
+        def generate_content(**kwargs):
+            self.server.publish_enrollment() # Someone enrolled while the request was in flight
+            return SimpleNamespace(text='{"authorized_person_present": false, "confidence": "HIGH", "description": "x"}')
+        self.server.ai_client = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+        self.server.verify_intruder(np.zeros((120, 120, 3), np.uint8), track, 20.0,
+                                    self.server.enrollment_generation, self.server.collage)
+        self.assertIsNone(track.verdict)
+        self.assertFalse(self.server.ai_lock)
+
+if __name__ == "__main__":
+    unittest.main()
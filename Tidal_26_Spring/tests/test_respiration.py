@@ -0,0 +1,46 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import babycam
+from sources import SyntheticSource
+
+FACES = os.path.join(ROOT, "authorized_faces")
+
+class DenseFaceLostTest(unittest.TestCase):
+    def setUp(self):
+        photos = sorted(f for f in os.listdir(FACES) if f.endswith(".jpg")) if os.path.isdir(FACES) else []
+        if not photos: self.skipTest("needs a face photo in authorized_faces/")
+        self.video = SyntheticSource(face=os.path.join(FACES, photos[0]), realtime=False)
+        self.server = babycam.NannyCamServer(headless=True, video_source=self.video, realtime=False, respiration_mode="dense")
+
+    def tearDown(self):
+        self.server.analysis_pool.shutdown(wait=False)
+        self.server.encode_pool.shutdown(wait=False)
+
+    def run_frames(self, seconds, frame_for=None):
+        statuses = []
+        for _ in range(int(seconds * self.video.fps)):
+            ok, frame = self.video.read()
+            if frame_for is not None: frame = frame_for(frame)
+            statuses.append(self.server.analyze_frame(frame, self.video.frame_time)["status"])
+        return statuses
+
+    def test_baby_picked_up_is_not_rolled_over(self):
+        statuses = self.run_frames(5.0)
+        self.assertIn("SAFE", statuses)
+        empty_crib = lambda frame: np.clip(self.video.background + np.random.normal(0, 2, frame.shape), 0, 255).astype(np.uint8)
+        statuses = self.run_frames(5.0, empty_crib)
+        self.assertNotIn("ALERT: ROLLED OVER", statuses)
+
+    def test_face_hidden_with_body_present_is_rolled_over(self):
+        self.run_frames(5.0)
+        self.video.face = None # Face turned into the mattress, chest still in view
+        statuses = self.run_frames(5.0)
+        self.assertEqual(statuses[-1], "ALERT: ROLLED OVER")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from babycam import RingBuffer
+from transport import VideoPublisher
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+class WaveDeltaTest(unittest.TestCase):
+    def stream(self, steps):
+        """Runs steps (callables on the ring) and publishes after each; returns the "hr" wave field per frame"""
+        async def run():
+            publisher = VideoPublisher()
+            ring = RingBuffer(300)
+            socket = FakeSocket()
+            publisher.negotiate(socket, {"waves": "delta"})
+            waves = []
+            for t, step in enumerate(steps):
+                step(ring, t)
+                publisher.publish({1: b"jpeg"}, {"type": "vitals"}, float(t), {"hr": (ring.total, ring.tail(60)[0])})
+                await asyncio.sleep(0.01) # Let the sender drain the queue
+                waves.append(json.loads(socket.sent[-1]).get("waves", {}).get("hr"))
+            publisher.remove(socket)
+            return waves
+        return asyncio.run(run())
+
+    def test_first_frame_is_snapshot_then_deltas(self):
+        add = lambda ring, t: [ring.append(t + i / 10, t + i / 10) for i in range(3)]
+        waves = self.stream([add, add, add])
+        self.assertTrue(waves[0]["snapshot"])
+        self.assertEqual([w["snapshot"] for w in waves[1:]], [False, False])
+        self.assertEqual(waves[2]["seq"], 6)
+
+    def test_clear_mid_stream_sends_snapshot(self):
+        add = lambda ring, t: [ring.append(t + i / 10, t + i / 10) for i in range(3)]
+        def clear_and_add(ring, t):
+            ring.clear() # Respiration tracking lost: new baseline
+            add(ring, t)
+        waves = self.stream([add, add, clear_and_add, add])
+        self.assertFalse(waves[1]["snapshot"])
+        self.assertTrue(waves[2]["snapshot"])
+        self.assertFalse(waves[3]["snapshot"])
+        self.assertEqual(waves[3]["seq"], waves[2]["seq"] + 3)
+
+if __name__ == "__main__":
+    unittest.main()
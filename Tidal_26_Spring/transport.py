@@ -0,0 +1,265 @@
+import cv2
+import json
+import time
+import struct
+import base64
+import asyncio
+import websockets
+import numpy as np
+from pipeline import put_latest
+from audio_codec import CODECS, DEFAULT_CODEC, encode_audio
+
+# --- WIRE FORMAT ---
+# Clients start in the legacy format (base64 JPEG inside the JSON payload).
+# Sending {"command": "hello", "protocol": "binary"} switches a client to:
+#   - one binary WebSocket message per video frame: FRAME_HEADER + JPEG bytes
+#   - one small JSON message per frame with vitals/status and the same "seq"
+#   - audio as binary messages (KIND_AUDIO) in "audio_codec" (see audio_codec.CODECS)
+# "hello" may also carry "tier": "high" | "medium" | "low" to pin a quality tier.
+# "hello" with "waves": "delta" replaces the full hr_wave/rr_wave lists in every frame with only the
+# samples added since the client's previous message (a snapshot of the window first):
+#   - binary clients: one KIND_WAVE message per graph, FRAME_HEADER (seq = first sample number) +
+#     WAVE_HEADER + little-endian int16 samples, value = offset + scale * sample
+#   - legacy clients: "waves": {"hr": {"seq", "snapshot", "offset", "scale", "data": base64 int16}}
+#   "snapshot": true means "replace the graph" (first message, or samples were lost in between)
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_BINARY = "binary"
+
+KIND_VIDEO = 1
+KIND_AUDIO = 2
+KIND_WAVE = 3
+
+# kind (u8), stream id (u8), sequence number (u32), capture timestamp in ms (u64) -> 14 bytes, network order
+FRAME_HEADER = struct.Struct("!BBIQ")
+# wave id (u8, index in WAVES), snapshot flag (u8), offset (f64), scale (f64) -> 18 bytes
+WAVE_HEADER = struct.Struct("!BBdd")
+WAVES = ("hr", "rr")
+
+# --- QUALITY TIERS --- (index 0 is the best; "medium" is the original 400x300 @ q50 stream)
+QUALITY_TIERS = [
+    {"name": "high", "size": (640, 480), "quality": 70},
+    {"name": "medium", "size": (400, 300), "quality": 50},
+    {"name": "low", "size": (240, 180), "quality": 35},
+]
+DEFAULT_TIER = 1
+
+SLOW_SEND = 0.15     # Smoothed send time (s) above which a client drops one tier
+FAST_SEND = 0.03     # ... and below which it may climb back up
+UPGRADE_AFTER = 30   # Consecutive fast sends needed before climbing a tier
+DROPS_TO_DOWNGRADE = 3 # Frames dropped without a reasonably fast send in between
+TIER_COOLDOWN = 2.0  # Seconds between tier changes for one client
+
+def pack_frame(kind, stream_id, seq, timestamp, body):
+    return FRAME_HEADER.pack(kind, stream_id, seq & 0xFFFFFFFF, int(timestamp * 1000)) + bytes(body)
+
+def unpack_frame(data):
+    """Returns (kind, stream_id, seq, timestamp, body) for a binary message"""
+    kind, stream_id, seq, ts_ms = FRAME_HEADER.unpack_from(data)
+    return kind, stream_id, seq, ts_ms / 1000.0, data[FRAME_HEADER.size:]
+
+def quantize_wave(values):
+    """float samples -> (offset, scale, int16 bytes) spanning the chunk's own range"""
+    if len(values) == 0: return 0.0, 1.0, b""
+    lo, hi = float(np.min(values)), float(np.max(values))
+    offset = (lo + hi) / 2
+    scale = (hi - lo) / 65534 or 1.0
+    return offset, scale, np.round((values - offset) / scale).astype("<i2").tobytes()
+
+def encode_tiers(frame, tiers):
+    """JPEG-encodes frame once per requested tier index -> {tier: bytes}"""
+    jpegs = {}
+    for tier in sorted(tiers):
+        spec = QUALITY_TIERS[tier]
+        small_frame = cv2.resize(frame, spec["size"], interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', small_frame, [int(cv2.IMWRITE_JPEG_QUALITY), spec["quality"]])
+        jpegs[tier] = buffer.tobytes()
+    return jpegs
+
+class ClientSession:
+    def __init__(self, websocket, tier=DEFAULT_TIER):
+        self.websocket = websocket
+        self.protocol = PROTOCOL_LEGACY
+        self.audio_codec = DEFAULT_CODEC
+        self.tier = tier
+        self.auto_tier = True
+        self.waves = False                    # Incremental graphs ("waves": "delta" in hello)
+        self.wave_pos = {}                    # Samples per graph already queued for this client (none -> snapshot)
+        self.wave_queued = {}                 # ... where the message still waiting in the queue started
+        self.queue = asyncio.Queue(maxsize=1) # Only the newest frame waits; older ones are dropped
+        self.send_time = 0.0                  # Smoothed seconds per frame send
+        self.fast_sends = 0
+        self.recent_drops = 0
+        self.dropped = 0
+        self.last_tier_change = time.monotonic()
+        self.task = None
+
+class VideoPublisher:
+    """Per-client send queues with frame dropping and automatic quality tiers"""
+    def __init__(self, stream_id=0, meta_type="vitals"):
+        self.stream_id = stream_id
+        self.meta_type = meta_type # "type" of the JSON message that accompanies binary frames
+        self.sessions = {}
+        self.seq = 0
+        self.audio_seq = 0
+
+    def add(self, websocket):
+        session = ClientSession(websocket)
+        session.task = asyncio.create_task(self._sender(session))
+        self.sessions[websocket] = session
+        return session
+
+    def remove(self, websocket):
+        session = self.sessions.pop(websocket, None)
+        if session is not None and session.task is not None:
+            session.task.cancel()
+
+    def negotiate(self, websocket, request):
+        """Handles a "hello" command and returns the reply for the client"""
+        session = self.sessions.get(websocket) or self.add(websocket)
+        protocol = request.get("protocol", PROTOCOL_LEGACY)
+        session.protocol = PROTOCOL_BINARY if protocol == PROTOCOL_BINARY else PROTOCOL_LEGACY
+
+        if request.get("audio_codec") in CODECS:
+            session.audio_codec = request["audio_codec"]
+
+        names = [spec["name"] for spec in QUALITY_TIERS]
+        if request.get("tier") in names:
+            session.tier = names.index(request["tier"])
+            session.auto_tier = False
+
+        if "waves" in request:
+            session.waves = request["waves"] == "delta"
+            session.wave_pos = {} # Starts with a snapshot
+
+        return {"type": "hello", "protocol": session.protocol, "stream_id": self.stream_id,
+                "header": FRAME_HEADER.format, "tier": QUALITY_TIERS[session.tier]["name"], "tiers": names,
+                "audio_codec": session.audio_codec, "audio_rate": CODECS[session.audio_codec],
+                "waves": "delta" if session.waves else "full", "wave_header": WAVE_HEADER.format, "wave_ids": list(WAVES)}
+
+    def stats(self):
+        """Gauges for metrics: connected clients, frames waiting in send queues, frames dropped per client"""
+        sessions = list(self.sessions.values())
+        stats = {"clients": len(sessions), "send_queue_depth": sum(s.queue.qsize() for s in sessions),
+                 "client_frames_dropped": sum(s.dropped for s in sessions)}
+        for i, spec in enumerate(QUALITY_TIERS):
+            stats[f"clients_{spec['name']}"] = sum(1 for s in sessions if s.tier == i)
+        return stats
+
+    def active_tiers(self):
+        """Tiers that at least one client is currently on (only these get encoded)"""
+        return {session.tier for session in self.sessions.values()}
+
+    def publish(self, jpegs, meta, timestamp, waves=None):
+        """jpegs is {tier: bytes} from encode_tiers; meta is the legacy payload without "video";
+        waves is {name: (samples ever added, newest samples)} for the graphs"""
+        self.seq += 1
+        waves = waves or {}
+        legacy_messages = {}
+        binary_meta = {}
+        wave_parts = {} # Clients at the same graph position share one encoding
+
+        for session in self.sessions.values():
+            jpeg = jpegs.get(session.tier)
+            if jpeg is None: # Tier changed after encoding, or the server is shedding tiers: cheapest one there is
+                if not jpegs: continue
+                jpeg = jpegs[max(jpegs)]
+
+            key = self._wave_key(session, waves)
+            if key not in wave_parts: wave_parts[key] = self._wave_parts(waves, key, timestamp)
+            fields, wave_frames = wave_parts[key]
+
+            if session.protocol == PROTOCOL_BINARY:
+                full = key is None
+                if full not in binary_meta:
+                    message = dict(meta)
+                    if full: message.update(fields)
+                    message.update({"type": self.meta_type, "seq": self.seq, "stream_id": self.stream_id})
+                    binary_meta[full] = json.dumps(message)
+                messages = [pack_frame(KIND_VIDEO, self.stream_id, self.seq, timestamp, jpeg), binary_meta[full]] + wave_frames
+            else:
+                if (session.tier, key) not in legacy_messages:
+                    payload = dict(meta)
+                    payload.update(fields)
+                    payload["video"] = base64.b64encode(jpeg).decode('utf-8')
+                    legacy_messages[(session.tier, key)] = json.dumps(payload)
+                messages = [legacy_messages[(session.tier, key)]]
+
+            if put_latest(session.queue, messages):
+                session.dropped += 1
+                session.recent_drops += 1
+                self._adapt(session, None)
+
+    def _wave_key(self, session, waves):
+        if not session.waves: return None
+        # A message still waiting in the queue is about to be replaced: the new one starts where it started
+        start = session.wave_queued if session.queue.full() else session.wave_pos
+        session.wave_queued = start
+        session.wave_pos = {name: total for name, (total, _) in waves.items()}
+        return tuple((name, start.get(name)) for name in waves)
+
+    def _wave_parts(self, waves, key, timestamp):
+        """(JSON fields, binary messages) carrying the graphs for clients at position key"""
+        if key is None:
+            return {f"{name}_wave": values.tolist() for name, (_, values) in waves.items()}, []
+        fields = {}
+        frames = []
+        for name, start in key:
+            total, values = waves[name]
+            available = total - len(values) # Number of the oldest sample still in the window
+            snapshot = start is None or start < available
+            first = available if snapshot else start
+            samples = values[first - available:]
+            if len(samples) == 0 and not snapshot: continue
+            offset, scale, data = quantize_wave(samples)
+            fields[name] = {"seq": first, "snapshot": snapshot, "offset": offset, "scale": scale,
+                            "data": base64.b64encode(data).decode('utf-8')}
+            frames.append(pack_frame(KIND_WAVE, self.stream_id, first, timestamp, WAVE_HEADER.pack(WAVES.index(name), snapshot, offset, scale) + data))
+        return ({"waves": fields} if fields else {}), frames
+
+    def publish_audio(self, parts, timestamp):
+        """parts are int16 PCM views; each codec is encoded at most once per chunk"""
+        self.audio_seq += 1
+        legacy = [session.websocket for session in self.sessions.values() if session.protocol == PROTOCOL_LEGACY]
+        if legacy:
+            pcm = encode_audio(parts, "pcm16")
+            payload = {"type": "audio", "audio": base64.b64encode(pcm).decode('utf-8')}
+            websockets.broadcast(legacy, json.dumps(payload))
+
+        by_codec = {}
+        for session in self.sessions.values():
+            if session.protocol == PROTOCOL_BINARY:
+                by_codec.setdefault(session.audio_codec, []).append(session.websocket)
+        for codec, clients in by_codec.items():
+            body = encode_audio(parts, codec)
+            websockets.broadcast(clients, pack_frame(KIND_AUDIO, self.stream_id, self.audio_seq, timestamp, body))
+
+    async def _sender(self, session):
+        try:
+            while True:
+                messages = await session.queue.get()
+                start = time.monotonic()
+                for message in messages:
+                    await session.websocket.send(message)
+                self._adapt(session, time.monotonic() - start)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def _adapt(self, session, elapsed):
+        if elapsed is not None:
+            session.send_time = elapsed if session.send_time == 0 else 0.8 * session.send_time + 0.2 * elapsed
+            session.fast_sends = session.fast_sends + 1 if session.send_time < FAST_SEND else 0
+            if session.send_time < SLOW_SEND: session.recent_drops = 0
+        if not session.auto_tier: return
+        if time.monotonic() - session.last_tier_change < TIER_COOLDOWN: return
+
+        if (session.send_time > SLOW_SEND or session.recent_drops >= DROPS_TO_DOWNGRADE) and session.tier < len(QUALITY_TIERS) - 1:
+            self._set_tier(session, session.tier + 1)
+        elif session.fast_sends >= UPGRADE_AFTER and session.tier > 0:
+            self._set_tier(session, session.tier - 1)
+
+    def _set_tier(self, session, tier):
+        session.tier = tier
+        session.send_time = 0.0
+        session.fast_sends = 0
+        session.recent_drops = 0
+        session.last_tier_change = time.monotonic()
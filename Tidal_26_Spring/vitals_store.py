@@ -0,0 +1,268 @@
+import os
+import json
+import math
+import numpy as np
+
+# --- VITALS HISTORY ---
+# Append-only, memory-mapped time series on disk: every analyzed frame (raw forehead/chest signals,
+# stable BPM/RPM), status changes, and 1 s / 1 min / 10 min rollups of the vitals. The rollups are
+# written as their buckets close, so a whole-night trend is a few hundred rows read straight from the
+# page cache; nothing is loaded into memory at startup and the history survives restarts.
+#
+# Each .ts file: 64-byte header (magic, row count, row size) followed by fixed-size rows. The file
+# grows in GROW_ROWS steps and the count is bumped after the row is written, so a crash loses at
+# most the last row.
+#
+# Retention: full-rate rows (samples, vitals) and the 1 s tier are dropped after their horizon; the
+# 1 min / 10 min trends and status events are kept. Trimming rewrites the file (new file, then
+# rename), so it only runs once the oldest rows are TRIM_SLACK past the horizon.
+MAGIC = 0x5354424D  # "MBTS"
+HEADER_BYTES = 64
+H_MAGIC, H_COUNT, H_ITEMSIZE = range(3)
+GROW_ROWS = 65536
+
+SAMPLE_DTYPE = np.dtype([("t", "<f8"), ("hr_signal", "<f4"), ("resp_signal", "<f4")])
+VITALS_FIELDS = ("bpm", "rpm", "raw_hr", "raw_rr", "cry")
+VITALS_DTYPE = np.dtype([("t", "<f8")] + [(f, "<f4") for f in VITALS_FIELDS])
+EVENT_DTYPE = np.dtype([("t", "<f8"), ("code", "<i4")])
+ROLLUP_DTYPE = np.dtype([("t", "<f8"), ("n", "<u4")] + [(f"{f}_{stat}", "<f4") for f in VITALS_FIELDS for stat in ("mean", "min", "max")])
+ROLLUP_TIERS = {"1s": 1.0, "1m": 60.0, "10m": 600.0} # Finest first
+RAW_RETENTION = 3 * 86400.0   # Seconds of full-rate samples/vitals kept
+FINE_RETENTION = 30 * 86400.0 # Seconds of the 1 s tier kept
+TRIM_SLACK = 0.1              # Fraction of the horizon the oldest rows may overstay (fewer rewrites)
+TRIM_CHECK = 3600.0           # Seconds between retention checks
+SERIES = ("vitals", "samples", "events")
+
+class MappedSeries:
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = dtype
+        if not os.path.exists(path): self._write(path, np.zeros(0, dtype=dtype))
+        self._open()
+
+    def _write(self, path, rows):
+        with open(path, "wb") as f:
+            header = np.zeros(HEADER_BYTES // 8, dtype=np.int64)
+            header[H_MAGIC], header[H_COUNT], header[H_ITEMSIZE] = MAGIC, len(rows), self.dtype.itemsize
+            f.write(header.tobytes())
+            f.write(rows.tobytes())
+            f.truncate(HEADER_BYTES + (len(rows) + GROW_ROWS) * self.dtype.itemsize)
+
+    def _open(self):
+        self.header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(HEADER_BYTES // 8,))
+        if self.header[H_MAGIC] != MAGIC or self.header[H_ITEMSIZE] != self.dtype.itemsize:
+            raise IOError(f"{self.path} is not a {self.dtype.itemsize}-byte time series")
+        self.count = int(self.header[H_COUNT])
+        self._map()
+
+    def _map(self):
+        self.capacity = (os.path.getsize(self.path) - HEADER_BYTES) // self.dtype.itemsize
+        self.rows = np.memmap(self.path, dtype=self.dtype, mode="r+", offset=HEADER_BYTES, shape=(self.capacity,))
+
+    def __len__(self):
+        return self.count
+
+    def last_time(self):
+        return float(self.rows["t"][self.count - 1]) if self.count else 0.0
+
+    def append(self, row):
+        if self.count == self.capacity:
+            self.rows.flush()
+            with open(self.path, "r+b") as f:
+                f.truncate(HEADER_BYTES + (self.capacity + GROW_ROWS) * self.dtype.itemsize)
+            self._map() # Readers holding the old map keep a valid (shorter) view
+        self.rows[self.count] = row
+        self.count += 1
+        self.header[H_COUNT] = self.count
+
+    def range(self, start, end):
+        """Copy of the rows with start <= t <= end (two binary searches over the mapped time column)"""
+        rows, count = self.rows, self.count
+        times = rows["t"][:count]
+        i = int(np.searchsorted(times, start, side="left"))
+        j = int(np.searchsorted(times, end, side="right"))
+        return np.array(rows[i:j])
+
+    def first_time(self):
+        return float(self.rows["t"][0]) if self.count else 0.0
+
+    def trim(self, before):
+        """Drops the rows with t < before; the kept rows go to a new file that replaces the old one
+        (a crash leaves the old file intact, readers holding the old map keep a valid view)"""
+        i = int(np.searchsorted(self.rows["t"][:self.count], before, side="left"))
+        if i == 0: return 0
+        self.flush()
+        tmp = self.path + ".tmp"
+        self._write(tmp, np.array(self.rows[i:self.count]))
+        os.replace(tmp, self.path)
+        self._open()
+        return i
+
+    def count_between(self, start, end):
+        times = self.rows["t"][:self.count]
+        return int(np.searchsorted(times, end, side="right") - np.searchsorted(times, start, side="left"))
+
+    def flush(self):
+        self.rows.flush()
+        self.header.flush()
+
+class Rollup:
+    """Mean/min/max per field over fixed buckets; a row is appended when its bucket closes"""
+    def __init__(self, series, period, fields=VITALS_FIELDS):
+        self.series = series
+        self.period = period
+        self.fields = fields
+        self.bucket = None
+        self.reset()
+
+    def state(self):
+        """The open bucket, so close() can keep it for the next start"""
+        if self.bucket is None or self.n == 0: return None
+        return {"bucket": self.bucket, "n": self.n, "sums": self.sums.tolist(), "counts": self.counts.tolist(),
+                "mins": self.mins.tolist(), "maxs": self.maxs.tolist()}
+
+    def restore(self, state):
+        if state is None or state["bucket"] * self.period <= self.series.last_time(): return # Already written
+        self.bucket, self.n = state["bucket"], state["n"]
+        self.sums, self.counts = np.array(state["sums"]), np.array(state["counts"])
+        self.mins, self.maxs = np.array(state["mins"]), np.array(state["maxs"])
+
+    def reset(self):
+        k = len(self.fields)
+        self.n = 0
+        self.sums = np.zeros(k)
+        self.counts = np.zeros(k)
+        self.mins = np.full(k, np.inf)
+        self.maxs = np.full(k, -np.inf)
+
+    def add(self, t, values):
+        bucket = math.floor(t / self.period)
+        if bucket != self.bucket:
+            if self.bucket is not None: self.flush_bucket()
+            self.bucket = bucket
+        valid = ~np.isnan(values) # Missing readings (no face, no estimate yet) don't drag the mean to 0
+        self.n += 1
+        self.sums[valid] += values[valid]
+        self.counts[valid] += 1
+        np.minimum(self.mins, values, out=self.mins, where=valid)
+        np.maximum(self.maxs, values, out=self.maxs, where=valid)
+
+    def flush_bucket(self):
+        if self.n == 0: return
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.counts
+        empty = self.counts == 0
+        stats = np.stack([means, np.where(empty, np.nan, self.mins), np.where(empty, np.nan, self.maxs)], axis=1)
+        self.series.append((self.bucket * self.period, self.n) + tuple(stats.ravel()))
+        self.reset()
+
+class VitalsStore:
+    def __init__(self, directory="history", raw_retention=RAW_RETENTION, fine_retention=FINE_RETENTION):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.samples = MappedSeries(os.path.join(directory, "samples.ts"), SAMPLE_DTYPE)
+        self.vitals = MappedSeries(os.path.join(directory, "vitals.ts"), VITALS_DTYPE)
+        self.events = MappedSeries(os.path.join(directory, "events.ts"), EVENT_DTYPE)
+        self.rollups = {name: Rollup(MappedSeries(os.path.join(directory, f"vitals_{name}.ts"), ROLLUP_DTYPE), period)
+                        for name, period in ROLLUP_TIERS.items()}
+        # Horizon per series (None = kept forever)
+        self.retention = [(self.samples, raw_retention), (self.vitals, raw_retention), (self.rollups["1s"].series, fine_retention)]
+        self.last_trim = 0.0
+        # Buckets still open at the last close() carry on where they stopped (once: a crash must not replay them)
+        self.open_buckets_file = os.path.join(directory, "open_buckets.json")
+        if os.path.exists(self.open_buckets_file):
+            try:
+                with open(self.open_buckets_file) as f:
+                    for name, state in json.load(f).items():
+                        if name in self.rollups: self.rollups[name].restore(state)
+            except (OSError, ValueError, KeyError):
+                pass
+            os.remove(self.open_buckets_file)
+        self.status_file = os.path.join(directory, "statuses.json")
+        self.statuses = []
+        if os.path.exists(self.status_file):
+            with open(self.status_file) as f:
+                self.statuses = json.load(f)
+        self.codes = {s: i for i, s in enumerate(self.statuses)}
+        self.last_status = None
+        self.last_time = max(self.vitals.last_time(), self.samples.last_time())
+
+    # --- WRITING (analysis thread) ---
+    def record(self, t, hr_signal, resp_signal, bpm, rpm, raw_hr, raw_rr, cry, status):
+        """One analyzed frame; 0 BPM/RPM (no estimate) and missing signals are stored as NaN"""
+        t = max(t, self.last_time) # Time columns must stay sorted (wall clock can step back)
+        self.last_time = t
+        self.samples.append((t, np.nan if hr_signal is None else hr_signal, np.nan if resp_signal is None else resp_signal))
+        values = np.array([bpm or np.nan, rpm or np.nan, raw_hr or np.nan, raw_rr or np.nan, cry], dtype=np.float64)
+        self.vitals.append((t,) + tuple(values))
+        for rollup in self.rollups.values():
+            rollup.add(t, values)
+        if status != self.last_status:
+            self.last_status = status
+            self.events.append((t, self.status_code(status)))
+        if t - self.last_trim >= TRIM_CHECK: self.enforce_retention(t)
+
+    def enforce_retention(self, now):
+        self.last_trim = now
+        for series, horizon in self.retention:
+            if horizon is None or not len(series): continue
+            if series.first_time() < now - horizon * (1 + TRIM_SLACK):
+                series.trim(now - horizon)
+
+    def status_code(self, status):
+        code = self.codes.get(status)
+        if code is None:
+            code = self.codes[status] = len(self.statuses)
+            self.statuses.append(status)
+            tmp = self.status_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.statuses, f)
+            os.replace(tmp, self.status_file)
+        return code
+
+    def close(self):
+        tmp = self.open_buckets_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({name: rollup.state() for name, rollup in self.rollups.items()}, f)
+        os.replace(tmp, self.open_buckets_file)
+        for series in [self.samples, self.vitals, self.events] + [r.series for r in self.rollups.values()]:
+            series.flush()
+
+    # --- QUERIES (blocking: call them in an executor) ---
+    def pick_resolution(self, start, end, max_points):
+        """Finest tier that returns at most max_points rows for the range"""
+        if self.vitals.count_between(start, end) <= max_points: return "raw"
+        for name, period in ROLLUP_TIERS.items():
+            if (end - start) / period <= max_points: return name
+        return list(ROLLUP_TIERS)[-1]
+
+    def query(self, series="vitals", start=None, end=None, resolution="auto", max_points=1000):
+        if series not in SERIES: raise ValueError(f"unknown series {series!r}")
+        max_points = int(max_points)
+        if max_points < 1: raise ValueError("max_points must be at least 1") # [-0:] would return everything
+        end = float(end) if end is not None else self.last_time
+        start = float(start) if start is not None else end - 3600.0
+        reply = {"type": "history", "series": series, "start": start, "end": end}
+        if series == "events":
+            rows = self.events.range(start, end)
+            reply.update(t=column(rows["t"], 3), status=[self.statuses[c] for c in rows["code"]])
+            return reply
+        if series == "samples":
+            rows = self.samples.range(start, end)[-max_points:] # Raw signals only make sense at full rate
+            reply.update(resolution="raw", t=column(rows["t"], 3), hr_signal=column(rows["hr_signal"]), resp_signal=column(rows["resp_signal"]))
+            return reply
+        if resolution == "auto": resolution = self.pick_resolution(start, end, max_points)
+        if resolution == "raw":
+            rows = self.vitals.range(start, end)[-max_points:]
+        elif resolution in self.rollups:
+            rows = self.rollups[resolution].series.range(start, end)[-max_points:]
+        else:
+            raise ValueError(f"unknown resolution {resolution!r}")
+        reply["resolution"] = resolution
+        for name in rows.dtype.names:
+            reply[name] = column(rows[name], 3 if name == "t" else 2)
+        return reply
+
+def column(values, decimals=2):
+    # JSON has no NaN: gaps go out as null
+    return [None if v != v else v for v in np.round(values.astype(np.float64), decimals).tolist()]